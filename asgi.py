@@ -0,0 +1,1430 @@
+"""Asyncio entrypoint serving the same routes and responses as index.py
+
+Requests wait on Postgres through an async connection pool instead of
+pinning a worker thread, so one process can hold thousands of in-flight
+requests. Run it with any ASGI server, for example:
+
+    hypercorn asgi:app
+"""
+import asyncio
+import hmac
+import json
+import os
+import re
+from time import perf_counter, time
+
+import psycopg
+import psycopg2
+from psycopg.types.string import TextLoader
+from psycopg_pool import AsyncConnectionPool
+from quart import Quart, Response, has_request_context, jsonify, request, websocket
+from werkzeug.exceptions import HTTPException
+
+import board_pool
+import export
+import game_history
+import logs
+import metrics
+import passwords
+import queries
+import query_log
+import rate_limit
+import responses
+import session_tokens
+import single_flight
+from game import (
+    apply_click,
+    dump_game_data,
+    get_battlepass_lvl,
+    get_tile_index,
+    load_game_data,
+    materialize_board,
+    record_click,
+    sanitize_game_data,
+    win_rewards,
+)
+from serializers import json_serializer, negotiate_serializer, serializers
+
+app = Quart(__name__)
+logs.configure()
+logger = logs.logger
+
+started_at = time()
+
+
+class MetricsAsyncCursor(psycopg.AsyncCursor):
+    """Async counterpart of metrics.MetricsCursor"""
+
+    async def execute(self, query, params=None, **kwargs):
+        start = perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            duration = perf_counter() - start
+            stats = metrics.current_stats()
+            if stats is not None:
+                stats.db_time += duration
+                stats.queries += 1
+            bound_query = None
+            if duration >= query_log.threshold and query_log.explain_connect is not None:
+                bound_query = self._bind(query, params)
+            query_log.record(query, bound_query, duration, stats.route if stats else None)
+
+    def _bind(self, query, params):
+        """The statement with its parameters inlined, like psycopg2's cursor.query,
+        for query_log's EXPLAIN. Statements are sent with server-side binding,
+        so this is only rendered for slow ones"""
+        try:
+            return psycopg.AsyncClientCursor(self.connection).mogrify(query, params).encode('utf-8')
+        except Exception:
+            return None
+
+    def _count_rows(self, count):
+        stats = metrics.current_stats()
+        if stats is not None:
+            stats.rows += count
+
+    async def fetchone(self):
+        row = await super().fetchone()
+        if row is not None:
+            self._count_rows(1)
+        return row
+
+    async def fetchmany(self, size=0):
+        rows = await super().fetchmany(size)
+        self._count_rows(len(rows))
+        return rows
+
+    async def fetchall(self):
+        rows = await super().fetchall()
+        self._count_rows(len(rows))
+        return rows
+
+
+class MetricsAsyncConnection(psycopg.AsyncConnection):
+    """Async counterpart of metrics.MetricsConnection"""
+
+    async def commit(self):
+        if self.pgconn.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            metrics.count_commit()
+        return await super().commit()
+
+
+async def configure_connection(conn):
+    # index.py (psycopg2) returns uuids as strings, keep the same responses
+    conn.adapters.register_loader('uuid', TextLoader)
+
+
+# Same environment as index.connect()
+db_params = {
+    'dbname': os.environ.get('DB_NAME', 'postgres'),
+    'user': os.environ.get('DB_USER', 'postgres.wicmdrinzqmsffrhqxyg'),
+    'password': os.environ.get('DB_PASSWORD'),
+    'host': os.environ.get('DB_HOST'),
+    'port': int(os.environ.get('DB_PORT', 5432)),
+    'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 10))
+}
+pool = AsyncConnectionPool(
+    kwargs={**db_params, 'cursor_factory': MetricsAsyncCursor},
+    connection_class=MetricsAsyncConnection,
+    min_size=int(os.environ.get('DB_POOL_MIN', 2)),
+    max_size=int(os.environ.get('DB_POOL_MAX', 20)),
+    configure=configure_connection,
+    open=False
+)
+
+def explain_connect():
+    """Side connection for query_log's EXPLAIN, which runs on its own thread.
+    A plain psycopg2 connection like index.py's, so plans aren't counted in metrics"""
+    return psycopg2.connect(**db_params)
+
+query_log.explain_connect = explain_connect
+# Concurrent identical reads of a session's user share one fetch
+reads = single_flight.AsyncSingleFlight()
+# Runs keep_revocations_synced() while signed tokens are enabled
+revocation_sync = None
+# Finished games are written to game_results in batches, off the click's path
+results = game_history.AsyncResultWriter()
+results_writer = None
+# Click flushes of channels that closed mid-game, kept referenced until they finish
+click_flushes = set()
+# Same readiness contract as index.py: probes share one SELECT 1 per READINESS_CACHE_S
+readiness_ttl = float(os.environ.get('READINESS_CACHE_S', 2))
+readiness_timeout_ms = int(os.environ.get('READINESS_TIMEOUT_MS', 1000))
+readiness = {'checked_at': 0.0, 'result': None}
+readiness_lock = asyncio.Lock()
+
+
+@app.before_serving
+async def open_pool():
+    global revocation_sync, results_writer
+    await pool.open()
+    board_pool.start()
+    if game_history.ENABLED:
+        results_writer = asyncio.ensure_future(results.run(pool))
+    rate_limit.admission.pool_waiting = lambda: pool.get_stats().get('requests_waiting', 0)
+    if session_tokens.ENABLED:
+        # Revoked tokens must be known before the first request trusts one
+        await sync_revocations()
+        revocation_sync = asyncio.ensure_future(keep_revocations_synced())
+
+
+@app.after_serving
+async def close_pool():
+    if revocation_sync is not None:
+        revocation_sync.cancel()
+    if results_writer is not None:
+        results_writer.cancel()
+        await results.flush(pool)
+    if click_flushes:
+        await asyncio.wait(click_flushes)
+    await pool.close()
+
+
+# FUNCTIONS
+async def get_request_data():
+    """Decode the request body according to its Content-Type"""
+    serializer = serializers.get(request.mimetype)
+    if serializer is None or serializer is json_serializer:
+        return await request.get_json()
+    return serializer.loads(await request.get_data())
+
+async def request_session_id():
+    """session_id of the request for rate limiting, None if it has none"""
+    try:
+        if request.mimetype in serializers:
+            data = await get_request_data()
+        else:
+            data = await request.values
+    except Exception:
+        return None # the handler reports malformed bodies
+    return data.get('session_id') if isinstance(data, dict) else None
+
+def respond(data):
+    """Serialize data using the encoding negotiated from the Accept header"""
+    serializer = negotiate_serializer(request.accept_mimetypes)
+    if serializer is json_serializer:
+        response = jsonify(data)
+    else:
+        response = Response(serializer.dumps(data), mimetype=serializer.mimetype)
+    response.vary.add('Accept')
+    return response
+
+def hash_password(password, salt):
+    """PBKDF2 takes a few hundred ms of CPU, keep it off the event loop"""
+    return asyncio.to_thread(passwords.hash_password, password, salt)
+
+def is_admin():
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    if not admin_token:
+        return False
+    return hmac.compare_digest(
+        request.headers.get('Authorization', ''),
+        f"Bearer {admin_token}"
+    )
+
+def pool_stats():
+    stats = pool.get_stats()
+    return {
+        'max': pool.max_size,
+        'in_use': stats['pool_size'] - stats['pool_available'],
+        'idle': stats['pool_available']
+    }
+
+async def get_session_user(cursor, session_id):
+    """user_id for session_id, or None. Signed tokens are checked without the sessions table"""
+    if session_tokens.is_token(session_id):
+        session = session_tokens.verify(session_id)
+        return session[1] if session else None
+    await cursor.execute(queries.SESSION_USER, (session_id,))
+    session = await cursor.fetchone()
+    return session[0] if session else None
+
+async def new_session(cursor, user_id):
+    """A signed token for user_id when SESSION_TOKEN_KEYS is set, otherwise a new sessions row"""
+    if session_tokens.ENABLED:
+        return session_tokens.issue(user_id)
+    await cursor.execute(queries.NEW_SESSION, (user_id,))
+    session = await cursor.fetchone()
+    return str(session[0]) if session else None
+
+async def sync_revocations():
+    """Pick up token revocations made by other instances every SESSION_REVOCATION_SYNC_S"""
+    revocations = session_tokens.revocations
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute(session_tokens.SYNC_SQL, (revocations.since(),))
+        revocations.apply(await cursor.fetchall())
+
+async def keep_revocations_synced():
+    while True:
+        await asyncio.sleep(session_tokens.revocations.sync_interval)
+        try:
+            await sync_revocations()
+        except Exception:
+            logger.exception("revocation sync failed")
+
+def wrong_session():
+    body, status = responses.wrong_session()
+    return respond(body), status
+
+
+@app.before_request
+async def start_request():
+    logs.begin(request)
+    metrics.begin(metrics.route_label(request))
+    if request.method == 'OPTIONS':
+        return None
+    rejected = rate_limit.check(
+        metrics.route_label(request),
+        await request_session_id(),
+        rate_limit.client_ip(request.remote_addr, request.headers)
+    )
+    if rejected is not None:
+        data, status, headers = rate_limit.rejection(*rejected)
+        return respond(data), status, headers
+
+@app.after_request
+async def finish_request(response):
+    metrics.observe(response.status_code, response.content_length or 0)
+    logs.finish_request(response)
+
+    # Same behaviour as flask_cors with its defaults
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    if request.method == 'OPTIONS':
+        response.headers['Access-Control-Allow-Methods'] = 'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'
+        if 'Access-Control-Request-Headers' in request.headers:
+            response.headers['Access-Control-Allow-Headers'] = request.headers['Access-Control-Request-Headers']
+    return response
+
+@app.teardown_request
+async def end_request(_exc=None):
+    rate_limit.done()
+
+@app.errorhandler(Exception)
+async def handle_exception(e):
+    if isinstance(e, HTTPException) or not has_request_context():
+        return e
+    logger.exception("unhandled error")
+    return respond({"error": str(e)}), 500
+
+
+# ROUTES
+@app.route('/')
+async def index():
+    return "This is only an api! If you want to access the game, go to <a href=\"https://sapper-zeta.vercel.app/\">https://sapper-zeta.vercel.app/</a>"
+
+@app.route('/metrics')
+async def get_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/admin/slow_queries')
+async def admin_slow_queries():
+    if not is_admin():
+        return respond(responses.fail("not authorized")), 403
+    return respond({"type": "success", **query_log.report()}), 200
+
+@app.route('/admin/export/<table>')
+async def admin_export(table):
+    if not is_admin():
+        return respond(responses.fail("not authorized")), 403
+    if table not in export.TABLES:
+        return respond(responses.fail("unknown table")), 404
+    output_format = request.args.get('format', 'ndjson')
+    if output_format not in export.FORMATS:
+        return respond(responses.fail("unknown format")), 400
+    columns, sql = export.TABLES[table]
+
+    async def generate():
+        # The pool connection is held until the last row is sent, or the client goes away
+        async with pool.connection() as conn:
+            await conn.execute("SET TRANSACTION READ ONLY")
+            # A named cursor is declared on the server, each fetchmany is one FETCH of BATCH_SIZE rows
+            cursor = conn.cursor(name=f"export_{table}")
+            await cursor.execute(sql)
+            header = export.header(columns, output_format)
+            # An empty chunk would end a chunked response early
+            if header:
+                yield header
+            while True:
+                rows = await cursor.fetchmany(export.BATCH_SIZE)
+                if not rows:
+                    break
+                export.exported_rows.inc(table, amount=len(rows))
+                yield export.format_rows(columns, rows, output_format)
+            await cursor.close()
+
+    response = Response(generate(), mimetype=export.FORMATS[output_format], headers={
+        'Content-Disposition': f'attachment; filename="{table}.{output_format}"'
+    })
+    # Large tables take longer than Quart's default response timeout to send
+    response.timeout = None
+    return response
+
+@app.route('/livez')
+async def livez():
+    return respond({
+        "type": "success",
+        "status": "alive",
+        "uptime_s": round(time() - started_at, 1),
+        "pool": pool_stats()
+    }), 200
+
+async def check_database():
+    """Same as index.check_database(), returns (result, cached)"""
+    result = readiness['result']
+    if result is not None and time() - readiness['checked_at'] < readiness_ttl:
+        return result, True
+
+    async with readiness_lock:
+        result = readiness['result']
+        if result is not None and time() - readiness['checked_at'] < readiness_ttl:
+            return result, True
+
+        start = perf_counter()
+        try:
+            async with pool.connection(timeout=readiness_timeout_ms / 1000) as conn:
+                cursor = conn.cursor()
+                # SET can't take a bound parameter, set_config() is its function form
+                await cursor.execute("SELECT set_config('statement_timeout', %s, true)", (str(readiness_timeout_ms),))
+                await cursor.execute("SELECT 1")
+                await cursor.fetchone()
+                await conn.rollback()
+            result = {'ready': True}
+        except Exception as e:
+            result = {'ready': False, 'error': str(e)}
+        result['latency_ms'] = round((perf_counter() - start) * 1000, 2)
+
+        readiness['result'] = result
+        readiness['checked_at'] = time()
+        return result, False
+
+@app.route('/readyz')
+async def readyz():
+    """Readiness: the database answers a pooled SELECT 1"""
+    result, cached = await check_database()
+    data = {
+        "type": "success" if result['ready'] else "fail",
+        "status": "ready" if result['ready'] else "unavailable",
+        "latency_ms": result['latency_ms'],
+        "checked_at": readiness['checked_at'],
+        "cached": cached,
+        "pool": pool_stats()
+    }
+    if not result['ready']:
+        data['reason'] = result['error']
+        return respond(data), 503
+    return respond(data), 200
+
+@app.route('/warmup')
+async def warmup():
+    """Same as index.py's, the pool here is already opened before serving"""
+    result, _cached = await check_database()
+    data = {
+        "type": "success" if result['ready'] else "fail",
+        "status": "ready" if result['ready'] else "unavailable",
+        "latency_ms": result['latency_ms'],
+        "pool": pool_stats()
+    }
+    if not result['ready']:
+        data['reason'] = result['error']
+        return respond(data), 503
+    return respond(data), 200
+
+@app.route('/health')
+async def health():
+    result, _ = await check_database()
+    timing = f"db select {round(result['latency_ms'] / 1000, 2)}s"
+    if not result['ready']:
+        return respond({'error': 'db error', 'timing': timing}), 500
+    return respond({'response': 'ok', 'timing': timing}), 200
+
+@app.route('/login', methods=['POST'])
+async def login():
+    form = await request.form
+    email = form['email']
+    password = form['password']
+    if not responses.valid_password(password):
+        logger.info("invalid password length")
+        return respond(responses.fail("invalid password length")), 200
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute(queries.LOGIN_USER, (email,))
+        user = await cursor.fetchone()
+
+        if user is None:
+            return respond(responses.fail("username or password is incorrect")), 200
+
+        if passwords.from_bits(user[1]) != await hash_password(password, passwords.from_bits(user[2])):
+            return respond(responses.fail("username or password is incorrect")), 200
+
+        session_id = await new_session(cursor, user[0])
+
+    if not session_id:
+        return respond({"error":"unknown db error"}), 500
+
+    logger.info("user logged in", extra={"user_id": user[0]})
+    return respond(responses.login(user, session_id)), 200
+
+@app.route('/register', methods=['POST'])
+async def register():
+    form = await request.form
+    email = form['email']
+
+    username = form['username']
+    if re.match(f"^[a-zA-Z0-9_]{5,24}$", username):
+        logger.info("invalid username")
+        return respond(responses.fail("invalid username")), 200
+
+    password = form['password']
+    if not responses.valid_password(password):
+        logger.info("invalid password length")
+        return respond(responses.fail("invalid password length")), 200
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        await cursor.execute(queries.EMAIL_TAKEN, (email,))
+        if await cursor.fetchone():
+            return respond(responses.fail("account with this email already exists")), 200
+
+        await cursor.execute(queries.USERNAME_TAKEN, (username,))
+        if await cursor.fetchone():
+            return respond(responses.fail("username is taken")), 200
+
+        salt = os.urandom(64)
+        password_hash = await hash_password(password, salt)
+        await cursor.execute(queries.REGISTER_USER, (email, username, password_hash, salt))
+        user = await cursor.fetchone()
+
+        if not user:
+            return respond({"error":"unknown db error"}), 500
+        logger.info("created account", extra={"user_id": user[0]})
+
+        session_id = await new_session(cursor, user[0])
+
+    if not session_id:
+        return respond({"error":"unknown db error"}), 500
+
+    return respond({
+        "type": "success",
+        "session_id": session_id,
+        "username": username
+    }), 200
+
+@app.route('/logout', methods=['POST'])
+async def logout():
+    session_id = (await get_request_data())['session_id']
+
+    if not session_id:
+        logger.info("user already logged out")
+        return respond({"type":"success"}), 200
+
+    async with pool.connection() as conn:
+        if session_tokens.is_token(session_id):
+            # Tokens stay valid until they expire, other instances learn of the logout on their next sync
+            values = session_tokens.revoke(session_id)
+            if values:
+                await conn.cursor().execute(session_tokens.REVOKE_SQL, values)
+        else:
+            await conn.cursor().execute(queries.DELETE_SESSION, (session_id,))
+    reads.invalidate(session_id)
+
+    logger.info("user logged out")
+    return respond({"type":"success"}), 200
+
+@app.route('/change_password', methods=['POST'])
+async def change_password():
+    form = await request.form
+    session_id = form['session_id']
+    if not session_id:
+        return respond(responses.fail("missing session id")), 400
+
+    old_password = form['old_password']
+    new_password = form['new_password']
+    if not responses.valid_password(old_password) or not responses.valid_password(new_password):
+        return respond(responses.fail("invalid password length")), 400
+
+    if form['confirm_new_password'] != new_password:
+        return respond(responses.fail("passwords do not match")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        if session_tokens.is_token(session_id):
+            user_id = await get_session_user(cursor, session_id)
+        else:
+            await cursor.execute(queries.SESSION_USER_FOR_UPDATE, (session_id,))
+            session = await cursor.fetchone()
+            user_id = session[0] if session else None
+
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.PASSWORD_FOR_UPDATE, (user_id,))
+        user = await cursor.fetchone()
+
+        if not user:
+            return respond({"error":"unknown db error"}), 500
+
+        if passwords.from_bits(user[0]) != await hash_password(old_password, passwords.from_bits(user[1])):
+            return respond(responses.fail("old password is incorrect")), 401
+
+        new_salt = os.urandom(64)
+        new_password_hash = await hash_password(new_password, new_salt)
+        await cursor.execute(queries.SET_PASSWORD, (new_password_hash, new_salt, user_id))
+
+        await cursor.execute(queries.DELETE_USER_SESSIONS, (user_id,))
+        if session_tokens.ENABLED:
+            await cursor.execute(session_tokens.REVOKE_SQL, session_tokens.revoke_user(user_id))
+
+        session_id = await new_session(cursor, user_id)
+
+    if not session_id:
+        return respond({"error":"unknown db error"}), 500
+
+    return respond({
+        "type": "success",
+        "session_id": session_id
+    }), 200
+
+@app.route('/get_user_id')
+async def get_user_id():
+    session_id = (await get_request_data())['session_id']
+    if not session_id:
+        return respond(responses.fail("missing session id")), 401
+
+    async with pool.connection() as conn:
+        user_id = await get_session_user(conn.cursor(), session_id)
+
+    if not user_id:
+        return wrong_session()
+    return respond({"type": "success", "id": user_id}), 200
+
+@app.route('/get_statistics', methods=['POST'])
+async def get_statistics():
+    session_id = (await get_request_data())['session_id']
+    if not session_id:
+        return respond(responses.fail("missing session id")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.USER_PROFILE, (user_id,))
+        user = await cursor.fetchone()
+
+    if not user:
+        return respond(responses.fail("user doesn't exist")), 400
+    return respond(responses.statistics(user)), 200
+
+@app.route('/game_history', methods=['POST'])
+async def get_game_history():
+    data = await get_request_data()
+    session_id = data['session_id']
+    if not session_id:
+        return respond(responses.fail("missing session id")), 400
+    params = responses.history_params(data)
+    if params is None:
+        return respond(responses.fail("invalid parameters")), 400
+    limit, before = params
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        values = {**session_tokens.session_params(session_id), 'before': before, 'limit': limit}
+        await cursor.execute(queries.GAME_HISTORY, values)
+        rows = await cursor.fetchall()
+
+    if not rows:
+        return wrong_session()
+    return respond(responses.history(rows)), 200
+
+
+@app.route('/game_replay', methods=['POST'])
+async def get_game_replay():
+    data = await get_request_data()
+    session_id = data['session_id']
+    if not session_id or data['game_id'] is None:
+        return respond(responses.fail("missing parameters")), 400
+    params = responses.replay_params(data)
+    if params is None:
+        return respond(responses.fail("invalid parameters")), 400
+    result_id, step = params
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        values = {**session_tokens.session_params(session_id), 'result_id': result_id}
+        await cursor.execute(queries.GAME_REPLAY, values)
+        row = await cursor.fetchone()
+
+    body, status = responses.replay(row, step)
+    return respond(body), status
+
+# FRIEND ENDPOINTS
+@app.route('/add_friend', methods=['POST'])
+async def add_friend():
+    data = await get_request_data()
+    session_id = data['session_id']
+    friend_id = data['user_id']
+
+    if not session_id or not friend_id:
+        return respond(responses.fail("missing parameters")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.USER_EXISTS, (friend_id,))
+        friend = await cursor.fetchone()
+
+        if not friend or not friend[0]:
+            return respond(responses.fail("friend does not exist")), 400
+
+        await cursor.execute(queries.FRIENDS_FOR_UPDATE, (user_id,))
+        user = await cursor.fetchone()
+
+        if not user:
+            return respond({"error": "failed to fetch user from database"}), 500
+
+        friends_list = list(user[0] or [])
+        if friend_id in friends_list:
+            return respond(responses.fail("user is already your friend")), 400
+
+        friends_list.append(friend_id)
+        await cursor.execute(queries.SET_FRIENDS, (friends_list, user_id))
+
+    return respond({"type": "success"}), 200
+
+@app.route('/remove_friend', methods=['POST'])
+async def remove_friend():
+    data = await get_request_data()
+    session_id = data['session_id']
+    friend_id = data['user_id']
+
+    if not session_id or not friend_id:
+        return respond(responses.fail("missing parameters")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.FRIENDS_FOR_UPDATE, (user_id,))
+        user = await cursor.fetchone()
+
+        if not user:
+            return respond({"error": "unknown db error"}), 500
+
+        friends_list = list(user[0] or [])
+        if friend_id not in friends_list:
+            return respond(responses.fail("user is not your friend")), 400
+
+        friends_list.remove(friend_id)
+        await cursor.execute(queries.SET_FRIENDS, (friends_list, user_id))
+
+    return respond({"type": "success"}), 200
+
+@app.route('/get_friends', methods=['POST'])
+async def get_friends():
+    session_id = (await get_request_data())['session_id']
+    if not session_id:
+        return respond(responses.fail("missing session id")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.FRIENDS, (user_id,))
+        friends = await cursor.fetchall()
+
+    return respond({"type": "success", "friends": responses.users(friends)}), 200
+
+@app.route('/search_users', methods=['POST'])
+async def search_users():
+    data = await get_request_data()
+    session_id = data['session_id']
+    query = data['query']
+
+    if not session_id or not query:
+        return respond(responses.fail("missing parameters")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.SEARCH_USERS, (query, user_id))
+        users = await cursor.fetchall()
+
+    return respond({"type": "success", "users": responses.users(users)}), 200
+
+@app.route('/user_info', methods=['POST'])
+async def user_info():
+    data = await get_request_data()
+    session_id = data['session_id']
+    friend_id = data['user_id']
+
+    if not session_id or not friend_id:
+        return respond(responses.fail("missing parameters")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        if not await get_session_user(cursor, session_id):
+            return wrong_session()
+
+        await cursor.execute(queries.USER_PROFILE, (friend_id,))
+        user = await cursor.fetchone()
+
+    if not user:
+        return respond(responses.fail("user doesn't exist")), 400
+    return respond(responses.statistics(user)), 200
+
+
+@app.route('/users_info', methods=['POST'])
+async def users_info():
+    data = await get_request_data()
+    session_id = data['session_id']
+    user_ids = data['user_ids']
+
+    if not session_id or not isinstance(user_ids, list):
+        return respond(responses.fail("missing parameters")), 400
+    user_ids, reason = responses.users_info_ids(user_ids)
+    if reason:
+        return respond(responses.fail(reason)), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        values = {**session_tokens.session_params(session_id), 'user_ids': user_ids}
+        await cursor.execute(queries.USERS_PROFILES, values)
+        rows = await cursor.fetchall()
+
+    if not rows:
+        return wrong_session()
+    return respond(responses.users_info(rows)), 200
+
+
+# SHOP ENDPOINTS
+async def fetch_user_fields(session_id, fields):
+    """(found_session, row) for a SELECT of fields on the session's user.
+    Concurrent calls for the same session and fields share one fetch"""
+    async def fetch():
+        async with pool.connection() as conn:
+            cursor = conn.cursor()
+            user_id = await get_session_user(cursor, session_id)
+            if not user_id:
+                return False, None
+            await cursor.execute(queries.USER_FIELDS.format(fields=fields), (user_id,))
+            return True, await cursor.fetchone()
+
+    return await reads.do(session_id, fields, fetch)
+
+@app.route('/me', methods=['POST'])
+async def me():
+    data = await get_request_data()
+    session_id = data['session_id']
+    fields = responses.profile_fields(data.get('fields'))
+    if not session_id:
+        return respond(responses.fail("not logged in")), 400
+    if fields is None:
+        return respond(responses.fail("unknown field")), 400
+
+    columns = responses.profile_columns(fields)
+
+    async def fetch():
+        async with pool.connection() as conn:
+            cursor = conn.cursor()
+            sql = queries.SESSION_USER_FIELDS.format(fields=columns)
+            await cursor.execute(sql, session_tokens.session_params(session_id))
+            return await cursor.fetchone()
+
+    user = await reads.do(session_id, columns, fetch)
+    if not user:
+        return wrong_session()
+    return respond(responses.profile(fields, user)), 200
+
+# general
+@app.route('/get_balance', methods=['POST'])
+async def get_balance():
+    session_id = (await get_request_data())['session_id']
+    if not session_id:
+        return respond(responses.fail("missing session id")), 400
+
+    found, user = await fetch_user_fields(session_id, "coins, gems")
+    if not found:
+        return wrong_session()
+    if not user:
+        return respond(responses.fail("wrong user id")), 401
+    return respond({"type": "success", "coins": user[0], "gems": user[1]}), 200
+
+@app.route('/get_xp', methods=['POST'])
+async def get_xp():
+    session_id = (await get_request_data())['session_id']
+    if not session_id:
+        return respond(responses.fail("missing session id")), 400
+
+    found, user = await fetch_user_fields(session_id, "xp, bp_xp")
+    if not found:
+        return wrong_session()
+    if not user:
+        return respond(responses.fail("wrong user id")), 404
+    return respond({"type": "success", "xp": user[0], "battlepass_xp": user[1]}), 200
+
+
+# skins
+@app.route('/get_all_skins')
+async def get_all_skins():
+    async with pool.connection() as conn:
+        cursor = await conn.execute(queries.SKINS)
+        skins = await cursor.fetchall()
+    return respond(responses.skins(skins)), 200
+
+@app.route('/get_user_skins', methods=['POST'])
+async def get_user_skins():
+    session_id = (await get_request_data())['session_id']
+
+    found, user = await fetch_user_fields(session_id, "owned_skins")
+    if not found:
+        return wrong_session()
+    if not user:
+        return respond(responses.fail("wrong user id")), 401
+    return respond({"ids": user[0]}), 200
+
+@app.route('/buy_skin', methods=['POST'])
+async def buy_skin():
+    data = await get_request_data()
+    session_id = data['session_id']
+    skin_id = data['skin_id']
+    currency = data['currency']
+
+    if not session_id or not skin_id or not currency:
+        return respond(responses.fail("missing parameters")), 400
+
+    if currency not in ['coins', 'gems']:
+        return respond(responses.fail("invalid currency")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.SKIN_BALANCE.format(currency=currency), (user_id,))
+        user = await cursor.fetchone()
+
+        if not user:
+            return respond(responses.fail("wrong user id")), 401
+
+        user_balance = user[0]
+        user_skins = user[1] if user[1] else []
+
+        if skin_id in user_skins:
+            return respond(responses.fail("skin already owned")), 400
+
+        await cursor.execute(queries.SKIN_PRICE.format(currency=currency), (skin_id,))
+        skin = await cursor.fetchone()
+
+        if not skin:
+            return respond(responses.fail("wrong skin id")), 401
+
+        skin_price = skin[0]
+        if skin_price > user_balance:
+            return respond(responses.fail("insufficient funds")), 401
+
+        user_skins.append(skin_id)
+        await cursor.execute(queries.BUY_SKIN.format(currency=currency), (skin_price, user_skins, user_id))
+    reads.invalidate(session_id)
+
+    return respond({
+        "type": "success",
+        "currency": currency,
+        "new_balance": user_balance - skin_price
+    }), 200
+
+
+# currency
+@app.route('/buy_gems', methods=['POST'])
+async def buy_gems():
+    data = await get_request_data()
+    session_id = data['session_id']
+    amount = data['gemsQuantity']
+
+    if not session_id or not amount:
+        return respond(responses.fail("missing parameters")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.ADD_GEMS, (amount, user_id))
+        gems = (await cursor.fetchone())[0]
+    reads.invalidate(session_id)
+
+    return respond({"type": "success", "new_balance": gems}), 200
+
+
+# battlepass
+@app.route('/buy_battlepass', methods=['POST'])
+async def buy_battlepass():
+    session_id = (await get_request_data())['session_id']
+    battlepass_cost = 950
+
+    if not session_id:
+        return respond(responses.fail("not logged in")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.BATTLEPASS_USER, (user_id,))
+        user = await cursor.fetchone()
+
+        if not user:
+            return respond(responses.fail("unknown user error")), 400
+
+        gems, battlepass_xp, booster_count, owned_avatars, owned_skins = user
+        if gems < battlepass_cost:
+            return respond(responses.fail("not enough gems")), 401
+
+        # Add items from battlepass
+        booster_count, owned_avatars, owned_skins = responses.add_battlepass_items(
+            range(1, get_battlepass_lvl(battlepass_xp)+1),
+            booster_count, owned_avatars, owned_skins
+        )
+        values = (battlepass_cost, True, booster_count, owned_avatars, owned_skins, user_id)
+        await cursor.execute(queries.BUY_BATTLEPASS, values)
+        gems = (await cursor.fetchone())[0]
+    reads.invalidate(session_id)
+
+    return respond({"type": "success", "new_balance": gems}), 200
+
+@app.route('/battlepass_status', methods=['POST'])
+async def battlepass_status():
+    session_id = (await get_request_data())['session_id']
+    if not session_id:
+        return respond(responses.fail("not logged in")), 400
+
+    found, user = await fetch_user_fields(session_id, "owns_battlepass")
+    if not found:
+        return wrong_session()
+    if not user:
+        return respond(responses.fail("unknown user error")), 400
+    return respond({"type": "success", "owned": "true" if user[0] else "false"}), 200
+
+
+# boosters
+@app.route('/get_booster_count', methods=['POST'])
+async def get_booster_count():
+    session_id = (await get_request_data())['session_id']
+    if not session_id:
+        return respond(responses.fail("not logged in")), 400
+
+    found, user = await fetch_user_fields(session_id, "booster_count")
+    if not found:
+        return wrong_session()
+    if not user:
+        return respond(responses.fail("unknown user error")), 400
+    return respond({"type": "success", "booster_count": user[0]}), 200
+
+@app.route('/buy_booster', methods=['POST'])
+async def buy_booster():
+    data = await get_request_data()
+    session_id = data['session_id']
+    currency = data['currency']
+
+    if not session_id or not currency:
+        return respond(responses.fail("missing parameters")), 400
+
+    if currency == "coins":
+        booster_cost = 200
+    elif currency == "gems":
+        booster_cost = 50
+    else:
+        return respond(responses.fail("wrong currency")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.BALANCE_FOR_UPDATE.format(currency=currency), (user_id,))
+        user = await cursor.fetchone()
+
+        if not user:
+            return respond(responses.fail("unknown user error")), 400
+
+        balance = user[0]
+        if balance < booster_cost:
+            return respond(responses.fail(f"not enough {currency}")), 401
+
+        await cursor.execute(queries.BUY_BOOSTER.format(currency=currency), (booster_cost, 1, user_id))
+        booster_count = (await cursor.fetchone())[0]
+    reads.invalidate(session_id)
+
+    return respond({
+        "type": "success",
+        "new_balance": balance - booster_cost,
+        "currency": currency,
+        "booster_count": booster_count
+    }), 200
+
+
+# avatars
+@app.route('/set_avatar', methods=['POST'])
+async def set_avatar():
+    data = await get_request_data()
+    session_id = data['session_id']
+    avatar_id = data['avatar_id']
+
+    if not session_id or not avatar_id:
+        return respond(responses.fail("missing parameters")), 400
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        user_id = await get_session_user(cursor, session_id)
+        if not user_id:
+            return wrong_session()
+
+        await cursor.execute(queries.AVATARS_FOR_UPDATE, (user_id,))
+        user = await cursor.fetchone()
+
+        if not user:
+            return respond(responses.fail("unknown user error")), 400
+
+        if avatar_id not in list(user[0]):
+            return respond(responses.fail(f"user doesn't own avatar with id {avatar_id}")), 401
+
+        await cursor.execute(queries.SET_AVATAR, (avatar_id, user_id))
+    reads.invalidate(session_id)
+
+    return respond({"type": "success"}), 200
+
+@app.route('/get_avatar', methods=['POST'])
+async def get_avatar():
+    session_id = (await get_request_data())['session_id']
+    if not session_id:
+        return respond(responses.fail("not logged in")), 400
+
+    found, user = await fetch_user_fields(session_id, "avatar")
+    if not found:
+        return wrong_session()
+    if not user:
+        return respond(responses.fail("unknown user error")), 400
+    return respond({"type": "success", "avatar_id": user[0]}), 200
+
+@app.route('/get_user_avatars', methods=['POST'])
+async def get_user_avatars():
+    session_id = (await get_request_data())['session_id']
+    if not session_id:
+        return respond(responses.fail("not logged in")), 400
+
+    found, user = await fetch_user_fields(session_id, "owned_avatars")
+    if not found:
+        return wrong_session()
+    if not user:
+        return respond(responses.fail("unknown user error")), 400
+    return respond({"type": "success", "owned_avatars": user[0]}), 200
+
+
+# GAME ENDPOINTS
+async def load_game(cursor, session_id):
+    """(game_data, start_time, version) of the session's game, or None"""
+    await cursor.execute(queries.LOAD_GAME, (session_id,))
+    game = await cursor.fetchone()
+    if not game:
+        return None
+    game_data = load_game_data(responses.sanitize_database_output(game[0]))
+    start_time = game[1] if game_data['timer_started'] else -1
+    return game_data, start_time, game[2]
+
+async def add_statistics(cursor, user_id, tiles_clicked, played=0, won=0, miliseconds_played=0):
+    """Add to the user's statistics"""
+    values = {
+        'user_id': user_id,
+        'tiles_clicked': tiles_clicked,
+        'played': played,
+        'won': won,
+        'miliseconds_played': miliseconds_played
+    }
+    await cursor.execute(queries.ADD_STATISTICS, values)
+
+async def save_click(cursor, user_id, session_id, game_data, version, statistics=None, delete_game=False,
+                     rewards=None, battlepass_xp=None):
+    """Run queries.save_click(). Raises GameConflict when the game (or the
+    battlepass xp the rewards were based on) changed since it was read.
+    Returns (xp, bp_xp, coins, start_time, version)"""
+    await cursor.execute(*queries.save_click(
+        session_id, user_id, game_data, version, statistics, delete_game, rewards, battlepass_xp
+    ))
+    row = await cursor.fetchone()
+    if row is None:
+        raise queries.GameConflict
+    return row
+
+async def play_click(cursor, user_id, session_id, game_data, start_time, version, tile_id,
+                     tiles_clicked=1, save_statistics=True, user=None):
+    """Apply one click and persist its effects, shared by /click_tile and
+    the WebSocket channel. tiles_clicked are the clicks not yet counted in
+    the user's statistics; with save_statistics=False they are only written
+    when the game ends. user is (owns_battlepass, bp_xp) if already read,
+    otherwise it is read when the game is won. Raises GameConflict when the
+    game changed since version was read, the click should then be replayed
+    on the stored game.
+    Returns (status, payload, stored start time, stored version)"""
+    if game_data.get('tiles') is None and get_tile_index(game_data, tile_id) is not None:
+        # No-guess generation can take up to its time budget, keep it off the event loop
+        await asyncio.to_thread(materialize_board, game_data, tile_id)
+    outcome = apply_click(game_data, tile_id)
+    timer_started = game_data['timer_started']
+    game_data['timer_started'] = True
+
+    if outcome in responses.CLICK_FAILURES:
+        stored_start, stored_version = start_time, version
+        if not timer_started:
+            stored_start, stored_version = (await save_click(cursor, user_id, session_id, game_data, version))[3:]
+        body, status = responses.click_failure(outcome, game_data)
+        return status, body, stored_start, stored_version
+
+    record_click(game_data, tile_id)
+    if outcome in ('loss', 'win'):
+        won = outcome == 'win'
+        miliseconds_played = responses.miliseconds_played(start_time)
+        statistics = {
+            'tiles_clicked': tiles_clicked,
+            'played': 1,
+            'won': int(won),
+            'miliseconds_played': miliseconds_played
+        }
+
+        if not won:
+            await save_click(cursor, user_id, session_id, game_data, version, statistics, delete_game=True)
+            results.record(user_id, game_data, False, miliseconds_played)
+            return 200, responses.click_loss(game_data, miliseconds_played), None, None
+
+        if user is None:
+            await cursor.execute(queries.USER_BATTLEPASS, (user_id,))
+            user = await cursor.fetchone()
+            if not user:
+                return 500, {"error": "unknown db error"}, start_time, version
+
+        # XP, coins, battlepass items and statistics in the same statement as the game delete.
+        # Tier rewards depend on the bp_xp read, so they only apply if it hasn't moved since
+        rewards = win_rewards(game_data, *user)
+        row = await save_click(
+            cursor, user_id, session_id, game_data, version, statistics, delete_game=True,
+            rewards=rewards, battlepass_xp=user[1]
+        )
+        results.record(user_id, game_data, True, miliseconds_played)
+        return 200, responses.click_win(game_data, row[:3], rewards, miliseconds_played), None, None
+
+    statistics = None
+    if save_statistics:
+        statistics = {'tiles_clicked': tiles_clicked, 'played': 0, 'won': 0, 'miliseconds_played': 0}
+    stored_start, stored_version = (await save_click(cursor, user_id, session_id, game_data, version, statistics))[3:]
+    return 200, responses.click_playing(game_data, start_time), stored_start, stored_version
+
+@app.route('/click_tile', methods=['POST'])
+async def click_tile():
+    data = await get_request_data()
+    session_id = data['session_id']
+    tile_id = data['tile_id']
+    logger.debug("tile clicked", extra={"tile_id": tile_id, "sample": True})
+
+    # Double clicks land here: the loser replays against the winner's board
+    for attempt in range(queries.CLICK_RETRIES + 1):
+        try:
+            async with pool.connection() as conn:
+                cursor = conn.cursor()
+                # Read without locks, the click is then saved with one statement,
+                # only if the game is still at this version
+                values = session_tokens.session_params(session_id)
+                await cursor.execute(queries.CLICK_GAME, values)
+                session = await cursor.fetchone()
+                if not session:
+                    return wrong_session()
+
+                user_id, owns_battlepass, battlepass_xp, game_raw, stored_start, version = session
+                if game_raw is None:
+                    return respond(responses.fail("game not found")), 404
+
+                game_data = load_game_data(responses.sanitize_database_output(game_raw))
+                start_time = stored_start if game_data['timer_started'] else -1
+                # Games are keyed by the session id, or a token's own id
+                status, result, _, _ = await play_click(
+                    cursor, user_id, values['session_id'], game_data, start_time, version, tile_id,
+                    user=(owns_battlepass, battlepass_xp)
+                )
+            if result.get('type') == 'win':
+                reads.invalidate(session_id)
+            return respond(result), status
+        except queries.GameConflict:
+            metrics.click_conflicts.inc('retried' if attempt < queries.CLICK_RETRIES else 'failed')
+    return respond(responses.fail("concurrent update")), 409
+
+@app.websocket('/game')
+async def game_channel():
+    """Persistent channel for one game.
+
+    The first message authenticates: {"session_id": ...}, answered with
+    {"type": "ready", "board": ...} for the game made by /create_game.
+    Every following {"tile_id": ...} is answered with the same payload
+    /click_tile would return. The channel closes when the game ends.
+    Binary frames are read and answered as MessagePack, text frames as JSON.
+    """
+    binary = False
+
+    async def receive():
+        nonlocal binary
+        message = await websocket.receive()
+        binary = isinstance(message, bytes)
+        if binary and 'application/msgpack' in serializers:
+            return serializers['application/msgpack'].loads(message)
+        return json.loads(message)
+
+    async def send(data):
+        if binary and 'application/msgpack' in serializers:
+            await websocket.send(serializers['application/msgpack'].dumps(data))
+        else:
+            await websocket.send(json.dumps(data))
+
+    try:
+        session_id = (await receive()).get('session_id')
+    except (ValueError, AttributeError):
+        session_id = None
+
+    user_id = game = None
+    if session_id:
+        # Games are keyed by the session id, or a token's own id
+        game_id = session_tokens.session_params(session_id)['session_id']
+        try:
+            async with pool.connection() as conn:
+                cursor = conn.cursor()
+                user_id = await get_session_user(cursor, session_id)
+                game = await load_game(cursor, game_id) if user_id else None
+        except psycopg.DataError:
+            pass # not a valid session id
+
+    if not user_id:
+        await send(responses.wrong_session()[0])
+        await websocket.close(1008)
+        return
+    if not game:
+        await send(responses.fail("game not found"))
+        await websocket.close(1000)
+        return
+
+    # The board stays in memory, each click only writes the game row back
+    ip = rate_limit.client_ip(websocket.remote_addr, websocket.headers)
+    game_data, start_time, version = game
+    await send({"type": "ready", "board": sanitize_game_data(game_data)})
+
+    tiles_clicked = 0
+    finished = False
+    try:
+        while not finished:
+            try:
+                tile_id = str((await receive())['tile_id'])
+            except (ValueError, KeyError, TypeError):
+                await send(responses.fail("invalid message"))
+                continue
+            logger.debug("tile clicked", extra={"tile_id": tile_id, "sample": True})
+            # Clicks share the session and IP buckets with /click_tile
+            retry_after = rate_limit.throttle('/game', session_id, ip)
+            if retry_after is not None:
+                await send({"type": "fail", "reason": "rate limited", "retry_after": retry_after})
+                continue
+
+            # Same click counting as /click_tile, but flushed once per game
+            counted = tiles_clicked + 1
+            for attempt in range(queries.CLICK_RETRIES + 1):
+                try:
+                    async with pool.connection() as conn:
+                        cursor = conn.cursor()
+                        if game is None:
+                            # Changed elsewhere (another tab), continue from the stored game
+                            game = await load_game(cursor, game_id)
+                            if game is None:
+                                status, result = 404, responses.fail("game not found")
+                                stored_start = stored_version = None
+                                break
+                            game_data, start_time, version = game
+                        status, result, stored_start, stored_version = await play_click(
+                            cursor, user_id, game_id, game_data, start_time, version, tile_id,
+                            tiles_clicked=counted, save_statistics=False
+                        )
+                    break
+                except queries.GameConflict:
+                    metrics.click_conflicts.inc('retried' if attempt < queries.CLICK_RETRIES else 'failed')
+                    game = None
+            else:
+                status, result = 409, responses.fail("concurrent update")
+                stored_start = stored_version = None
+            if result.get('type') == 'win':
+                reads.invalidate(session_id)
+            if stored_start is not None:
+                start_time = stored_start
+            if stored_version is not None:
+                version = stored_version
+
+            if status == 200:
+                tiles_clicked = counted
+            finished = result.get('type') in ('win', 'loss') or status == 500
+            await send(result)
+            if status == 404:
+                break # deleted by a click elsewhere, its uncounted clicks still get flushed
+    finally:
+        if not finished and tiles_clicked:
+            # A task, so a cancelled (disconnected) handler still gets its clicks counted
+            task = asyncio.create_task(flush_clicks(user_id, tiles_clicked))
+            click_flushes.add(task)
+            task.add_done_callback(click_flushes.discard)
+
+    await websocket.close(1000)
+
+async def flush_clicks(user_id, tiles_clicked):
+    """Count clicks of a channel that closed before its game ended"""
+    try:
+        async with pool.connection() as conn:
+            await add_statistics(conn.cursor(), user_id, tiles_clicked)
+    except Exception:
+        logger.exception("flushing game channel clicks failed",
+                         extra={"user_id": user_id, "tiles_clicked": tiles_clicked})
+
+@app.route('/create_game', methods=['POST'])
+async def create_game():
+    data = await get_request_data()
+    session_id = data['session_id']
+    game_data = responses.new_game(data)
+
+    if not session_id or game_data is None:
+        return respond(responses.fail("missing parameters")), 400
+    booster_used = game_data['booster_active']
+
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+        values = {
+            **session_tokens.session_params(session_id),
+            'booster_used': booster_used,
+            'data': dump_game_data(game_data)
+        }
+        await cursor.execute(queries.CREATE_GAME, values)
+        session_found, game_created = await cursor.fetchone()
+    if booster_used:
+        reads.invalidate(session_id)
+
+    if not session_found:
+        return wrong_session()
+    if not game_created:
+        return respond(responses.fail("insufficient amount of boosters")), 401
+    return respond({"type": "success"}), 200
@@ -0,0 +1,198 @@
+"""Micro-benchmarks for the game engine functions in game.py
+
+Runs fully offline (no database needed):
+    python benchmarks/bench_game.py --output results.json
+
+Compare against a stored baseline, failing on regressions above 20%:
+    python benchmarks/bench_game.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_game.py --compare benchmarks/baseline.json --threshold 0.2
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+from math import ceil
+from statistics import median
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from game import (  # noqa: E402
+    calculate_xp,
+    count_hidden_tiles,
+    cached_board,
+    create_game_board,
+    difficulty_list,
+    dump_game_data,
+    get_battlepass_lvl,
+    PreparedBoard,
+    load_game_data,
+    materialize_board,
+    sanitize_game_data,
+    seeded_mines,
+    uncover_all_tiles,
+    uncover_tiles,
+)
+
+BOARD_SIZES = [9, 16, 30, 50, 100, 200]
+SEED = 1234
+
+
+def make_game_data(size_x, size_y, mine_count):
+    """Build game data the same way /create_game and the first /click_tile do"""
+    game_data = {
+        'size_x': size_x,
+        'size_y': size_y,
+        'mine_count': mine_count,
+        'timer_started': False,
+        'booster_active': False
+    }
+    return materialize_board(game_data, str(size_x * size_y // 2))
+
+
+def clear_board_caches():
+    cached_board.cache_clear()
+    seeded_mines.cache_clear()
+
+
+def copy_tiles(tiles):
+    return {id: dict(tile) for id, tile in tiles.items()}
+
+
+def measure(func, repeat, prepare=None):
+    """Return per-call timings in seconds, excluding the prepare step"""
+    timings = []
+    for _ in range(repeat):
+        args = prepare() if prepare else ()
+        start = perf_counter()
+        func(*args)
+        timings.append(perf_counter() - start)
+    return timings
+
+
+def board_cases(sizes):
+    for size in sizes:
+        for difficulty, density in difficulty_list.items():
+            yield size, difficulty, ceil(density * size * size)
+
+
+def run_benchmarks(sizes, repeat):
+    results = {}
+
+    def record(name, timings):
+        results[name] = {
+            'median': median(timings),
+            'min': min(timings),
+            'max': max(timings),
+            'repeat': len(timings)
+        }
+
+    for size, difficulty, mine_count in board_cases(sizes):
+        suffix = f"[{size}x{size},d{difficulty}]"
+        random.seed(SEED)
+
+        record(
+            f"create_game_board{suffix}",
+            measure(create_game_board, repeat, lambda: (size, size, mine_count))
+        )
+
+        # Opening a pooled board only moves the mines around the first click
+        prepared = [PreparedBoard(size, size, mine_count) for _ in range(repeat)]
+        record(
+            f"PreparedBoard.open_at{suffix}",
+            measure(lambda board: board.open_at(size * size // 2), repeat, lambda: (prepared.pop(),))
+        )
+
+        game_data = make_game_data(size, size, mine_count)
+        tiles = game_data['tiles']
+
+        record(f"count_hidden_tiles{suffix}", measure(count_hidden_tiles, repeat, lambda: (tiles,)))
+        record(f"sanitize_game_data{suffix}", measure(sanitize_game_data, repeat, lambda: (game_data,)))
+        record(f"uncover_all_tiles{suffix}", measure(uncover_all_tiles, repeat, lambda: (game_data,)))
+
+        stored = dump_game_data(game_data)
+        record(f"dump_game_data{suffix}", measure(dump_game_data, repeat, lambda: (game_data,)))
+        record(f"load_game_data{suffix}", measure(load_game_data, repeat, lambda: (stored,)))
+        record(
+            f"load_game_data_uncached{suffix}",
+            measure(load_game_data, repeat, lambda: (clear_board_caches(), stored)[1:])
+        )
+
+        # uncover_tiles mutates the board, so every run gets a fresh copy
+        zero_id = next((id for id, tile in tiles.items() if tile['value'] == 0), None)
+        if zero_id is not None:
+            record(
+                f"uncover_tiles{suffix}",
+                measure(uncover_tiles, repeat, lambda: (copy_tiles(tiles), size, size, zero_id))
+            )
+
+    # The reward helpers are tiny, so time a whole sweep per run
+    def xp_sweep():
+        for size, _, mine_count in board_cases(BOARD_SIZES):
+            calculate_xp(mine_count, size * size)
+
+    def battlepass_sweep():
+        for battlepass_xp in range(0, 50000, 250):
+            get_battlepass_lvl(battlepass_xp)
+
+    record("calculate_xp[sweep]", measure(xp_sweep, repeat))
+    record("get_battlepass_lvl[sweep]", measure(battlepass_sweep, repeat))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return the list of benchmarks slower than baseline by more than threshold"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['median']
+        new = result['median']
+        if old > 0 and (new - old) / old > threshold:
+            regressions.append((name, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=BOARD_SIZES,
+                        help="square board sizes to sweep")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="timed runs per benchmark")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--save-baseline', help="write results as the new baseline")
+    parser.add_argument('--compare', help="baseline JSON file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed slowdown vs baseline, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeat)
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results
+    }
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+    if not args.output:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, old, new in regressions:
+            print(f"REGRESSION {name}: {old*1000:.3f}ms -> {new*1000:.3f}ms", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions above {args.threshold:.0%}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
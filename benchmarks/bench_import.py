@@ -0,0 +1,120 @@
+"""Import time budget benchmark for the API entrypoints
+
+Imports each module in a fresh interpreter without DB_PASSWORD or DB_HOST
+set, so a module that touches the database at import fails instead of
+timing the connection. Flask and Quart with psycopg are measured alongside
+as the floors each entrypoint can't go below:
+    python benchmarks/bench_import.py --output results.json
+
+Fails when any import fails or its slowest run exceeds its budget. index.py
+is the serverless entrypoint, where the import is paid on every cold start.
+asgi.py runs as a long-lived server and gets its own, larger budget, as
+Quart and psycopg alone take most of the serverless one:
+    python benchmarks/bench_import.py --budget-ms 400 --asgi-budget-ms 600
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from statistics import median
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ['flask', 'index', 'quart, psycopg', 'asgi']
+BUDGET_MS = 400
+ASGI_BUDGET_MS = 600
+# Checked against --asgi-budget-ms, everything else against --budget-ms
+ASGI_MODULES = {'quart, psycopg', 'asgi'}
+
+# Prints the seconds `import <module>` took, the interpreter's own startup excluded
+TIMER = "from time import perf_counter; start = perf_counter(); import {module}; print(perf_counter() - start)"
+
+
+def import_once(module):
+    """Seconds one import took, or the error it failed with"""
+    env = {name: value for name, value in os.environ.items() if name not in ('DB_PASSWORD', 'DB_HOST')}
+    # The background warm-up would need the database too
+    env['DB_WARM_UP'] = '0'
+    process = subprocess.run(
+        [sys.executable, '-c', TIMER.format(module=module)],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        return None, process.stderr.strip().splitlines()[-1]
+    return float(process.stdout.strip().splitlines()[-1]), None
+
+
+def run_benchmarks(modules, repeat):
+    results = {}
+    for module in modules:
+        timings = []
+        for _ in range(repeat):
+            seconds, error = import_once(module)
+            if error is not None:
+                results[f"import[{module}]"] = {'error': error}
+                break
+            timings.append(seconds)
+        else:
+            results[f"import[{module}]"] = {
+                'median': median(timings),
+                'min': min(timings),
+                'max': max(timings),
+                'repeat': repeat
+            }
+    return results
+
+
+def over_budget(results, budgets):
+    """Return the imports that failed or whose slowest run exceeded their budget"""
+    slow = []
+    for name, result in results.items():
+        budget_ms = budgets[name]
+        if 'error' in result or result['max'] > budget_ms / 1000:
+            slow.append((name, result.get('error') or f"{result['max']*1000:.1f}ms > {budget_ms}ms"))
+    return slow
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modules', nargs='+', default=MODULES,
+                        help="modules to import")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="fresh interpreters per module")
+    parser.add_argument('--budget-ms', type=int, default=BUDGET_MS,
+                        help="import budget per module")
+    parser.add_argument('--asgi-budget-ms', type=int, default=ASGI_BUDGET_MS,
+                        help="import budget of asgi and its floor")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.modules, args.repeat)
+    budgets = {
+        f"import[{module}]": args.asgi_budget_ms if module in ASGI_MODULES else args.budget_ms
+        for module in args.modules
+    }
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'budgets_ms': budgets,
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    slow = over_budget(results, budgets)
+    for name, reason in slow:
+        print(f"OVER BUDGET {name}: {reason}", file=sys.stderr)
+    if slow:
+        sys.exit(1)
+    print("all imports within budget", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Time budget benchmark for no-guess board generation in game.py
+
+Sweeps every difficulty in difficulty_list over the board sizes, reporting
+how long find_no_guess_seed takes and how often it found a board that
+needs no guessing (the rest fall back to a plain board). Runs offline:
+    python benchmarks/bench_no_guess.py --output results.json
+
+Fails when any run overshoots the budget by more than the tolerance:
+    python benchmarks/bench_no_guess.py --budget-ms 200 --tolerance 0.1
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+from math import ceil
+from statistics import median
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from game import NO_GUESS_BUDGET_MS, difficulty_list, find_no_guess_seed  # noqa: E402
+
+BOARD_SIZES = [9, 16, 30, 50, 100, 200]
+SEED = 1234
+
+
+def run_benchmarks(sizes, repeat, budget_ms):
+    results = {}
+    for size in sizes:
+        for difficulty, density in difficulty_list.items():
+            mine_count = ceil(density * size * size)
+            random.seed(SEED)
+
+            timings = []
+            found = 0
+            for _ in range(repeat):
+                # Players usually open near the middle of the board
+                start = perf_counter()
+                seed = find_no_guess_seed(size, size, mine_count, size * size // 2, budget_ms)
+                timings.append(perf_counter() - start)
+                found += seed is not None
+
+            results[f"find_no_guess_seed[{size}x{size},d{difficulty}]"] = {
+                'median': median(timings),
+                'min': min(timings),
+                'max': max(timings),
+                'repeat': repeat,
+                'no_guess_rate': found / repeat
+            }
+    return results
+
+
+def over_budget(results, budget_ms, tolerance):
+    """Return the benchmarks whose slowest run exceeded the budget plus tolerance"""
+    limit = budget_ms / 1000 * (1 + tolerance)
+    return [(name, result['max']) for name, result in results.items() if result['max'] > limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=BOARD_SIZES,
+                        help="square board sizes to sweep")
+    parser.add_argument('--repeat', type=int, default=10,
+                        help="boards generated per benchmark")
+    parser.add_argument('--budget-ms', type=int, default=NO_GUESS_BUDGET_MS,
+                        help="generation budget, defaults to NO_GUESS_BUDGET_MS")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="allowed overshoot of the budget, 0.1 = 10%%")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeat, args.budget_ms)
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'budget_ms': args.budget_ms,
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    slow = over_budget(results, args.budget_ms, args.tolerance)
+    for name, slowest in slow:
+        print(f"OVER BUDGET {name}: {slowest*1000:.1f}ms > {args.budget_ms}ms", file=sys.stderr)
+    if slow:
+        sys.exit(1)
+    print(f"all runs within {args.budget_ms}ms (+{args.tolerance:.0%})", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Boards prepared ahead of time for the most played game configurations,
+so the first click of a game doesn't pay for generating its board"""
+import os
+from collections import deque
+from math import ceil
+from threading import Event, Lock, Thread
+
+import game
+import metrics
+from logs import logger
+
+POOL_SIZE = int(os.environ.get('BOARD_POOL_SIZE', 4))
+MAX_CONFIGS = int(os.environ.get('BOARD_POOL_MAX_CONFIGS', 8))
+# Configurations requested this many times (in the current window) are added to the pool
+ADOPT_AFTER = int(os.environ.get('BOARD_POOL_ADOPT_AFTER', 3))
+# Larger configurations are always generated inline, a few pooled boards of any size a
+# client asks for would otherwise cost the refill thread's CPU and memory for good
+MAX_TILES = int(os.environ.get('BOARD_POOL_MAX_TILES', 2500))
+# Request counts are halved every this many first clicks, so popularity follows recent traffic
+WINDOW = int(os.environ.get('BOARD_POOL_WINDOW', 1000))
+
+pool_requests = metrics.Counter(
+    'sapper_board_pool_requests_total',
+    "First clicks served from the board pool (hit) or generated inline (miss)",
+    ('config', 'result'))
+metrics.registry.append(pool_requests)
+
+
+def parse_configs(value):
+    """Parse "9x9:1,16x16:2" (size_x x size_y : difficulty) into (size_x, size_y, mine_count)"""
+    configs = []
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        size, difficulty = item.strip().split(':')
+        size_x, size_y = (int(side) for side in size.split('x'))
+        configs.append((size_x, size_y, ceil(game.difficulty_list[difficulty] * size_x * size_y)))
+    return configs
+
+
+class BoardPool:
+    """A queue of prepared boards per configuration, refilled by a background thread"""
+
+    def __init__(self, size, configs=(), max_configs=MAX_CONFIGS, adopt_after=ADOPT_AFTER,
+                 max_tiles=MAX_TILES, window=WINDOW):
+        self.size = size
+        self.max_configs = max_configs
+        self.adopt_after = adopt_after
+        self.max_tiles = max_tiles
+        self.window = window
+        self.boards = {config: deque() for config in configs}
+        # Configured from BOARD_POOL_CONFIGS, never replaced
+        self.pinned = set(self.boards)
+        # First clicks per configuration, pooled or not, decayed every window
+        self.requests = {}
+        self.taken = 0
+        self.lock = Lock()
+        self.wanted = Event()
+        self.thread = None
+
+    def take(self, size_x, size_y, mine_count):
+        """A PreparedBoard for the configuration, or None to generate one inline"""
+        config = (size_x, size_y, mine_count)
+        self.count(config)
+        boards = self.boards.get(config)
+        board = None
+        if boards is not None:
+            try:
+                board = boards.popleft()
+            except IndexError:
+                pass
+            self.wanted.set()
+        else:
+            self.note_miss(config)
+
+        label = f"{size_x}x{size_y}:{mine_count}" if boards is not None else 'other'
+        pool_requests.inc(label, 'hit' if board is not None else 'miss')
+        return board
+
+    def count(self, config):
+        with self.lock:
+            self.requests[config] = self.requests.get(config, 0) + 1
+            self.taken += 1
+            if self.taken < self.window and len(self.requests) <= 1000:
+                return
+            # Unpopular configurations fade out instead of growing this forever
+            self.taken = 0
+            self.requests = {
+                counted: requests // 2 for counted, requests in self.requests.items() if requests > 1
+            }
+
+    def note_miss(self, config):
+        """Adopt a configuration requested adopt_after times, in place of the least
+        requested adopted one when the pool is full and that one is requested less"""
+        size_x, size_y, _mine_count = config
+        if size_x * size_y > self.max_tiles:
+            return
+        with self.lock:
+            requests = self.requests.get(config, 0)
+            if requests < self.adopt_after or config in self.boards:
+                return
+            replaced = None
+            if len(self.boards) >= self.max_configs:
+                adopted = [pooled for pooled in self.boards if pooled not in self.pinned]
+                if not adopted:
+                    return
+                replaced = min(adopted, key=lambda pooled: self.requests.get(pooled, 0))
+                if self.requests.get(replaced, 0) >= requests:
+                    return
+                del self.boards[replaced]
+            self.boards[config] = deque()
+        logger.info("board pool adopted configuration", extra={"config": config, "replaced": replaced})
+        self.wanted.set()
+
+    def refill(self):
+        for config, boards in list(self.boards.items()):
+            while len(boards) < self.size:
+                boards.append(game.PreparedBoard(*config))
+
+    def run(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            try:
+                self.refill()
+            except Exception:
+                logger.exception("board pool refill failed")
+
+    def start(self):
+        """Start the refill thread and serve first clicks from the pool"""
+        if self.size < 1:
+            return
+        if self.thread is None:
+            self.thread = Thread(target=self.run, name='board-pool', daemon=True)
+            self.thread.start()
+        game.board_source = self.take
+        self.wanted.set()
+
+
+pool = BoardPool(POOL_SIZE, parse_configs(os.environ.get('BOARD_POOL_CONFIGS', '')))
+
+
+def start():
+    pool.start()
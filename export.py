@@ -0,0 +1,67 @@
+"""Admin bulk export of users, statistics and game results. Rows are read
+through a named (server-side) cursor BATCH_SIZE at a time and sent as they
+arrive, so a worker holds one batch in memory however large the table is"""
+import csv
+import io
+import json
+import os
+
+import metrics
+
+# Rows per FETCH from the server-side cursor, and per chunk of the response
+BATCH_SIZE = int(os.environ.get('EXPORT_BATCH', 1000))
+
+# name: (columns, query). Ordered by primary key so the scan follows the index
+# instead of sorting the table. Password hashes and salts are never exported,
+# finished_at is unix time like in /game_history
+TABLES = {
+    'users': (
+        ('uuid', 'username', 'xp', 'bp_xp', 'coins', 'gems', 'avatar', 'owns_battlepass', 'booster_count'),
+        "SELECT uuid, username, xp, bp_xp, coins, gems, avatar, owns_battlepass, booster_count \
+         FROM users ORDER BY uuid"
+    ),
+    'statistics': (
+        ('uuid', 'tiles_clicked', 'games_played', 'games_won', 'miliseconds_played'),
+        "SELECT uuid, (stats->>'tiles_clicked')::bigint, (stats->>'games_played')::bigint, \
+         (stats->>'games_won')::bigint, (stats->>'miliseconds_played')::bigint \
+         FROM users CROSS JOIN LATERAL (SELECT btrim(statistics, ':tex')::jsonb AS stats) stored ORDER BY uuid"
+    ),
+    'game_results': (
+        ('result_id', 'user_id', 'finished_at', 'size_x', 'size_y', 'mine_count', 'no_guess', 'won',
+         'miliseconds_played', 'tiles_revealed', 'seed', 'safe_tile', 'clicks'),
+        "SELECT result_id, user_id, extract(epoch from finished_at)::bigint, size_x, size_y, mine_count, \
+         no_guess, won, miliseconds_played, tiles_revealed, seed, safe_tile, encode(clicks, 'hex') \
+         FROM game_results ORDER BY result_id"
+    )
+}
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+exported_rows = metrics.Counter(
+    'sapper_export_rows_total',
+    "Rows sent by /admin/export",
+    ('table',))
+metrics.registry.append(exported_rows)
+
+
+def header(columns, output_format):
+    """First chunk of the export, the column names for CSV"""
+    if output_format == 'csv':
+        return format_rows(columns, [columns], output_format)
+    return ''
+
+
+def format_rows(columns, rows, output_format):
+    """One chunk of the export: a CSV line or a JSON object per row"""
+    if output_format == 'csv':
+        out = io.StringIO()
+        csv.writer(out).writerows(rows)
+        return out.getvalue()
+    return ''.join(
+        json.dumps(dict(zip(columns, row)), separators=(',', ':'), default=str) + '\n'
+        for row in rows
+    )
+
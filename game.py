@@ -0,0 +1,504 @@
+import base64
+import json
+import os
+import random
+from functools import lru_cache
+from time import perf_counter, time
+
+import solver
+
+battlepass_rewards = {
+    "1": {"type": "booster", "count": 1},
+    "2": {"type": "booster", "count": 1},
+    "3": {"type": "avatar", "id": 3},
+    "4": {"type": "booster", "count": 2},
+    "5": {"type": "gems", "count": 100},
+    "6": {"type": "booster", "count": 1},
+    "7": {"type": "booster", "count": 3},
+    "8": {"type": "gems", "count": 50},
+    "9": {"type": "booster", "count": 1},
+    "10": {"type": "skin", "id": 1},
+    "11": {"type": "gems", "count": 100},
+    "12": {"type": "booster", "count": 1},
+    "13": {"type": "booster", "count": 2},
+    "14": {"type": "avatar", "id": 2},
+    "15": {"type": "gems", "count": 100},
+    "16": {"type": "booster", "count": 2},
+    "17": {"type": "gems", "count": 50},
+    "18": {"type": "booster", "count": 1},
+    "19": {"type": "booster", "count": 1},
+    "20": {"type": "skin", "id": 4},
+    "21": {"type": "gems", "count": 100},
+    "22": {"type": "booster", "count": 2},
+    "23": {"type": "booster", "count": 1},
+    "24": {"type": "avatar", "id": 5},
+    "25": {"type": "gems", "count": 100},
+    "26": {"type": "booster", "count": 3},
+    "27": {"type": "booster", "count": 1},
+    "28": {"type": "gems", "count": 50},
+    "29": {"type": "booster", "count": 1},
+    "30": {"type": "skin", "id": 8},
+    "31": {"type": "gems", "count": 100},
+    "32": {"type": "booster", "count": 3},
+    "33": {"type": "booster", "count": 2},
+    "34": {"type": "avatar", "id": 8},
+    "35": {"type": "gems", "count": 100},
+    "36": {"type": "booster", "count": 3},
+    "37": {"type": "gems", "count": 50},
+    "38": {"type": "booster", "count": 1},
+    "39": {"type": "gems", "count": 100},
+    "40": {"type": "avatar", "id": 9},
+}
+
+difficulty_list = {
+    '1': 0.1,
+    '2': 0.15,
+    '3': 0.2,
+    '4': 0.35
+}
+
+
+def get_neighbors(tile_id, size_x, size_y):
+    """Ids of tile_id and all tiles touching it"""
+    x, y = tile_id % size_x, tile_id // size_x
+    return [
+        nx + ny*size_x
+        for nx in range(max(x-1, 0), min(x+2, size_x))
+        for ny in range(max(y-1, 0), min(y+2, size_y))
+    ]
+
+def safe_zone(size_x, size_y, mine_count, safe_tile):
+    """The first clicked tile and its neighbours, or just the tile
+    (or nothing) on boards too dense to keep them all free of mines"""
+    size = size_x * size_y
+    safe_tiles = set(get_neighbors(safe_tile, size_x, size_y))
+    if mine_count > size - len(safe_tiles):
+        safe_tiles = {safe_tile} if mine_count < size else set()
+    return safe_tiles
+
+# Stored games and game_results rebuild boards from their seed, so mines are drawn from
+# rng.random() alone: Python only keeps random() reproducible for a seed across versions,
+# not sample() or randrange()
+def random_index(rng, count):
+    """Uniform integer in [0, count) drawn with one rng.random()"""
+    return min(int(rng.random() * count), count - 1)
+
+def random_tiles(rng, size, count):
+    """count distinct tile ids out of size, a partial Fisher-Yates shuffle"""
+    tiles = list(range(size))
+    for i in range(count):
+        j = i + random_index(rng, size - i)
+        tiles[i], tiles[j] = tiles[j], tiles[i]
+    return tiles[:count]
+
+def relocate_mines(mines, size_x, size_y, safe_tile, rng=random):
+    """Move the mines inside the first click's safe zone to random free tiles,
+    updating mines in place. Returns the tiles that changed"""
+    safe_tiles = safe_zone(size_x, size_y, len(mines), safe_tile)
+    moved = []
+    for mine in sorted(mines & safe_tiles):
+        while True:
+            target = random_index(rng, size_x * size_y)
+            if target not in mines and target not in safe_tiles:
+                break
+        mines.remove(mine)
+        mines.add(target)
+        moved.extend((mine, target))
+    return moved
+
+def place_mines(size_x, size_y, mine_count, safe_tile=None, rng=random):
+    """Sorted ids of randomly placed mines"""
+    mines = set(random_tiles(rng, size_x * size_y, mine_count))
+    # Keep the first clicked tile (and its neighbours, if they fit) free of mines
+    if safe_tile is not None:
+        relocate_mines(mines, size_x, size_y, safe_tile, rng)
+    return tuple(sorted(mines))
+
+def count_neighbors(size_x, size_y, mines):
+    """Board values (0-8, 9 for mines) for the given mine ids"""
+    board = [0] * size_x * size_y
+    for mine in mines:
+        board[mine] = 9
+
+    # Update the counts around each mine
+    for mine in mines:
+        for neighbor in get_neighbors(mine, size_x, size_y):
+            if board[neighbor] != 9:
+                board[neighbor] += 1
+    return board
+
+# Stored games only keep their mines, the values are rebuilt on every load
+BOARD_CACHE_SIZE = int(os.environ.get('BOARD_CACHE_SIZE', 256))
+
+@lru_cache(maxsize=BOARD_CACHE_SIZE)
+def cached_board(size_x, size_y, mines):
+    return tuple(count_neighbors(size_x, size_y, mines))
+
+@lru_cache(maxsize=BOARD_CACHE_SIZE)
+def seeded_mines(size_x, size_y, mine_count, seed, safe_tile):
+    return place_mines(size_x, size_y, mine_count, safe_tile, rng=random.Random(seed))
+
+def create_game_board(size_x, size_y, mine_count, safe_tile=None, rng=random):
+    return count_neighbors(size_x, size_y, place_mines(size_x, size_y, mine_count, safe_tile, rng))
+
+class PreparedBoard:
+    """A seeded board whose mines and counts are computed before the first click
+    is known (see board_pool), opening it only relocates the few mines in the
+    safe zone. Gives the same board as seeded_mines for the same seed"""
+    __slots__ = ('size_x', 'size_y', 'seed', 'rng', 'mines', 'board')
+
+    def __init__(self, size_x, size_y, mine_count, seed=None):
+        self.size_x = size_x
+        self.size_y = size_y
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.mines = set(random_tiles(self.rng, size_x * size_y, mine_count))
+        self.board = count_neighbors(size_x, size_y, self.mines)
+
+    def open_at(self, safe_tile):
+        """Board values with safe_tile kept free of mines"""
+        moved = relocate_mines(self.mines, self.size_x, self.size_y, safe_tile, self.rng)
+        touched = {
+            neighbor
+            for tile in moved
+            for neighbor in get_neighbors(tile, self.size_x, self.size_y)
+        }
+        for tile in touched:
+            if tile in self.mines:
+                self.board[tile] = 9
+            else:
+                self.board[tile] = sum(
+                    1 for neighbor in get_neighbors(tile, self.size_x, self.size_y)
+                    if neighbor in self.mines
+                )
+        return self.board
+
+# Hook returning a PreparedBoard for (size_x, size_y, mine_count) or None, set by board_pool
+board_source = None
+
+def get_tile_index(game_data, tile_id):
+    """Board index of tile_id, or None if it is not on the board"""
+    try:
+        index = int(tile_id)
+    except (TypeError, ValueError):
+        return None
+    if str(index) != str(tile_id) or not 0 <= index < game_data['size_x'] * game_data['size_y']:
+        return None
+    return index
+
+# Time allowed to search for a board that needs no guessing before falling back to a random one
+NO_GUESS_BUDGET_MS = int(os.environ.get('NO_GUESS_BUDGET_MS', 200))
+
+def find_no_guess_seed(size_x, size_y, mine_count, safe_tile, budget_ms=NO_GUESS_BUDGET_MS):
+    """Seed of a board that can be cleared from safe_tile without guessing,
+    or None if none was found within budget_ms"""
+    deadline = perf_counter() + budget_ms / 1000
+    try:
+        while True:
+            start = perf_counter()
+            seed = random.getrandbits(32)
+            mines = place_mines(size_x, size_y, mine_count, safe_tile, rng=random.Random(seed))
+            board = count_neighbors(size_x, size_y, mines)
+            if solver.is_solvable(size_x, size_y, board, safe_tile, deadline):
+                return seed
+            # Don't start an attempt that cannot finish in time
+            if perf_counter() + (perf_counter() - start) > deadline:
+                return None
+    except solver.SolverTimeout:
+        return None
+
+def materialize_board(game_data, first_tile_id):
+    """Boards are generated on the first click instead of in /create_game,
+    so the clicked tile can be guaranteed to be safe.
+    Only the seed is stored, the values are rebuilt from it by load_game_data"""
+    safe_tile = get_tile_index(game_data, first_tile_id)
+    seed = board = None
+    if game_data.get('no_guess'):
+        seed = find_no_guess_seed(game_data['size_x'], game_data['size_y'], game_data['mine_count'], safe_tile)
+        # Keep the game playable with a plain board when the budget ran out
+        game_data['no_guess'] = seed is not None
+    elif board_source is not None:
+        prepared = board_source(game_data['size_x'], game_data['size_y'], game_data['mine_count'])
+        if prepared is not None:
+            seed = prepared.seed
+            board = prepared.open_at(safe_tile)
+
+    game_data['seed'] = seed if seed is not None else random.getrandbits(32)
+    game_data['safe_tile'] = safe_tile
+    if board is None:
+        mines = seeded_mines(
+            game_data['size_x'],
+            game_data['size_y'],
+            game_data['mine_count'],
+            game_data['seed'],
+            game_data['safe_tile']
+        )
+        board = cached_board(game_data['size_x'], game_data['size_y'], mines)
+    set_tiles(game_data, board)
+    return game_data
+
+def set_tiles(game_data, board, revealed=()):
+    game_data['tiles'] = {
+        str(id): {'value': value, 'hidden': True}
+        for id, value in enumerate(board)
+    }
+    for id in revealed:
+        tile = game_data['tiles'][str(id)]
+        tile['hidden'] = False
+        if tile['value'] == 9:
+            tile['value'] = 10 # Only a clicked mine is ever revealed
+    return game_data
+
+def dump_game_data(game_data):
+    """Compact JSON for games.data: the parameters, the seed (or the mine ids
+    of boards that were not generated from one) and a bitmap of revealed tiles"""
+    stored = {key: value for key, value in game_data.items() if key != 'tiles'}
+    tiles = game_data.get('tiles')
+    if tiles is not None:
+        revealed = bytearray((len(tiles) + 7) // 8)
+        for id, tile in tiles.items():
+            if not tile['hidden']:
+                revealed[int(id) >> 3] |= 1 << (int(id) & 7)
+        stored['revealed'] = base64.b64encode(revealed).decode()
+        if 'seed' not in game_data:
+            stored['mines'] = [int(id) for id, tile in tiles.items() if tile['value'] in (9, 10)]
+    return json.dumps(stored, separators=(',', ':'))
+
+def load_game_data(raw):
+    """Inverse of dump_game_data, also accepts games stored with every tile"""
+    game_data = json.loads(raw)
+    if 'tiles' in game_data or 'revealed' not in game_data:
+        return game_data
+
+    size_x, size_y = game_data['size_x'], game_data['size_y']
+    if 'seed' in game_data:
+        mines = seeded_mines(size_x, size_y, game_data['mine_count'], game_data['seed'], game_data['safe_tile'])
+    else:
+        mines = tuple(sorted(game_data.pop('mines')))
+    revealed = base64.b64decode(game_data.pop('revealed'))
+    set_tiles(game_data, cached_board(size_x, size_y, mines), (
+        id for id in range(size_x * size_y)
+        if revealed[id >> 3] >> (id & 7) & 1
+    ))
+    return game_data
+
+def append_varint(log, value):
+    """Append value to log as a LEB128 varint, 7 bits per byte"""
+    while value >= 0x80:
+        log.append(value & 0x7f | 0x80)
+        value >>= 7
+    log.append(value)
+
+def read_varints(log):
+    values, value, shift = [], 0, 0
+    for byte in log:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value, shift = 0, 0
+    return values
+
+def record_click(game_data, tile_id, now=None):
+    """Append a click that changed the board to the game's click log. Each click is
+    two varints, the tile index and the hundredths of a second since the previous
+    click, so a game takes a few bytes per click. Kept in game_data as base64 so it
+    is stored with the game until it ends"""
+    if now is None:
+        now = time()
+    log = bytearray(base64.b64decode(game_data.get('clicks', '')))
+    append_varint(log, int(tile_id))
+    append_varint(log, max(0, round((now - game_data.get('clicked_at', now)) * 100)))
+    game_data['clicks'] = base64.b64encode(log).decode()
+    game_data['clicked_at'] = round(now, 2)
+    return game_data
+
+def decode_clicks(log):
+    """[(tile index, hundredths of a second since the previous click)] of a click log,
+    bytes or the memoryview psycopg2 returns for bytea"""
+    values = read_varints(bytes(log))
+    return list(zip(values[::2], values[1::2]))
+
+def replay_game(size_x, size_y, mine_count, seed, safe_tile, clicks, step=None):
+    """Rebuild a game from its seed and play the first step clicks of its log
+    (all of them when step is None) through apply_click.
+    Returns the game_data and the outcome of the last click played"""
+    game_data = {'size_x': size_x, 'size_y': size_y, 'mine_count': mine_count, 'seed': seed, 'safe_tile': safe_tile}
+    set_tiles(game_data, cached_board(size_x, size_y, seeded_mines(size_x, size_y, mine_count, seed, safe_tile)))
+    outcome = 'playing'
+    for tile_index, _delay in clicks[:step]:
+        outcome = apply_click(game_data, str(tile_index))
+    return game_data, outcome
+
+def sanitize_game_data(game_data):
+    """Hide hidden tiles (-1) and only provide useful data (id: value)"""
+    if game_data.get('tiles') is None:
+        return {str(id): -1 for id in range(game_data['size_x'] * game_data['size_y'])}
+    
+    sanitized_data = {
+        id: data['value'] if not data['hidden'] else -1
+        for id, data in game_data['tiles'].items()
+    }
+    return sanitized_data
+
+def uncover_all_tiles(game_data):
+    """Ucover all hidden tiles (-1) and only provide useful data (id: value)"""
+
+    sanitized_data = {
+        id: data['value']
+        for id, data in game_data['tiles'].items()
+    }
+    return sanitized_data
+
+def uncover_tiles(tile_data, size_x, size_y, clicked_id):
+    """Function uncovers all tiles that need to be uncovered (as per minesweeper rules)
+    Tile provided MUST be a 0!"""
+    process_queue = set()
+    uncover_queue = set()
+    tiles_processed = set()
+    
+    process_queue.add(str(clicked_id))
+    uncover_queue.add(str(clicked_id))
+    
+    def queue_neighbors(tile_id):
+        x, y = tile_id % size_x, tile_id // size_x
+        for dx in [-1, 0, 1]:
+            for dy in [-1, 0, 1]:
+                if dx == 0 and dy == 0:
+                    continue
+    
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < size_x and 0 <= ny < size_y:
+                    str_id = str(ny * size_x + nx)
+                    if tile_data[str_id]['value'] == 0 and str_id not in tiles_processed:
+                        process_queue.add(str_id)
+                    uncover_queue.add(str_id)
+        tiles_processed.add(str(tile_id))
+    
+    # Process tiles from queue, while also adding new tiles into the same queue
+    while process_queue:
+        current_id = process_queue.pop()
+        queue_neighbors(int(current_id))
+    
+    # Uncover tiles from queue
+    for tile in uncover_queue:
+        tile_data[tile]['hidden'] = False
+    return tile_data
+
+def count_hidden_tiles(tile_data):
+    return sum(1 for tile in tile_data.values() if tile['hidden'])
+
+def calculate_xp(mine_count, size):
+    if mine_count == 0:
+        return 0
+    mine_percentage = mine_count/size
+    if mine_percentage < 0.1 or size < 100:
+        return 0
+
+    if mine_percentage >= 0.35 and size >= 2500:
+        return 200
+    
+    difficulty_bonus_dict = {
+        0.15: 25,
+        0.2: 50,
+        0.35: 75
+    }
+    for key, value in difficulty_bonus_dict.items():
+        if mine_percentage < key:
+            difficulty_bonus = value
+            break
+    else:
+        difficulty_bonus = 100
+
+    size_bonus_dict = {
+        400: 0,
+        900: 25,
+        2500: 50
+    }
+    for key, value in size_bonus_dict.items():
+        if size < key:
+            size_bonus = value
+            break
+    else:    
+        size_bonus = 75
+
+    return difficulty_bonus + size_bonus
+
+def get_battlepass_lvl(battlepass_xp):
+    expRequired = 100
+    expIncrementAmount = 25
+    currentLevel = 0
+
+    while battlepass_xp >= expRequired:
+        battlepass_xp -= expRequired
+        currentLevel += 1
+        expRequired += expIncrementAmount
+    return currentLevel
+
+def win_rewards(game_data, owns_battlepass, battlepass_xp):
+    """XP, coins and battlepass items earned by winning game_data,
+    battlepass_xp is the user's battlepass XP before the win"""
+    bp_multiplier = 0.25 if owns_battlepass else 0
+    boost_multiplier = 0.25 if game_data['booster_active'] else 0
+    base_xp = calculate_xp(
+        game_data['mine_count'],
+        game_data['size_x'] * game_data['size_y']
+    )
+    added_battlepass_xp = int(base_xp * (1 + boost_multiplier + bp_multiplier))
+    rewards = {
+        'added_coins': int(base_xp * (1 + boost_multiplier)),
+        'added_xp': int(base_xp * (1 + boost_multiplier)),
+        'added_battlepass_xp': added_battlepass_xp,
+        'battlepass_reward': "false",
+        'boosters': 0,
+        'avatars': [],
+        'skins': []
+    }
+
+    # If battlepass lvl changed, give rewards
+    old_battlepass_lvl = get_battlepass_lvl(battlepass_xp)
+    new_battlepass_lvl = get_battlepass_lvl(battlepass_xp + added_battlepass_xp)
+    if new_battlepass_lvl > old_battlepass_lvl:
+        rewards['battlepass_reward'] = "true"
+        if owns_battlepass:
+            for tier in range(max(old_battlepass_lvl, 1), new_battlepass_lvl+1):
+                item = battlepass_rewards[str(tier)]
+                if item['type'] == "booster":
+                    rewards['boosters'] += item['count']
+                elif item['type'] == "avatar":
+                    rewards['avatars'].append(item['id'])
+                elif item['type'] == "skin":
+                    rewards['skins'].append(item['id'])
+    return rewards
+
+def apply_click(game_data, tile_id):
+    """Reveal tile_id following minesweeper rules, updating game_data in place.
+    Returns 'not_found', 'already_clicked', 'unknown_value', 'loss', 'win' or 'playing'"""
+    if game_data.get('tiles') is None:
+        if get_tile_index(game_data, tile_id) is None:
+            return 'not_found'
+        materialize_board(game_data, tile_id)
+
+    tiles = game_data['tiles']
+    if tile_id not in tiles:
+        return 'not_found'
+
+    tile = tiles[tile_id]
+    if not tile['hidden']:
+        return 'already_clicked'
+
+    if tile['value'] == 9:
+        tile['value'] = 10 # Blow up mine visually
+        tile['hidden'] = False
+        return 'loss'
+
+    if tile['value'] in range(1, 9):
+        tile['hidden'] = False
+    elif tile['value'] == 0:
+        game_data['tiles'] = uncover_tiles(tiles, game_data['size_x'], game_data['size_y'], tile_id)
+    else:
+        return 'unknown_value'
+
+    if count_hidden_tiles(game_data['tiles']) == game_data['mine_count']:
+        return 'win'
+    return 'playing'
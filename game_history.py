@@ -0,0 +1,200 @@
+"""Append-only history of finished games. Results are queued when a game ends
+and written to game_results by a background writer, many rows per INSERT,
+so the click that ends a game doesn't wait for it"""
+import atexit
+import base64
+import os
+from collections import deque
+from datetime import datetime, timezone
+from threading import Event, Lock, Thread
+from time import sleep
+
+import metrics
+from logs import logger
+
+ENABLED = os.environ.get('GAME_HISTORY_ENABLED', '1') == '1'
+# Rows per INSERT, a full batch is written right away
+BATCH_SIZE = int(os.environ.get('GAME_HISTORY_BATCH', 200))
+# Partial batches are written at least this often
+FLUSH_INTERVAL = float(os.environ.get('GAME_HISTORY_FLUSH_MS', 1000)) / 1000
+# Results past this many waiting are dropped rather than growing memory while the database is down
+MAX_PENDING = int(os.environ.get('GAME_HISTORY_MAX_PENDING', 10000))
+# Retries after a failed write wait twice as long each time, up to this
+MAX_BACKOFF = float(os.environ.get('GAME_HISTORY_MAX_BACKOFF_MS', 30000)) / 1000
+# Most results /game_history returns for one request
+HISTORY_LIMIT = int(os.environ.get('GAME_HISTORY_LIMIT', 50))
+
+# One array per column, unnested into one row per result
+INSERT_SQL = "INSERT INTO game_results \
+    (user_id, finished_at, size_x, size_y, mine_count, no_guess, won, miliseconds_played, tiles_revealed, \
+    seed, safe_tile, clicks) \
+    SELECT * FROM unnest(%s::uuid[], %s::timestamptz[], %s::integer[], %s::integer[], %s::integer[], \
+    %s::boolean[], %s::boolean[], %s::integer[], %s::integer[], %s::bigint[], %s::integer[], %s::bytea[])"
+
+game_results = metrics.Counter(
+    'sapper_game_results_total',
+    "Finished games written to game_results (written) or given up on (dropped)",
+    ('result',))
+metrics.registry.append(game_results)
+
+
+def result_row(user_id, game_data, won, miliseconds_played):
+    """The game_results row of a game that just ended, tiles_revealed doesn't count a blown up mine.
+    The seed, first tile and click log are what /game_replay rebuilds the game from"""
+    tiles = game_data.get('tiles') or {}
+    clicks = game_data.get('clicks')
+    return (
+        str(user_id),
+        datetime.now(timezone.utc),
+        game_data['size_x'],
+        game_data['size_y'],
+        game_data['mine_count'],
+        bool(game_data.get('no_guess')),
+        won,
+        miliseconds_played,
+        sum(1 for tile in tiles.values() if not tile['hidden'] and tile['value'] < 9),
+        game_data.get('seed'),
+        game_data.get('safe_tile'),
+        base64.b64decode(clicks) if clicks is not None else None
+    )
+
+
+class ResultQueue:
+    """Results waiting to be written, shared by both writers"""
+
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = deque()
+        # Seconds to wait before the next write, 0 unless the last one failed
+        self.backoff = 0.0
+
+    def record(self, user_id, game_data, won, miliseconds_played):
+        if not ENABLED:
+            return
+        if len(self.pending) >= self.max_pending:
+            game_results.inc('dropped')
+            return
+        self.pending.append(result_row(user_id, game_data, won, miliseconds_played))
+        if len(self.pending) >= self.batch_size:
+            self.wake()
+
+    def wake(self):
+        pass
+
+    def take(self):
+        """The next batch as INSERT_SQL values, one list per column"""
+        batch = []
+        while self.pending and len(batch) < self.batch_size:
+            batch.append(self.pending.popleft())
+        return batch, [list(column) for column in zip(*batch)]
+
+    def written(self, batch):
+        self.backoff = 0.0
+        game_results.inc('written', amount=len(batch))
+
+    def failed(self, batch):
+        """Put a batch that couldn't be written back in front, in its order. Only results
+        past max_pending (the newest) are dropped, and the next write is delayed"""
+        logger.exception("writing game results failed")
+        self.pending.extendleft(reversed(batch))
+        overflow = len(self.pending) - self.max_pending
+        for _ in range(overflow):
+            self.pending.pop()
+        if overflow > 0:
+            game_results.inc('dropped', amount=overflow)
+        self.backoff = min(max(self.backoff * 2, self.flush_interval), MAX_BACKOFF)
+
+
+class ResultWriter(ResultQueue):
+    """Writes from a thread with its own connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wanted = Event()
+        self.lock = Lock()
+        self.thread = None
+        self.connect = None
+        self.conn = None
+
+    def wake(self):
+        self.wanted.set()
+
+    def flush(self):
+        with self.lock:
+            while self.pending:
+                batch, values = self.take()
+                try:
+                    if self.conn is None or self.conn.closed:
+                        self.conn = self.connect()
+                    cursor = self.conn.cursor()
+                    cursor.execute(INSERT_SQL, values)
+                    self.conn.commit()
+                    cursor.close()
+                except Exception:
+                    self.failed(batch)
+                    if self.conn is not None:
+                        self.conn.close()
+                        self.conn = None
+                    return
+                self.written(batch)
+
+    def run(self):
+        while True:
+            if self.backoff:
+                # Full batches don't hurry a retry while the database is failing
+                sleep(self.backoff)
+            else:
+                self.wanted.wait(self.flush_interval)
+            self.wanted.clear()
+            self.flush()
+
+    def start(self, connect):
+        """Start the writer thread, connect() opens its connection when there is something to write"""
+        if not ENABLED or self.thread is not None:
+            return
+        self.connect = connect
+        self.thread = Thread(target=self.run, name='game-history', daemon=True)
+        self.thread.start()
+        # Daemon threads are stopped on exit, write what is left first
+        atexit.register(self.flush)
+
+
+class AsyncResultWriter(ResultQueue):
+    """Writes from a task on the event loop, through the pool"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wanted = None
+
+    def wake(self):
+        if self.wanted is not None:
+            self.wanted.set()
+
+    async def flush(self, pool):
+        while self.pending:
+            batch, values = self.take()
+            try:
+                async with pool.connection() as conn:
+                    await conn.cursor().execute(INSERT_SQL, values)
+            except Exception:
+                self.failed(batch)
+                return
+            self.written(batch)
+
+    async def run(self, pool):
+        """Write batches until cancelled"""
+        # Already loaded under the event loop, see single_flight
+        import asyncio
+        self.wanted = asyncio.Event()
+        while True:
+            if self.backoff:
+                await asyncio.sleep(self.backoff)
+            else:
+                try:
+                    await asyncio.wait_for(self.wanted.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.wanted.clear()
+            await self.flush(pool)
@@ -1,211 +1,254 @@
-import json
+import hmac
 import os
-import random
 import re
-from hashlib import pbkdf2_hmac
-from threading import Thread
-from time import time
-from math import ceil
+from threading import BoundedSemaphore, Lock, Thread
+from time import perf_counter, time
 
 import psycopg2
-from bitstring import BitArray
-from flask import Flask, jsonify, request
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from flask import Flask, Response, g, request
 from flask_cors import CORS, cross_origin
 
+import board_pool
+import export
+import game_history
+import logs
+import metrics
+import passwords
+import queries
+import query_log
+import rate_limit
+import responses
+import session_tokens
+import single_flight
+from game import (
+    apply_click,
+    dump_game_data,
+    get_battlepass_lvl,
+    load_game_data,
+    record_click,
+    win_rewards,
+)
+from serializers import get_request_data, respond
+
 app = Flask(__name__)
 cors = CORS(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
-
-encoding = 'sha512'
-iterations = 450959
+logs.init_app(app)
+metrics.init_app(app)
+rate_limit.init_app(app)
+logger = logs.logger
+
+def db_params():
+    return {
+        'dbname': os.environ.get('DB_NAME', 'postgres'),
+        'user': os.environ.get('DB_USER', 'postgres.wicmdrinzqmsffrhqxyg'),
+        'password': os.environ['DB_PASSWORD'],
+        'host': os.environ['DB_HOST'],
+        'port': int(os.environ.get('DB_PORT', 5432)),
+        'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 10)),
+        'cursor_factory': metrics.MetricsCursor,
+        'connection_factory': metrics.MetricsConnection
+    }
 
 def connect():
-    conn = psycopg2.connect(
-        dbname='postgres',
-        user='postgres.wicmdrinzqmsffrhqxyg',
-        password=os.environ['DB_PASSWORD'],
-        host=os.environ['DB_HOST'],
-        port=5432
-    )
+    conn = psycopg2.connect(**db_params())
     return conn
 
-conn = connect()
-
-battlepass_rewards = {
-    "1": {"type": "booster", "count": 1},
-    "2": {"type": "booster", "count": 1},
-    "3": {"type": "avatar", "id": 3},
-    "4": {"type": "booster", "count": 2},
-    "5": {"type": "gems", "count": 100},
-    "6": {"type": "booster", "count": 1},
-    "7": {"type": "booster", "count": 3},
-    "8": {"type": "gems", "count": 50},
-    "9": {"type": "booster", "count": 1},
-    "10": {"type": "skin", "id": 1},
-    "11": {"type": "gems", "count": 100},
-    "12": {"type": "booster", "count": 1},
-    "13": {"type": "booster", "count": 2},
-    "14": {"type": "avatar", "id": 2},
-    "15": {"type": "gems", "count": 100},
-    "16": {"type": "booster", "count": 2},
-    "17": {"type": "gems", "count": 50},
-    "18": {"type": "booster", "count": 1},
-    "19": {"type": "booster", "count": 1},
-    "20": {"type": "skin", "id": 4},
-    "21": {"type": "gems", "count": 100},
-    "22": {"type": "booster", "count": 2},
-    "23": {"type": "booster", "count": 1},
-    "24": {"type": "avatar", "id": 5},
-    "25": {"type": "gems", "count": 100},
-    "26": {"type": "booster", "count": 3},
-    "27": {"type": "booster", "count": 1},
-    "28": {"type": "gems", "count": 50},
-    "29": {"type": "booster", "count": 1},
-    "30": {"type": "skin", "id": 8},
-    "31": {"type": "gems", "count": 100},
-    "32": {"type": "booster", "count": 3},
-    "33": {"type": "booster", "count": 2},
-    "34": {"type": "avatar", "id": 8},
-    "35": {"type": "gems", "count": 100},
-    "36": {"type": "booster", "count": 3},
-    "37": {"type": "gems", "count": 50},
-    "38": {"type": "booster", "count": 1},
-    "39": {"type": "gems", "count": 100},
-    "40": {"type": "avatar", "id": 9},
-} 
+query_log.explain_connect = connect
+board_pool.start()
+
+# Created on first use, so importing (a serverless cold start) never waits on the database
+pool = None
+pool_lock = Lock()
+POOL_MIN = int(os.environ.get('DB_POOL_MIN', 2))
+POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+# psycopg2's pool fails right away when every connection is taken, requests wait up to this long instead
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT_S', 10))
+pool_slots = BoundedSemaphore(POOL_MAX)
+# Requests blocked in getconn(), admission control sheds new ones past ADMISSION_MAX_POOL_WAITING
+pool_waiting = 0
+pool_waiting_lock = Lock()
+rate_limit.admission.pool_waiting = lambda: pool_waiting
+
+started_at = time()
+readiness_ttl = float(os.environ.get('READINESS_CACHE_S', 2))
+readiness_timeout_ms = int(os.environ.get('READINESS_TIMEOUT_MS', 1000))
+readiness = {'checked_at': 0.0, 'result': None}
+readiness_lock = Lock()
+# Concurrent identical reads of a session's user share one fetch
+reads = single_flight.SingleFlight()
+# Finished games are written to game_results in batches, off the click's path
+results = game_history.ResultWriter()
+results.start(connect)
 
 
 # FUNCTIONS
-def create_game_board(size_x, size_y, mine_count):
-    # Create empty board
-    board = [0] * size_x * size_y
-
-    # Place mines randomly on the board
-    for _ in range(mine_count):
-        while True:
-            x, y = random.randint(0, size_x-1), random.randint(0, size_y-1)
-            if board[x + y*size_x] != 9:
-                board[x + y*size_x] = 9
-                break
-
-    # Update the counts around each mine
-    for x in range(size_x):
-        for y in range(size_y):
-            if board[x + y*size_x] == 9:
-                continue
-
-            for dx in range(-1, 2):
-                for dy in range(-1, 2):
-                    nx, ny = x + dx, y + dy
-                    if 0 <= nx < size_x and 0 <= ny < size_y and board[nx + ny*size_x] == 9:
-                        board[x + y*size_x] += 1
-    return board
-
-def sanitize_database_output(text):
-    return str(text).strip("::text")
-
-def sanitize_game_data(game_data):
-    """Hide hidden tiles (-1) and only provide useful data (id: value)"""
-    
-    sanitized_data = {
-        id: data['value'] if not data['hidden'] else -1
-        for id, data in game_data['tiles'].items()
-    }
-    return sanitized_data
-
-def uncover_all_tiles(game_data):
-    """Ucover all hidden tiles (-1) and only provide useful data (id: value)"""
-
-    sanitized_data = {
-        id: data['value']
-        for id, data in game_data['tiles'].items()
-    }
-    return sanitized_data
-
-def uncover_tiles(tile_data, size_x, size_y, clicked_id):
-    """Function uncovers all tiles that need to be uncovered (as per minesweeper rules)
-    Tile provided MUST be a 0!"""
-    process_queue = set()
-    uncover_queue = set()
-    tiles_processed = set()
-    
-    process_queue.add(str(clicked_id))
-    uncover_queue.add(str(clicked_id))
-    
-    def queue_neighbors(tile_id):
-        x, y = tile_id % size_x, tile_id // size_x
-        for dx in [-1, 0, 1]:
-            for dy in [-1, 0, 1]:
-                if dx == 0 and dy == 0:
-                    continue
-    
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < size_x and 0 <= ny < size_y:
-                    str_id = str(ny * size_x + nx)
-                    if tile_data[str_id]['value'] == 0 and str_id not in tiles_processed:
-                        process_queue.add(str_id)
-                    uncover_queue.add(str_id)
-        tiles_processed.add(str(tile_id))
-    
-    # Process tiles from queue, while also adding new tiles into the same queue
-    while process_queue:
-        current_id = process_queue.pop()
-        queue_neighbors(int(current_id))
-    
-    # Uncover tiles from queue
-    for tile in uncover_queue:
-        tile_data[tile]['hidden'] = False
-    return tile_data
-
-def count_hidden_tiles(tile_data):
-    return sum(1 for tile in tile_data.values() if tile['hidden'])
-
-def calculate_xp(mine_count, size):
-    if mine_count == 0:
-        return 0
-    mine_percentage = mine_count/size
-    if mine_percentage < 0.1 or size < 100:
-        return 0
-
-    if mine_percentage >= 0.35 and size >= 2500:
-        return 200
-    
-    difficulty_bonus_dict = {
-        0.15: 25,
-        0.2: 50,
-        0.35: 75
-    }
-    for key, value in difficulty_bonus_dict.items():
-        if mine_percentage < key:
-            difficulty_bonus = value
-            break
-    else:
-        difficulty_bonus = 100
-
-    size_bonus_dict = {
-        400: 0,
-        900: 25,
-        2500: 50
+def get_pool():
+    """The shared connection pool, opened on first use"""
+    global pool
+    if pool is None:
+        with pool_lock:
+            if pool is None:
+                # Opens DB_POOL_MIN connections right away. psycopg2 keeps at most
+                # DB_POOL_MIN idle connections, the rest are closed on putconn
+                pool = ThreadedConnectionPool(POOL_MIN, POOL_MAX, **db_params())
+    return pool
+
+def getconn():
+    """A connection from the pool, waiting up to DB_POOL_TIMEOUT_S for one to be returned"""
+    global pool_waiting
+    if not pool_slots.acquire(blocking=False):
+        with pool_waiting_lock:
+            pool_waiting += 1
+        try:
+            acquired = pool_slots.acquire(timeout=POOL_TIMEOUT)
+        finally:
+            with pool_waiting_lock:
+                pool_waiting -= 1
+        if not acquired:
+            raise PoolError("connection pool exhausted")
+    try:
+        conn = get_pool().getconn()
+        # Connections the server closed while idle are replaced
+        while conn.closed:
+            get_pool().putconn(conn, close=True)
+            conn = get_pool().getconn()
+        return conn
+    except Exception:
+        pool_slots.release()
+        raise
+
+def putconn(conn):
+    """Give back a connection from getconn(), the pool rolls back anything left uncommitted"""
+    try:
+        get_pool().putconn(conn, close=bool(conn.closed))
+    finally:
+        pool_slots.release()
+
+def get_connection():
+    """The request's pooled connection, taken on first use and given back when the request ends"""
+    if 'conn' not in g:
+        g.conn = getconn()
+    return g.conn
+
+@app.teardown_appcontext
+def release_connection(_exception):
+    conn = g.pop('conn', None)
+    if conn is not None:
+        putconn(conn)
+
+def warm_up():
+    """Open the pool and check the database ahead of the first request.
+    Serverless platforms can call this (or GET /warmup) right after a cold start"""
+    start = perf_counter()
+    try:
+        get_pool()
+    except Exception as e:
+        logger.warning("warm up failed", extra={"error": str(e)})
+        return {'ready': False, 'error': str(e), 'latency_ms': round((perf_counter() - start) * 1000, 2)}
+    result, _cached = check_database()
+    return result
+
+def pool_stats():
+    if pool is None:
+        return {'max': POOL_MAX, 'in_use': 0, 'idle': 0}
+    return {
+        'max': pool.maxconn,
+        'in_use': len(pool._used),
+        'idle': len(pool._pool)
     }
-    for key, value in size_bonus_dict.items():
-        if size < key:
-            size_bonus = value
-            break
-    else:    
-        size_bonus = 75
-
-    return difficulty_bonus + size_bonus
 
-def get_battlepass_lvl(battlepass_xp):
-    expRequired = 100
-    expIncrementAmount = 25
-    currentLevel = 0
+def check_database():
+    """Run a pooled SELECT 1, reusing the last result for READINESS_CACHE_S
+    so frequent probes cost at most one query per interval.
+    Returns (result, cached)"""
+    result = readiness['result']
+    if result is not None and time() - readiness['checked_at'] < readiness_ttl:
+        return result, True
+
+    with readiness_lock:
+        result = readiness['result']
+        if result is not None and time() - readiness['checked_at'] < readiness_ttl:
+            return result, True
+
+        start = perf_counter()
+        try:
+            probe_conn = getconn()
+            try:
+                cursor = probe_conn.cursor()
+                cursor.execute("SET LOCAL statement_timeout = %s", (readiness_timeout_ms,))
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+                cursor.close()
+                probe_conn.rollback()
+            finally:
+                putconn(probe_conn)
+            result = {'ready': True}
+        except Exception as e:
+            result = {'ready': False, 'error': str(e)}
+        result['latency_ms'] = round((perf_counter() - start) * 1000, 2)
+
+        readiness['result'] = result
+        readiness['checked_at'] = time()
+        return result, False
+
+def is_admin():
+    """Admin endpoints need `Authorization: Bearer <ADMIN_TOKEN>`"""
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    if not admin_token:
+        return False
+    return hmac.compare_digest(
+        request.headers.get('Authorization', ''),
+        f"Bearer {admin_token}"
+    )
 
-    while battlepass_xp >= expRequired:
-        battlepass_xp -= expRequired
-        currentLevel += 1
-        expRequired += expIncrementAmount
-    return currentLevel
+def sync_revocations(cursor):
+    """Pick up token revocations made by other instances every SESSION_REVOCATION_SYNC_S.
+    Only the first sync is waited for, later ones are skipped while another request runs one"""
+    revocations = session_tokens.revocations
+    if not session_tokens.ENABLED or not revocations.due() \
+            or not revocations.lock.acquire(blocking=revocations.synced_at is None):
+        return
+    try:
+        if revocations.due():
+            cursor.execute(session_tokens.SYNC_SQL, (revocations.since(),))
+            revocations.apply(cursor.fetchall())
+    finally:
+        revocations.lock.release()
+
+def get_session_user(cursor, session_id):
+    """user_id for session_id, or None. Signed tokens are checked without the sessions table"""
+    if session_tokens.is_token(session_id):
+        sync_revocations(cursor)
+        session = session_tokens.verify(session_id)
+        return session[1] if session else None
+    cursor.execute(queries.SESSION_USER, (session_id,))
+    session = cursor.fetchone()
+    return session[0] if session else None
+
+def session_params(cursor, session_id):
+    """session_tokens.session_params() once revocations are synced"""
+    if session_tokens.is_token(session_id):
+        sync_revocations(cursor)
+    return session_tokens.session_params(session_id)
+
+def wrong_session():
+    body, status = responses.wrong_session()
+    return respond(body), status
+
+def new_session(cursor, user_id):
+    """A signed token for user_id when SESSION_TOKEN_KEYS is set, otherwise a new sessions row"""
+    if session_tokens.ENABLED:
+        return session_tokens.issue(user_id)
+    cursor.execute(queries.NEW_SESSION, (user_id,))
+    session = cursor.fetchone()
+    return session[0] if session else None
+
+
+# DB_WARM_UP=1 opens the pool in the background right after import instead of on the first request
+if os.environ.get('DB_WARM_UP', '0') == '1':
+    Thread(target=warm_up, name='db-warm-up', daemon=True).start()
 
 
 # ROUTES
@@ -213,1739 +256,1134 @@ def get_battlepass_lvl(battlepass_xp):
 def index():
     return "This is only an api! If you want to access the game, go to <a href=\"https://sapper-zeta.vercel.app/\">https://sapper-zeta.vercel.app/</a>"
 
+@app.route('/metrics')
+def get_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/admin/slow_queries')
+def admin_slow_queries():
+    if not is_admin():
+        return respond(responses.fail("not authorized")), 403
+    return respond({"type": "success", **query_log.report()}), 200
+
+@app.route('/admin/export/<table>')
+def admin_export(table):
+    """Stream a whole table as NDJSON (default) or CSV with ?format=csv"""
+    if not is_admin():
+        return respond(responses.fail("not authorized")), 403
+    if table not in export.TABLES:
+        return respond(responses.fail("unknown table")), 404
+    output_format = request.args.get('format', 'ndjson')
+    if output_format not in export.FORMATS:
+        return respond(responses.fail("unknown format")), 400
+    columns, sql = export.TABLES[table]
+
+    def generate():
+        # Its own connection, held until the last row is sent
+        conn = connect()
+        try:
+            conn.set_session(readonly=True)
+            # A named cursor is declared on the server, each fetchmany is one FETCH of BATCH_SIZE rows
+            cursor = conn.cursor(name=f"export_{table}")
+            cursor.execute(sql)
+            header = export.header(columns, output_format)
+            # An empty chunk would end a chunked response early
+            if header:
+                yield header
+            while True:
+                rows = cursor.fetchmany(export.BATCH_SIZE)
+                if not rows:
+                    break
+                export.exported_rows.inc(table, amount=len(rows))
+                yield export.format_rows(columns, rows, output_format)
+            cursor.close()
+        finally:
+            conn.close()
+
+    return Response(generate(), mimetype=export.FORMATS[output_format], headers={
+        'Content-Disposition': f'attachment; filename="{table}.{output_format}"'
+    })
+
+@app.route('/livez')
+@cross_origin()
+def livez():
+    """Liveness: the process is serving requests, never touches the database"""
+    return respond({
+        "type": "success",
+        "status": "alive",
+        "uptime_s": round(time() - started_at, 1),
+        "pool": pool_stats()
+    }), 200
+
+@app.route('/readyz')
+@cross_origin()
+def readyz():
+    """Readiness: the database answers a pooled SELECT 1"""
+    result, cached = check_database()
+    data = {
+        "type": "success" if result['ready'] else "fail",
+        "status": "ready" if result['ready'] else "unavailable",
+        "latency_ms": result['latency_ms'],
+        "checked_at": readiness['checked_at'],
+        "cached": cached,
+        "pool": pool_stats()
+    }
+    if not result['ready']:
+        data['reason'] = result['error']
+        return respond(data), 503
+    return respond(data), 200
+
+@app.route('/warmup')
+@cross_origin()
+def warmup():
+    """Warm-up hook for serverless platforms: opens the pool so the next request doesn't"""
+    result = warm_up()
+    data = {
+        "type": "success" if result['ready'] else "fail",
+        "status": "ready" if result['ready'] else "unavailable",
+        "latency_ms": result['latency_ms'],
+        "pool": pool_stats()
+    }
+    if not result['ready']:
+        data['reason'] = result['error']
+        return respond(data), 503
+    return respond(data), 200
+
 @app.route('/health')
 @cross_origin()
 def health():
-    start1 = time()
-    try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "INSERT INTO test (value) VALUES (%s)"
-        values = ('ABX',)
-        cursor.execute(sql, values)
-        timing1 = time()-start1
-        
-        start2 = time()
-        sql = "SELECT value FROM test"
-        cursor.execute(sql)
-        row = cursor.fetchone()
-        if row[0] == 'ABX':
-            timing2 = time()-start2
-            data = {
-                'response': 'ok',
-                'timing': f'db conn + insert {round(timing1, 2)}s | db fetch {round(timing2, 2)}s'
-            }
-            cursor.close()
-            return jsonify(data), 200
-        else:
-            timing2 = time()-start2
-            data = {
-                'error': 'db error',
-                'timing': f'db conn + insert {round(timing1, 2)}s | db fetch {round(timing2, 2)}s'
-            }
-            cursor.close()
-            return jsonify(data), 500
-    except Exception as e:
-        cursor.close()
-        return jsonify({'error': str(e)}), 500
+    result, _ = check_database()
+    timing = f"db select {round(result['latency_ms'] / 1000, 2)}s"
+    if not result['ready']:
+        return respond({'error': 'db error', 'timing': timing}), 500
+    return respond({'response': 'ok', 'timing': timing}), 200
 
 @app.route('/login', methods=['POST'])
 @cross_origin()
 def login():
-    print("got login request!")
-    # session_id = request.form['session_id']
-
-    # if session_id:
-        # return jsonify({"type":"fail", "reason": "user already logged in"}), 200
-    
     email = request.form['email']
     password = request.form['password']
-    if len(password) < 8 or len(password) > 64:
-        print("invalid password")
-        return jsonify({"type":"fail", "reason":"invalid password length"}), 200
+    if not responses.valid_password(password):
+        logger.info("invalid password length")
+        return respond(responses.fail("invalid password length")), 200
 
-    
-    try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        sql = "SELECT uuid, password_hash, salt, username, xp, bp_xp, coins, gems \
-        FROM users WHERE email = %s"
-        values = (email,)
-        cursor.execute(sql, values)
+        cursor.execute(queries.LOGIN_USER, (email,))
         user = cursor.fetchone()
-        
+
         if user is None:
             cursor.close()
-            return jsonify({
-                "type":"fail", 
-                "reason":"username or password is incorrect"
-            }), 200
-    
-        uuid = user[0]
-        db_hash = BitArray(bin=user[1]).bytes
-        db_salt = BitArray(bin=user[2]).bytes
-        username = user[3]
-        xp = user[4]
-        battlepass_xp = user[5]
-        coins = user[6]
-        gems = user[7]
-        
-        password_hash = pbkdf2_hmac(
-            encoding, 
-            password.encode('utf-8'), 
-            db_salt, 
-            iterations
-        )
-        
-        if db_hash != password_hash:
+            return respond(responses.fail("username or password is incorrect")), 200
+
+        if passwords.from_bits(user[1]) != passwords.hash_password(password, passwords.from_bits(user[2])):
             cursor.close()
-            return jsonify({"type":"fail", "reason":"username or password is incorrect"}), 200
-    
-        sql = "with rows as (INSERT INTO sessions (user_id) VALUES (%s) RETURNING session_id) SELECT session_id FROM rows"
-        values = (uuid, )
-        cursor.execute(sql, values)
+            return respond(responses.fail("username or password is incorrect")), 200
+
+        session_id = new_session(cursor, user[0])
         conn.commit()
-        session = cursor.fetchone()
         cursor.close()
-    
-        if not session:
-            return jsonify({"error":"unknown db error"}), 500
-    
-        print(f"new session_id {session[0]} for user {email} with uuid {uuid}")
-        return jsonify({
-            "session_id": session[0], 
-            "username": username,
-            "xp": xp,
-            "battlepass_xp": battlepass_xp,
-            "coins": coins,
-            "gems": gems,
-            "type": "success"
-        }), 200
+
+        if not session_id:
+            return respond({"error":"unknown db error"}), 500
+
+        logger.info("user logged in", extra={"user_id": user[0]})
+        return respond(responses.login(user, session_id)), 200
     except Exception as e:
         cursor.close()
-        return jsonify({"error": str(e)}), 500    
+        return respond({"error": str(e)}), 500
 
 @app.route('/register', methods=['POST'])
 @cross_origin()
 def register():
-    print("got register request!")
-    # session_id = request.form['session_id']
-
-    # if session_id:
-        # return jsonify({"type":"fail", "reason": "user already logged in"}), 200
-    
     email = request.form['email']
-    
+
     username = request.form['username']
     if re.match(f"^[a-zA-Z0-9_]{5,24}$", username):
-        print("invalid username")
-        return jsonify({"type":"fail", "reason":"invalid username"}), 200
-        
-    password = request.form['password']
-    if len(password) < 8 or len(password) > 64:
-        print("invalid password")
-        return jsonify({"type":"fail", "reason":"invalid password length"}), 200
+        logger.info("invalid username")
+        return respond(responses.fail("invalid username")), 200
 
+    password = request.form['password']
+    if not responses.valid_password(password):
+        logger.info("invalid password length")
+        return respond(responses.fail("invalid password length")), 200
 
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT uuid FROM users WHERE email = %s"
-        values = (email, )
-        cursor.execute(sql, values)
-        existing_email = cursor.fetchone()
-        
-        if existing_email:
+        cursor.execute(queries.EMAIL_TAKEN, (email,))
+        if cursor.fetchone():
             cursor.close()
-            return jsonify({"type":"fail", "reason":"account with this email already exists"}), 200
-            
-        sql = "SELECT uuid FROM users WHERE username = %s"
-        values = (username, )
-        cursor.execute(sql, values)
-        existing_username = cursor.fetchone()
-    
-        if existing_username:
+            return respond(responses.fail("account with this email already exists")), 200
+
+        cursor.execute(queries.USERNAME_TAKEN, (username,))
+        if cursor.fetchone():
             cursor.close()
-            return jsonify({"type":"fail", "reason":"username is taken"}), 200
-    
+            return respond(responses.fail("username is taken")), 200
+
         salt = os.urandom(64)
-        password_hash = pbkdf2_hmac(
-            encoding, 
-            password.encode('utf-8'), 
-            salt, 
-            iterations
-        )
-    
-        sql = "INSERT INTO users (email, username, password_hash, salt) VALUES (%s, %s, right(%s::text, -1)::bit(512), right(%s::text, -1)::bit(512))"
-        values = (email, username, password_hash, salt)
-        cursor.execute(sql, values)
-        sql = "SELECT uuid, email FROM users WHERE username = %s"
-        values = (username, )
-        cursor.execute(sql, values)
-        conn.commit()
+        password_hash = passwords.hash_password(password, salt)
+        cursor.execute(queries.REGISTER_USER, (email, username, password_hash, salt))
         user = cursor.fetchone()
-        
+
         if not user:
             cursor.close()
-            return jsonify({"error":"unknown db error"}), 500
-        print(f"created account {user[0]} with email {user[1]}")
-        
-        sql = "with rows as (INSERT INTO sessions (user_id) VALUES (%s) RETURNING session_id) SELECT session_id FROM rows"
-        values = (user[0], )
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+            return respond({"error":"unknown db error"}), 500
+        logger.info("created account", extra={"user_id": user[0]})
+
+        session_id = new_session(cursor, user[0])
+        conn.commit()
         cursor.close()
-    
-        if not session:
-            return jsonify({"error":"unknown db error"}), 500
-    
-        print(f"and session_id {session[0]}")
-        return jsonify({
-            "type": "success", 
-            "session_id": session[0],
+
+        if not session_id:
+            return respond({"error":"unknown db error"}), 500
+
+        return respond({
+            "type": "success",
+            "session_id": session_id,
             "username": username
         }), 200
     except Exception as e:
         cursor.close()
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/logout', methods=['POST'])
 @cross_origin()
 def logout():
-    print("got logout request!")
-    session_id = request.json['session_id']
+    session_id = get_request_data()['session_id']
 
     if not session_id:
-        print("user already logged out")
-        return jsonify({"type":"success"}), 200
-    
-    try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
+        logger.info("user already logged out")
+        return respond({"type":"success"}), 200
+
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        sql = "DELETE FROM sessions WHERE session_id = %s"
-        values = (session_id, )
-        cursor.execute(sql, values)
+        if session_tokens.is_token(session_id):
+            # Tokens stay valid until they expire, other instances learn of the logout on their next sync
+            values = session_tokens.revoke(session_id)
+            if values:
+                cursor.execute(session_tokens.REVOKE_SQL, values)
+        else:
+            cursor.execute(queries.DELETE_SESSION, (session_id,))
         conn.commit()
-    
-        print(f"Logged out user with session_id {session_id}")
+        reads.invalidate(session_id)
+
+        logger.info("user logged out")
         cursor.close()
-        return jsonify({"type":"success"}), 200
+        return respond({"type":"success"}), 200
     except Exception as e:
         cursor.close()
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/change_password', methods=['POST'])
 @cross_origin()
 def change_password():
     session_id = request.form['session_id']
     if not session_id:
-        return jsonify({
-            "type":"fail", 
-            "reason": "missing session id"
-        }), 400
-    
-    old_password = request.form['old_password']
-    if len(old_password) < 8 or len(old_password) > 64:
-        return jsonify({
-            "type":"fail", 
-            "reason":"invalid password length"
-        }), 400
+        return respond(responses.fail("missing session id")), 400
 
+    old_password = request.form['old_password']
     new_password = request.form['new_password']
-    if len(new_password) < 8 or len(new_password) > 64:
-        return jsonify({
-            "type":"fail", 
-            "reason":"invalid password length"
-        }), 400
-
-    confirm_new_password = request.form['confirm_new_password']
-    if confirm_new_password != new_password:
-        return jsonify({
-            "type":"fail", 
-            "reason":"passwords do not match"
-        }), 400
+    if not responses.valid_password(old_password) or not responses.valid_password(new_password):
+        return respond(responses.fail("invalid password length")), 400
 
+    if request.form['confirm_new_password'] != new_password:
+        return respond(responses.fail("passwords do not match")), 400
+
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s FOR UPDATE"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        if session_tokens.is_token(session_id):
+            user_id = get_session_user(cursor, session_id)
+        else:
+            cursor.execute(queries.SESSION_USER_FOR_UPDATE, (session_id,))
+            session = cursor.fetchone()
+            user_id = session[0] if session else None
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "wrong session id"
-            }), 401
-
-        user_id = session[0]
-        sql = "SELECT password_hash, salt FROM users WHERE uuid = %s FOR UPDATE"
-        values = (user_id, )
-        cursor.execute(sql, values)
+            return wrong_session()
+
+        cursor.execute(queries.PASSWORD_FOR_UPDATE, (user_id,))
         user = cursor.fetchone()
-    
+
         if not user:
             cursor.close()
-            return jsonify({"error":"unknown db error"}), 500
-    
-        db_hash = BitArray(bin=user[0]).bytes
-        db_salt = BitArray(bin=user[1]).bytes
-        
-        old_password_hash = pbkdf2_hmac(
-            encoding, 
-            old_password.encode('utf-8'), 
-            db_salt, 
-            iterations
-        )
-        
-        if db_hash != old_password_hash:
+            return respond({"error":"unknown db error"}), 500
+
+        if passwords.from_bits(user[0]) != passwords.hash_password(old_password, passwords.from_bits(user[1])):
             cursor.close()
-            return jsonify({"type":"fail", "reason":"old password is incorrect"}), 401
+            return respond(responses.fail("old password is incorrect")), 401
 
-        # Password is correct. Now change the password
         new_salt = os.urandom(64)
-        new_password_hash = pbkdf2_hmac(
-            encoding, 
-            new_password.encode('utf-8'), 
-            new_salt, 
-            iterations
-        )
-    
-        # Update password and hash in db
-        sql = "UPDATE users SET \
-                 password_hash = right(%s::text, -1)::bit(512), \
-                 salt = right(%s::text, -1)::bit(512) \
-               WHERE uuid = %s"
-        values = (new_password_hash, new_salt, user_id)
-        cursor.execute(sql, values)
-        
-        # Delete all existing sessions for user
-        sql = "DELETE FROM sessions WHERE user_id = %s"
-        values = (user_id, )
-        cursor.execute(sql, values)
+        cursor.execute(queries.SET_PASSWORD, (passwords.hash_password(new_password, new_salt), new_salt, user_id))
+
+        # Delete all existing sessions for user, and revoke every token issued so far
+        cursor.execute(queries.DELETE_USER_SESSIONS, (user_id,))
+        if session_tokens.ENABLED:
+            cursor.execute(session_tokens.REVOKE_SQL, session_tokens.revoke_user(user_id))
 
         # Add a new session (renew old one)
-        sql = "WITH rows AS (INSERT INTO sessions (user_id) VALUES (%s) RETURNING session_id) SELECT session_id FROM rows"
-        values = (user_id, )
-        cursor.execute(sql, values)
+        session_id = new_session(cursor, user_id)
         conn.commit()
-        session = cursor.fetchone()
         cursor.close()
 
-        if not session:
-            return jsonify({"error":"unknown db error"}), 500
-    
-        return jsonify({
-            "type": "success", 
-            "session_id": session[0]
+        if not session_id:
+            return respond({"error":"unknown db error"}), 500
+
+        return respond({
+            "type": "success",
+            "session_id": session_id
         }), 200
     except Exception as e:
         cursor.close()
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/get_user_id')
 @cross_origin()
 def get_user_id():
-    session_id = request.json['session_id']
+    session_id = get_request_data()['session_id']
     if not session_id:
-        return jsonify({"type": "fail", "reason": "missing session id"}), 401
-    try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
+        return respond(responses.fail("missing session id")), 401
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-
-        if not session:
-            cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "wrong session id"
-            }), 401
-
-        return jsonify({
-            "type": "success",
-            "id": session[0]
-        }), 200
+        user_id = get_session_user(cursor, session_id)
+        cursor.close()
 
+        if not user_id:
+            return wrong_session()
+        return respond({"type": "success", "id": user_id}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/get_statistics', methods=['POST'])
 @cross_origin()
 def get_statistics():
-    session_id = request.json['session_id']
-    
+    session_id = get_request_data()['session_id']
+
     if not session_id:
-        return jsonify({"type": "fail", "reason": "missing session id"}), 400
+        return respond(responses.fail("missing session id")), 400
 
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
+            return wrong_session()
 
-        user_id = session[0]
-        sql = "SELECT username, avatar, xp, statistics FROM users WHERE uuid = %s"
-        values = (user_id, )
-        cursor.execute(sql, values)
+        cursor.execute(queries.USER_PROFILE, (user_id,))
         user = cursor.fetchone()
         cursor.close()
 
         if not user:
-            return jsonify({"type": "fail", "reason": "user doesn't exist"}), 400
-        
-        return jsonify({
-            "type": "success",
-            "username": user[0],
-            "avatar": user[1],
-            "xp": user[2],
-            "statistics": json.loads(sanitize_database_output(user[3]))
-        }), 200
+            return respond(responses.fail("user doesn't exist")), 400
+        return respond(responses.statistics(user)), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
+@app.route('/game_history', methods=['POST'])
+@cross_origin()
+def get_game_history():
+    data = get_request_data()
+    session_id = data['session_id']
+
+    if not session_id:
+        return respond(responses.fail("missing session id")), 400
+    params = responses.history_params(data)
+    if params is None:
+        return respond(responses.fail("invalid parameters")), 400
+    limit, before = params
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        values = {**session_params(cursor, session_id), 'before': before, 'limit': limit}
+        cursor.execute(queries.GAME_HISTORY, values)
+        rows = cursor.fetchall()
+        cursor.close()
+
+        if not rows:
+            return wrong_session()
+        return respond(responses.history(rows)), 200
+    except Exception as e:
+        return respond({"error": str(e)}), 500
+
+
+@app.route('/game_replay', methods=['POST'])
+@cross_origin()
+def get_game_replay():
+    data = get_request_data()
+    session_id = data['session_id']
+
+    if not session_id or data['game_id'] is None:
+        return respond(responses.fail("missing parameters")), 400
+    params = responses.replay_params(data)
+    if params is None:
+        return respond(responses.fail("invalid parameters")), 400
+    result_id, step = params
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(queries.GAME_REPLAY, {**session_params(cursor, session_id), 'result_id': result_id})
+        row = cursor.fetchone()
+        cursor.close()
+
+        body, status = responses.replay(row, step)
+        return respond(body), status
+    except Exception as e:
+        return respond({"error": str(e)}), 500
 
 # FRIEND ENDPOINTS
 @app.route('/add_friend', methods=['POST'])
 @cross_origin()
 def add_friend():
-    session_id = request.json['session_id']
-    friend_id = request.json['user_id']
+    session_id = get_request_data()['session_id']
+    friend_id = get_request_data()['user_id']
 
     if not session_id or not friend_id:
-        return jsonify({"type": "fail", "reason": "missing parameters"}), 400
+        return respond(responses.fail("missing parameters")), 400
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "wrong session id"
-            }), 401
-
-        user_id = session[0]
+            return wrong_session()
 
-        # Check if friend exists
-        sql = "SELECT uuid FROM users WHERE uuid = %s"
-        values = (friend_id,)
-        cursor.execute(sql, values)
+        cursor.execute(queries.USER_EXISTS, (friend_id,))
         friend = cursor.fetchone()
 
         if not friend or not friend[0]:
             cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "friend does not exist"
-            }), 400
-
-        # Get user's friend list
-        sql = "SELECT friends FROM users WHERE uuid = %s FOR UPDATE"
-        values = (user_id,)
-        cursor.execute(sql, values)
+            return respond(responses.fail("friend does not exist")), 400
+
+        cursor.execute(queries.FRIENDS_FOR_UPDATE, (user_id,))
         user = cursor.fetchone()
 
         if not user:
             cursor.close()
-            return jsonify({
-                "error": "failed to fetch user from database"
-            }), 500
+            return respond({"error": "failed to fetch user from database"}), 500
 
-        str_friends_list = user[0].strip("\{\}")
-        friends_list = str_friends_list.split(',')
+        # psycopg2 returns uuid[] as its text form
+        friends_list = [friend for friend in user[0].strip("{}").split(',') if friend]
         if friend_id in friends_list:
             cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "user is already your friend"
-            }), 400
-
-
-        # Add friend to user's friend list
-        if friends_list[0]:
-            friends_list.append(friend_id)
-        else:
-            friends_list = [friend_id]
+            return respond(responses.fail("user is already your friend")), 400
 
-        sql = "UPDATE users SET friends = %s::uuid[] WHERE uuid = %s"
-        values = (friends_list, user_id)
-        cursor.execute(sql, values)
+        friends_list.append(friend_id)
+        cursor.execute(queries.SET_FRIENDS, (friends_list, user_id))
         conn.commit()
         cursor.close()
 
-        return jsonify({"type": "success"}), 200
+        return respond({"type": "success"}), 200
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/remove_friend', methods=['POST'])
 @cross_origin()
 def remove_friend():
-    session_id = request.json['session_id']
-    friend_id = request.json['user_id']
+    session_id = get_request_data()['session_id']
+    friend_id = get_request_data()['user_id']
 
     if not session_id or not friend_id:
-        return jsonify({"type": "fail", "reason": "missing parameters"}), 400
+        return respond(responses.fail("missing parameters")), 400
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "wrong session id"
-            }), 401
-
-        user_id = session[0]
+            return wrong_session()
 
-        # Get user's friend list
-        sql = "SELECT friends FROM users WHERE uuid = %s FOR UPDATE"
-        values = (user_id,)
-        cursor.execute(sql, values)
+        cursor.execute(queries.FRIENDS_FOR_UPDATE, (user_id,))
         user = cursor.fetchone()
 
         if not user:
             cursor.close()
-            return jsonify({"error": "unknown db error"}), 500
+            return respond({"error": "unknown db error"}), 500
 
-        str_friends_list = user[0].strip("\{\}")
-        friends_list = str_friends_list.split(',')
+        friends_list = [friend for friend in user[0].strip("{}").split(',') if friend]
         if friend_id not in friends_list:
             cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "user is not your friend"
-            }), 400
+            return respond(responses.fail("user is not your friend")), 400
 
-
-        # Remove friend from user's friend list
-        if friends_list[0]:
-            friends_list.remove(friend_id)
-        else:
-            friends_list = []
-
-        sql = "UPDATE users SET friends = %s::uuid[] WHERE uuid = %s"
-        values = (friends_list, user_id)
-        cursor.execute(sql, values)
+        friends_list.remove(friend_id)
+        cursor.execute(queries.SET_FRIENDS, (friends_list, user_id))
         conn.commit()
         cursor.close()
 
-        return jsonify({"type": "success"}), 200
+        return respond({"type": "success"}), 200
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/get_friends', methods=['POST'])
 @cross_origin()
 def get_friends():
-    session_id = request.json['session_id']
+    session_id = get_request_data()['session_id']
 
     if not session_id:
-        return jsonify({"type": "fail", "reason": "missing session id"}), 400
-    try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
+        return respond(responses.fail("missing session id")), 400
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-
-        if not session:
-            cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "wrong session id"
-            }), 401
-
-        user_id = session[0]
-
-        # Get user's friend list
-        sql = "SELECT friends FROM users WHERE uuid = %s"
-        values = (user_id,)
-        cursor.execute(sql, values)
-        user = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not user:
+        if not user_id:
             cursor.close()
-            return jsonify({"error": "unknown db error"}), 500
-
-        # Convert string array to a string like this: "'val1','val2','val3'"
-        str_friends_list = str(user[0].strip("\{\}").split(',')).strip("[]")
-
-        if str_friends_list == "''":
-            return jsonify({
-                "type": "success",
-                "friends": []
-            }), 200
+            return wrong_session()
 
-        sql = f"SELECT uuid, username, avatar FROM users WHERE uuid IN ({str_friends_list})"
-        cursor.execute(sql)
+        cursor.execute(queries.FRIENDS, (user_id,))
         friends = cursor.fetchall()
         cursor.close()
 
-        data = []
-        for friend in friends:
-            data.append({
-                "id": friend[0],
-                "username": friend[1],
-                "avatar": friend[2]
-            })
-
-        return jsonify({
-            "type": "success",
-            "friends": data
-        }), 200
+        return respond({"type": "success", "friends": responses.users(friends)}), 200
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/search_users', methods=['POST'])
 @cross_origin()
 def search_users():
-    session_id = request.json['session_id']
-    query = request.json['query']
+    session_id = get_request_data()['session_id']
+    query = get_request_data()['query']
 
     if not session_id or not query:
-        return jsonify({"type": "fail", "reason": "missing parameters"}), 400
+        return respond(responses.fail("missing parameters")), 400
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "wrong session id"
-            }), 401
-
-        user_id = session[0]
+            return wrong_session()
 
-        sql = "SELECT uuid, username, avatar FROM users WHERE username ~* %s AND uuid != %s::uuid"
-        values = (query, user_id)
-        cursor.execute(sql, values)
-        friends = cursor.fetchall()
+        cursor.execute(queries.SEARCH_USERS, (query, user_id))
+        users = cursor.fetchall()
         cursor.close()
 
-        data = []
-        for friend in friends:
-            data.append({
-                "id": friend[0],
-                "username": friend[1],
-                "avatar": friend[2]
-            })
-
-        return jsonify({
-            "type": "success",
-            "users": data
-        }), 200
+        return respond({"type": "success", "users": responses.users(users)}), 200
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/user_info', methods=['POST'])
 @cross_origin()
 def user_info():
-    session_id = request.json['session_id']
-    friend_id = request.json['user_id']
-    
+    session_id = get_request_data()['session_id']
+    friend_id = get_request_data()['user_id']
+
     if not session_id or not friend_id:
-        return jsonify({"type": "fail", "reason": "missing parameters"}), 400
+        return respond(responses.fail("missing parameters")), 400
 
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-
-        if not session:
+        if not get_session_user(cursor, session_id):
             cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
+            return wrong_session()
 
-        sql = "SELECT username, avatar, xp, statistics FROM users WHERE uuid = %s"
-        values = (friend_id, )
-        cursor.execute(sql, values)
+        cursor.execute(queries.USER_PROFILE, (friend_id,))
         user = cursor.fetchone()
         cursor.close()
 
         if not user:
-            return jsonify({"type": "fail", "reason": "user doesn't exist"}), 400
-        
-        return jsonify({
-            "type": "success",
-            "username": user[0],
-            "avatar": user[1],
-            "xp": user[2],
-            "statistics": json.loads(sanitize_database_output(user[3]))
-        }), 200
+            return respond(responses.fail("user doesn't exist")), 400
+        return respond(responses.statistics(user)), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
+
+
+@app.route('/users_info', methods=['POST'])
+@cross_origin()
+def users_info():
+    session_id = get_request_data()['session_id']
+    user_ids = get_request_data()['user_ids']
+
+    if not session_id or not isinstance(user_ids, list):
+        return respond(responses.fail("missing parameters")), 400
+    user_ids, reason = responses.users_info_ids(user_ids)
+    if reason:
+        return respond(responses.fail(reason)), 400
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(queries.USERS_PROFILES, {**session_params(cursor, session_id), 'user_ids': user_ids})
+        rows = cursor.fetchall()
+        cursor.close()
+
+        if not rows:
+            return wrong_session()
+        return respond(responses.users_info(rows)), 200
+    except Exception as e:
+        return respond({"error": str(e)}), 500
 
 
 # SHOP ENDPOINTS
 # general
-@app.route('/get_balance', methods=['POST'])
+def fetch_user_fields(session_id, fields):
+    """(found_session, row) for a SELECT of fields on the session's user.
+    Concurrent calls for the same session and fields share one fetch"""
+    def fetch():
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            user_id = get_session_user(cursor, session_id)
+            if not user_id:
+                return False, None
+
+            cursor.execute(queries.USER_FIELDS.format(fields=fields), (user_id,))
+            return True, cursor.fetchone()
+        finally:
+            cursor.close()
+
+    return reads.do(session_id, fields, fetch)
+
+@app.route('/me', methods=['POST'])
 @cross_origin()
-def get_balance():
-    session_id = request.json['session_id']
+def me():
+    session_id = get_request_data()['session_id']
+    fields = responses.profile_fields(get_request_data().get('fields'))
 
     if not session_id:
-        return jsonify({"type": "fail", "reason": "missing session id"}), 400
+        return respond(responses.fail("not logged in")), 400
+    if fields is None:
+        return respond(responses.fail("unknown field")), 400
 
-    try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
+    columns = responses.profile_columns(fields)
+
+    def fetch():
+        conn = get_connection()
         cursor = conn.cursor()
+        try:
+            cursor.execute(queries.SESSION_USER_FIELDS.format(fields=columns), session_params(cursor, session_id))
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
     try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user = reads.do(session_id, columns, fetch)
+        if not user:
+            return wrong_session()
+        return respond(responses.profile(fields, user)), 200
+    except Exception as e:
+        return respond({"error": str(e)}), 500
 
-        if not session:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
+@app.route('/get_balance', methods=['POST'])
+@cross_origin()
+def get_balance():
+    session_id = get_request_data()['session_id']
 
-        user_id = session[0]
-        sql = "SELECT coins, gems FROM users WHERE uuid = %s"
-        values = (user_id, )
-        cursor.execute(sql, values)
-        user = cursor.fetchone()
-        cursor.close()
+    if not session_id:
+        return respond(responses.fail("missing session id")), 400
 
+    try:
+        found, user = fetch_user_fields(session_id, "coins, gems")
+        if not found:
+            return wrong_session()
         if not user:
-            return jsonify({"type": "fail", "reason": "wrong user id"}), 401
-        
-        return jsonify({
-            "type": "success",
-            "coins": user[0],
-            "gems": user[1]
-        }), 200
+            return respond(responses.fail("wrong user id")), 401
+        return respond({"type": "success", "coins": user[0], "gems": user[1]}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/get_xp', methods=['POST'])
 @cross_origin()
 def get_xp():
-    session_id = request.json['session_id']
+    session_id = get_request_data()['session_id']
 
     if not session_id:
-        return jsonify({"type": "fail", "reason": "missing session id"}), 400
+        return respond(responses.fail("missing session id")), 400
 
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-
-        if not session:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
-
-        user_id = session[0]
-        sql = "SELECT xp, bp_xp FROM users WHERE uuid = %s"
-        values = (user_id, )
-        cursor.execute(sql, values)
-        user = cursor.fetchone()
-        cursor.close()
-
+        found, user = fetch_user_fields(session_id, "xp, bp_xp")
+        if not found:
+            return wrong_session()
         if not user:
-            return jsonify({"type": "fail", "reason": "wrong user id"}), 404
-        
-        return jsonify({
-            "type": "success",
-            "xp": user[0],
-            "battlepass_xp": user[1]
-        }), 200
+            return respond(responses.fail("wrong user id")), 404
+        return respond({"type": "success", "xp": user[0], "battlepass_xp": user[1]}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 
 # skins
 @app.route('/get_all_skins')
 @cross_origin()
 def get_all_skins():
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT * FROM skins"
-        cursor.execute(sql)
+        cursor.execute(queries.SKINS)
         skins = cursor.fetchall()
         cursor.close()
-        
-        data = {}
-        for skin in skins:
-            skin_id = skin[0]
-            skin_name = skin[1]
-            price_coins = skin[2]
-            price_gems = skin[3]
-            
-            data[str(skin_id)] = {
-                'name': skin_name,
-                'price_coins': price_coins,
-                'price_gems': price_gems
-            }
-        return jsonify(data), 200
+        return respond(responses.skins(skins)), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/get_user_skins', methods=['POST'])
 @cross_origin()
 def get_user_skins():
-    session_id = request.json['session_id']
+    session_id = get_request_data()['session_id']
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-
-        if not session:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
-
-        user_id = session[0]
-        sql = "SELECT owned_skins FROM users WHERE uuid = %s"
-        values = (user_id,)
-        cursor.execute(sql, values)
-        user = cursor.fetchone()
-
+        found, user = fetch_user_fields(session_id, "owned_skins")
+        if not found:
+            return wrong_session()
         if not user:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong user id"}), 401
-        
-        user_skins = user[0]
-        return jsonify({"ids": user_skins}), 200
+            return respond(responses.fail("wrong user id")), 401
+        return respond({"ids": user[0]}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/buy_skin', methods=['POST'])
 @cross_origin()
 def buy_skin():
-    session_id = request.json['session_id']
-    skin_id = request.json['skin_id']
-    currency = request.json['currency']
+    session_id = get_request_data()['session_id']
+    skin_id = get_request_data()['skin_id']
+    currency = get_request_data()['currency']
 
     if not session_id or not skin_id or not currency:
-        return jsonify({"type": "fail", "reason": "missing parameters"}), 400
+        return respond(responses.fail("missing parameters")), 400
 
     if currency not in ['coins', 'gems']:
-        return jsonify({"type": "fail", "reason": "invalid currency"}), 400
+        return respond(responses.fail("invalid currency")), 400
 
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
+            return wrong_session()
 
-        user_id = session[0]
-        sql = f"SELECT {currency}, owned_skins FROM users WHERE uuid = %s FOR UPDATE"
-        values = (user_id,)
-        cursor.execute(sql, values)
+        cursor.execute(queries.SKIN_BALANCE.format(currency=currency), (user_id,))
         user = cursor.fetchone()
 
         if not user:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong user id"}), 401
+            return respond(responses.fail("wrong user id")), 401
 
         user_balance = user[0]
         user_skins = user[1] if user[1] else []
 
         if skin_id in user_skins:
             cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "skin already owned"
-            }), 400
-
-        sql = f"SELECT price_{currency} FROM skins WHERE sid = %s"
-        values = (skin_id, )
-        cursor.execute(sql, values)
+            return respond(responses.fail("skin already owned")), 400
+
+        cursor.execute(queries.SKIN_PRICE.format(currency=currency), (skin_id,))
         skin = cursor.fetchone()
 
         if not skin:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong skin id"}), 401
+            return respond(responses.fail("wrong skin id")), 401
 
         skin_price = skin[0]
-
         if skin_price > user_balance:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "insufficient funds"}), 401
+            return respond(responses.fail("insufficient funds")), 401
 
         user_skins.append(skin_id)
-        sql = f"UPDATE users SET {currency} = {currency} - %s, owned_skins = %s WHERE uuid = %s"
-        values = (skin_price, user_skins, user_id)
-        cursor.execute(sql, values)
+        cursor.execute(queries.BUY_SKIN.format(currency=currency), (skin_price, user_skins, user_id))
         conn.commit()
+        reads.invalidate(session_id)
         cursor.close()
 
-        return jsonify({
+        return respond({
             "type": "success",
             "currency": currency,
             "new_balance": user_balance - skin_price
         }), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 
 # currency
 @app.route('/buy_gems', methods=['POST'])
 @cross_origin()
 def buy_gems():
-    session_id = request.json['session_id']
-    amount = request.json['gemsQuantity']
+    session_id = get_request_data()['session_id']
+    amount = get_request_data()['gemsQuantity']
 
     if not session_id or not amount:
-        return jsonify({"type": "fail", "reason": "missing parameters"}), 400
+        return respond(responses.fail("missing parameters")), 400
 
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
-
-        user_id = session[0]
-        sql = "WITH rows AS \
-               (UPDATE users SET gems = gems + %s WHERE uuid = %s RETURNING gems) \
-               SELECT gems FROM rows"
-        values = (amount, user_id)
-        cursor.execute(sql, values)
-        conn.commit()
+            return wrong_session()
+
+        cursor.execute(queries.ADD_GEMS, (amount, user_id))
         gems = cursor.fetchone()[0]
+        conn.commit()
+        reads.invalidate(session_id)
         cursor.close()
 
-        return jsonify({
-            "type": "success",
-            "new_balance": gems
-        }), 200
+        return respond({"type": "success", "new_balance": gems}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 
 # battlepass
 @app.route('/buy_battlepass', methods=['POST'])
 @cross_origin()
 def buy_battlepass():
-    session_id = request.json['session_id']
+    session_id = get_request_data()['session_id']
     battlepass_cost = 950
 
     if not session_id:
-        return jsonify({"type": "fail", "reason": "not logged in"}), 400
+        return respond(responses.fail("not logged in")), 400
 
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
+            return wrong_session()
 
-        user_id = session[0]
-        sql = "SELECT gems FROM users WHERE uuid = %s FOR UPDATE"
-        values = (user_id, )
-        cursor.execute(sql, values)
+        cursor.execute(queries.BATTLEPASS_USER, (user_id,))
         user = cursor.fetchone()
-        
+
         if not user:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "unknown user error"}), 400
-        
-        gems = user[0]
+            return respond(responses.fail("unknown user error")), 400
+
+        gems, battlepass_xp, booster_count, owned_avatars, owned_skins = user
         if gems < battlepass_cost:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "not enough gems"}), 401
-
-        sql = "UPDATE users SET gems = gems - %s, owns_battlepass = %s WHERE uuid = %s"
-        values = (battlepass_cost, True, user_id)
-        cursor.execute(sql, values)
-        conn.commit()
+            return respond(responses.fail("not enough gems")), 401
 
         # Add items from battlepass
-        sql = "SELECT gems, bp_xp, booster_count, owned_avatars, owned_skins \
-               FROM users WHERE uuid = %s FOR UPDATE"
-        values = (user_id, )
-        cursor.execute(sql, values)
-        user = cursor.fetchone()
-
-        gems = user[0]
-        battlepass_xp = user[1]
-        booster_count = user[2]
-        owned_avatars = user[3]
-        owned_skins = user[4]
-
-        battlepass_lvl = get_battlepass_lvl(battlepass_xp)
-        for tier in range(1, battlepass_lvl+1):
-            item = battlepass_rewards[str(tier)]
-            if item['type'] == "booster":
-                booster_count += item['count']
-                continue
-            if item['type'] == "avatar":
-                owned_avatars.append(item['id'])
-                continue
-            if item['type'] == "skin":
-                owned_skins.append(item['id'])
-                continue
-        
-        sql = "UPDATE users \
-               SET booster_count = %s, owned_avatars = %s, owned_skins = %s \
-               WHERE uuid = %s"
-        values = (booster_count, owned_avatars, owned_skins, user_id)
-        cursor.execute(sql, values)
+        booster_count, owned_avatars, owned_skins = responses.add_battlepass_items(
+            range(1, get_battlepass_lvl(battlepass_xp)+1),
+            booster_count, owned_avatars, owned_skins
+        )
+        values = (battlepass_cost, True, booster_count, owned_avatars, owned_skins, user_id)
+        cursor.execute(queries.BUY_BATTLEPASS, values)
+        gems = cursor.fetchone()[0]
         conn.commit()
+        reads.invalidate(session_id)
         cursor.close()
 
-        return jsonify({
-            "type": "success",
-            "new_balance": gems
-        }), 200
+        return respond({"type": "success", "new_balance": gems}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/battlepass_status', methods=['POST'])
 @cross_origin()
 def battlepass_status():
-    session_id = request.json['session_id']
+    session_id = get_request_data()['session_id']
 
     if not session_id:
-        return jsonify({"type": "fail", "reason": "not logged in"}), 400
+        return respond(responses.fail("not logged in")), 400
 
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-
-        if not session:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
-
-        user_id = session[0]
-        sql = "SELECT owns_battlepass FROM users WHERE uuid = %s"
-        values = (user_id, )
-        cursor.execute(sql, values)
-        user = cursor.fetchone()
-        cursor.close()
-        
+        found, user = fetch_user_fields(session_id, "owns_battlepass")
+        if not found:
+            return wrong_session()
         if not user:
-            return jsonify({"type": "fail", "reason": "unknown user error"}), 400
-        
-        owns_battlepass = "true" if user[0] else "false"
-        return jsonify({
-            "type": "success",
-            "owned": owns_battlepass
-        }), 200
+            return respond(responses.fail("unknown user error")), 400
+        return respond({"type": "success", "owned": "true" if user[0] else "false"}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 
 # boosters
 @app.route('/get_booster_count', methods=['POST'])
 @cross_origin()
 def get_booster_count():
-    session_id = request.json['session_id']
-    
+    session_id = get_request_data()['session_id']
+
     if not session_id:
-        return jsonify({"type": "fail", "reason": "not logged in"}), 400
+        return respond(responses.fail("not logged in")), 400
 
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-
-        if not session:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
-
-        user_id = session[0]
-        sql = "SELECT booster_count FROM users WHERE uuid = %s"
-        values = (user_id, )
-        cursor.execute(sql, values)
-        user = cursor.fetchone()
-        
+        found, user = fetch_user_fields(session_id, "booster_count")
+        if not found:
+            return wrong_session()
         if not user:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "unknown user error"}), 400
-        
-        booster_count = user[0]
-        return jsonify({
-            "type": "success",
-            "booster_count": booster_count
-        }), 200
+            return respond(responses.fail("unknown user error")), 400
+        return respond({"type": "success", "booster_count": user[0]}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/buy_booster', methods=['POST'])
 @cross_origin()
 def buy_booster():
-    session_id = request.json['session_id']
-    currency = request.json['currency']
-    
+    session_id = get_request_data()['session_id']
+    currency = get_request_data()['currency']
+
     if not session_id or not currency:
-        return jsonify({"type": "fail", "reason": "missing parameters"}), 400
-    
+        return respond(responses.fail("missing parameters")), 400
+
     if currency == "coins":
         booster_cost = 200
     elif currency == "gems":
         booster_cost = 50
     else:
-        return jsonify({"type": "fail", "reason": "wrong currency"}), 400
+        return respond(responses.fail("wrong currency")), 400
 
-
-    try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
+            return wrong_session()
 
-        user_id = session[0]
-        sql = f"SELECT {currency} FROM users WHERE uuid = %s FOR UPDATE"
-        values = (user_id, )
-        cursor.execute(sql, values)
+        cursor.execute(queries.BALANCE_FOR_UPDATE.format(currency=currency), (user_id,))
         user = cursor.fetchone()
-        
+
         if not user:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "unknown user error"}), 400
-        
+            return respond(responses.fail("unknown user error")), 400
+
         balance = user[0]
         if balance < booster_cost:
             cursor.close()
-            return jsonify({"type": "fail", "reason": f"not enough {currency}"}), 401
-
-        sql = f"WITH rows AS \
-                (UPDATE users SET {currency} = {currency} - %s, booster_count = booster_count + %s WHERE uuid = %s RETURNING booster_count)\
-                SELECT booster_count FROM rows"
-        values = (booster_cost, 1, user_id)
-        cursor.execute(sql, values)
-        conn.commit()
+            return respond(responses.fail(f"not enough {currency}")), 401
 
+        cursor.execute(queries.BUY_BOOSTER.format(currency=currency), (booster_cost, 1, user_id))
         booster_count = cursor.fetchone()[0]
-        balance -= booster_cost
-
+        conn.commit()
+        reads.invalidate(session_id)
         cursor.close()
 
-        return jsonify({
+        return respond({
             "type": "success",
-            "new_balance": balance,
+            "new_balance": balance - booster_cost,
             "currency": currency,
             "booster_count": booster_count
         }), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 
 # avatars
 @app.route('/set_avatar', methods=['POST'])
 @cross_origin()
 def set_avatar():
-    session_id = request.json['session_id']
-    avatar_id = request.json['avatar_id']
-    
+    session_id = get_request_data()['session_id']
+    avatar_id = get_request_data()['avatar_id']
+
     if not session_id or not avatar_id:
-        return jsonify({"type": "fail", "reason": "missing parameters"}), 400
+        return respond(responses.fail("missing parameters")), 400
 
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
+        user_id = get_session_user(cursor, session_id)
 
-        if not session:
+        if not user_id:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
+            return wrong_session()
 
-        user_id = session[0]
-        sql = f"SELECT owned_avatars FROM users WHERE uuid = %s FOR UPDATE"
-        values = (user_id, )
-        cursor.execute(sql, values)
+        cursor.execute(queries.AVATARS_FOR_UPDATE, (user_id,))
         user = cursor.fetchone()
-        
+
         if not user:
             cursor.close()
-            return jsonify({"type": "fail", "reason": "unknown user error"}), 400
-        
-        owned_avatars = list(user[0])
-        if avatar_id not in owned_avatars:
+            return respond(responses.fail("unknown user error")), 400
+
+        if avatar_id not in list(user[0]):
             cursor.close()
-            return jsonify({"type": "fail", "reason": f"user doesn't own avatar with id {avatar_id}"}), 401
+            return respond(responses.fail(f"user doesn't own avatar with id {avatar_id}")), 401
 
-        sql = f"UPDATE users SET avatar = %s WHERE uuid = %s"
-        values = (avatar_id, user_id)
-        cursor.execute(sql, values)
+        cursor.execute(queries.SET_AVATAR, (avatar_id, user_id))
         conn.commit()
+        reads.invalidate(session_id)
         cursor.close()
 
-        return jsonify({"type": "success"}), 200
+        return respond({"type": "success"}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/get_avatar', methods=['POST'])
 @cross_origin()
 def get_avatar():
-    session_id = request.json['session_id']
-    
+    session_id = get_request_data()['session_id']
+
     if not session_id:
-        return jsonify({"type": "fail", "reason": "not logged in"}), 400
+        return respond(responses.fail("not logged in")), 400
 
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-
-        if not session:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
-
-        user_id = session[0]
-        sql = f"SELECT avatar FROM users WHERE uuid = %s"
-        values = (user_id, )
-        cursor.execute(sql, values)
-        user = cursor.fetchone()
-        cursor.close()
-
+        found, user = fetch_user_fields(session_id, "avatar")
+        if not found:
+            return wrong_session()
         if not user:
-            return jsonify({"type": "fail", "reason": "unknown user error"}), 400
-        
-        avatar_id = user[0]
-        return jsonify({
-            "type": "success",
-            "avatar_id": avatar_id
-        }), 200
+            return respond(responses.fail("unknown user error")), 400
+        return respond({"type": "success", "avatar_id": user[0]}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/get_user_avatars', methods=['POST'])
 @cross_origin()
 def get_user_avatars():
-    session_id = request.json['session_id']
-    
+    session_id = get_request_data()['session_id']
+
     if not session_id:
-        return jsonify({"type": "fail", "reason": "not logged in"}), 400
+        return respond(responses.fail("not logged in")), 400
 
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-
-        if not session:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
-
-        user_id = session[0]
-        sql = f"SELECT owned_avatars FROM users WHERE uuid = %s"
-        values = (user_id, )
-        cursor.execute(sql, values)
-        user = cursor.fetchone()
-        cursor.close()
-
+        found, user = fetch_user_fields(session_id, "owned_avatars")
+        if not found:
+            return wrong_session()
         if not user:
-            return jsonify({"type": "fail", "reason": "unknown user error"}), 400
-        
-        owned_avatars = user[0]
-        return jsonify({
-            "type": "success",
-            "owned_avatars": owned_avatars
-        }), 200
+            return respond(responses.fail("unknown user error")), 400
+        return respond({"type": "success", "owned_avatars": user[0]}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 
 # GAME ENDPOINTS
+def play_click(conn, cursor, session_id, tile_id):
+    """Play one click against the stored game, returning (response, status)"""
+    # Read without locks, the click is then saved with one statement and a
+    # single commit, only if the game is still at this version
+    values = session_params(cursor, session_id)
+    # Games are keyed by the session id, or a token's own id
+    game_id = values['session_id']
+    cursor.execute(queries.CLICK_GAME, values)
+    session = cursor.fetchone()
+
+    if not session:
+        return wrong_session()
+
+    user_id, owns_battlepass, battlepass_xp, game_raw, stored_start, version = session
+    if game_raw is None:
+        conn.rollback()
+        return respond(responses.fail("game not found")), 404
+
+    game_data = load_game_data(responses.sanitize_database_output(game_raw))
+    # apply_click generates the board on the first click, around the clicked tile
+    outcome = apply_click(game_data, tile_id)
+    timer_started = game_data['timer_started']
+    start_time = stored_start if timer_started else -1
+    game_data['timer_started'] = True
+
+    def save_click(statistics=None, delete_game=False, rewards=None):
+        """Write the click's game and user changes with one statement and commit.
+        Clicks that change nothing (failed clicks after the timer started) write nothing.
+        Raises GameConflict when another click changed the game (or the battlepass
+        xp the rewards were based on) since it was read"""
+        if statistics is None and timer_started:
+            conn.rollback()
+            return None
+        cursor.execute(*queries.save_click(
+            game_id, user_id, game_data, version, statistics, delete_game,
+            rewards, battlepass_xp if rewards else None
+        ))
+        row = cursor.fetchone()
+        if row is None:
+            conn.rollback()
+            raise queries.GameConflict
+        conn.commit()
+        if rewards:
+            reads.invalidate(session_id)
+        return row
+
+    if outcome in responses.CLICK_FAILURES:
+        save_click()
+        body, status = responses.click_failure(outcome, game_data)
+        return respond(body), status
+
+    record_click(game_data, tile_id)
+    if outcome == 'loss':
+        # Add statistics and delete the game
+        miliseconds_played = responses.miliseconds_played(start_time)
+        save_click(
+            {'tiles_clicked': 1, 'played': 1, 'won': 0, 'miliseconds_played': miliseconds_played},
+            delete_game=True
+        )
+        results.record(user_id, game_data, False, miliseconds_played)
+        return respond(responses.click_loss(game_data, miliseconds_played)), 200
+
+    if outcome == 'win':
+        # XP, coins, battlepass items and statistics in the same statement as the game delete
+        miliseconds_played = responses.miliseconds_played(start_time)
+        rewards = win_rewards(game_data, owns_battlepass, battlepass_xp)
+        user = save_click(
+            {'tiles_clicked': 1, 'played': 1, 'won': 1, 'miliseconds_played': miliseconds_played},
+            delete_game=True,
+            rewards=rewards
+        )
+        results.record(user_id, game_data, True, miliseconds_played)
+        return respond(responses.click_win(game_data, user[:3], rewards, miliseconds_played)), 200
+
+    # Update statistics and game state in database
+    save_click({'tiles_clicked': 1, 'played': 0, 'won': 0, 'miliseconds_played': 0})
+    return respond(responses.click_playing(game_data, start_time)), 200
+
+
 @app.route('/click_tile', methods=['POST'])
 @cross_origin()
 def click_tile():
-    print(request.json)
-    session_id = request.json['session_id']
-    tile_id = request.json['tile_id']
+    session_id = get_request_data()['session_id']
+    tile_id = get_request_data()['tile_id']
+    logger.debug("tile clicked", extra={"tile_id": tile_id, "sample": True})
 
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-    
-        if not session:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
-
-        user_id = session[0]
-        sql = "SELECT statistics FROM users WHERE uuid = %s FOR UPDATE"
-        values = (user_id,)
-        cursor.execute(sql, values)
-        user_stats = cursor.fetchone()
-
-        if not user_stats:
-            cursor.close()
-            return jsonify({"error": "unknown db error"}), 500
-
-        statistics = json.loads(sanitize_database_output(user_stats[0]))
-        statistics['tiles_clicked'] += 1
-        
-        sql = "SELECT data, extract(epoch from start_time)::integer FROM games WHERE game_id = %s"
-        values = (session_id,)
-        cursor.execute(sql, values)
-        game = cursor.fetchone()
-    
-        if not game:
-            return jsonify({"type": "fail", "reason": "game not found"}), 404
-
-        def delete_game_from_database(session_id):
-            print(f"Deleting game from database for session {session_id}")
-            cursor = conn.cursor()
-            sql = "DELETE FROM games WHERE game_id = %s"
-            values = (session_id,)
-            cursor.execute(sql, values)
-            conn.commit()
-            cursor.close()
-            return
-
-        game_data = json.loads(sanitize_database_output(game[0]))
-        timer_started = game_data['timer_started']
-        start_time = game[1] if timer_started else -1
-        if not timer_started:
-            game_data['timer_started'] = True
-            timer_started = True
-            sql = "UPDATE games SET data = %s, start_time = NOW() WHERE game_id = %s"
-            values = (json.dumps(game_data), session_id)
-            cursor.execute(sql, values)
-            conn.commit()
-        
-        tiles = game_data['tiles']
-        
-        # id not found
-        if tile_id not in tiles:
-            cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "tile not found",
-                "board": sanitize_game_data(game_data)
-            }), 404
-
-        # Already clicked (not hidden)
-        if not tiles[tile_id]['hidden']:
-            cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "tile already clicked",
-                "board": sanitize_game_data(game_data)
-            }), 400
-
-        # Loss condition
-        if tiles[tile_id]['value'] == 9:
-            # Add statistics
-            statistics['games_played'] += 1
-            miliseconds_played = int((time() - start_time)*100) if start_time != -1 else -1
-            statistics['miliseconds_played'] += miliseconds_played
-
-            sql = "UPDATE users SET statistics = %s WHERE uuid = %s"
-            values = (json.dumps(statistics), user_id)
-            cursor.execute(sql, values)
-            conn.commit()
-
-            # Delete game from database in another thread
-            thread = Thread(
-                target=delete_game_from_database, 
-                kwargs={'session_id': session_id}
-            )
-            thread.start()
-
-            tiles[tile_id]['value'] = 10 # Blow up mine visually
-            tiles[tile_id]['hidden'] = False
-            game_data['tiles'] = tiles
-            return jsonify({
-                "type": "loss", 
-                "board": uncover_all_tiles(game_data),
-                "miliseconds_played": miliseconds_played
-            }), 200
-
-        # Uncover tiles, because a number tile got clicked
-        if tiles[tile_id]['value'] in range(1, 9):
-            tiles[tile_id]['hidden'] = False
-        elif tiles[tile_id]['value'] == 0:
-            tiles = uncover_tiles(tiles, game_data['size_x'], game_data['size_y'], tile_id)
-        else:
-            cursor.close()
-            return jsonify({
-                "type": "fail", 
-                "reason": "unknown tile value",
-                "board": sanitize_game_data(game_data)
-            }), 400
-
-        game_data['tiles'] = tiles
-        
-        # Win condition
-        if count_hidden_tiles(tiles) == game_data['mine_count']:
-            sql = "SELECT owns_battlepass, statistics FROM users WHERE uuid = %s FOR UPDATE"
-            values = (user_id, )
-            cursor.execute(sql, values)
-            user = cursor.fetchone()
-
-            if not user:
-                cursor.close()
-                return jsonify({"error": "unknown db error"}), 500
-            
-            # Add statistics
-            statistics['games_won'] += 1
-            statistics['games_played'] += 1
-            miliseconds_played = int((time() - start_time)*100) if start_time != -1 else -1
-            statistics['miliseconds_played'] += miliseconds_played
-
-            # If battlepass active, add multiplier
-            bp_multiplier = 0
-            owns_battlepass = user[0]
-            if owns_battlepass:
-                bp_multiplier = 0.25
-
-            # If booster active, add multiplier
-            boost_multiplier = 0
-            if game_data['booster_active']:
-                boost_multiplier = 0.25
-
-            # Calculate XP
-            base_xp = calculate_xp(
-                game_data['mine_count'], 
-                game_data['size_x'] * game_data['size_y']
-            )
-
-            added_coins = int(base_xp * (1 + boost_multiplier))
-            added_xp = int(base_xp * (1 + boost_multiplier))
-            added_battlepass_xp = int(base_xp * (1 + boost_multiplier + bp_multiplier))
-
-            # Add XP, Battlepass XP and coins
-            sql = "WITH row AS ( \
-                     UPDATE users \
-                     SET coins = coins+%s, xp = xp+%s, bp_xp = bp_xp+%s, statistics = %s \
-                     WHERE uuid = %s \
-                     RETURNING xp, bp_xp, coins \
-                   ) SELECT xp, bp_xp, coins FROM row"
-            values = (added_coins, added_xp, added_battlepass_xp, json.dumps(statistics), user_id)
-            cursor.execute(sql, values)
-            conn.commit()
-            user = cursor.fetchone()
-
-            user_xp = user[0]
-            user_battlepass_xp = user[1]
-            user_coins = user[2]
-
-            # If battlepass lvl changed, give rewards
-            old_battlepass_lvl = get_battlepass_lvl(user_battlepass_xp - added_battlepass_xp)
-            new_battlepass_lvl = get_battlepass_lvl(user_battlepass_xp)
-            bp_reward = "false"
-            if new_battlepass_lvl > old_battlepass_lvl:
-                bp_reward = "true"
-                if owns_battlepass:
-                    sql = "SELECT booster_count, owned_avatars, owned_skins \
-                        FROM users WHERE uuid = %s FOR UPDATE"
-                    values = (user_id, )
-                    cursor.execute(sql, values)
-                    user = cursor.fetchone()
-
-                    booster_count = user[0]
-                    owned_avatars = user[1]
-                    owned_skins = user[2]
-
-                    for tier in range(max(old_battlepass_lvl, 1), new_battlepass_lvl+1):
-                        item = battlepass_rewards[str(tier)]
-                        if item['type'] == "booster":
-                            booster_count += item['count']
-                            continue
-                        if item['type'] == "avatar":
-                            owned_avatars.append(item['id'])
-                            continue
-                        if item['type'] == "skin":
-                            owned_skins.append(item['id'])
-                            continue
-                    
-                    sql = "UPDATE users \
-                        SET booster_count = %s, owned_avatars = %s, owned_skins = %s \
-                        WHERE uuid = %s"
-                    values = (booster_count, owned_avatars, owned_skins, user_id)
-                    cursor.execute(sql, values)
-                    conn.commit()
-
+        # Double clicks land here: the loser replays against the winner's board
+        for attempt in range(queries.CLICK_RETRIES + 1):
+            try:
+                result = play_click(conn, cursor, session_id, tile_id)
+            except queries.GameConflict:
+                metrics.click_conflicts.inc('retried' if attempt < queries.CLICK_RETRIES else 'failed')
+                continue
             cursor.close()
-
-            # Delete game from database in another thread
-            thread = Thread(
-                target=delete_game_from_database, 
-                kwargs={'session_id': session_id}
-            )
-            thread.start()
-
-            board = sanitize_game_data(game_data)
-            result = jsonify({
-                "type": "win", 
-                "board": board,
-                "xp": user_xp,
-                "added_xp": added_xp,
-                "coins": user_coins,
-                "added_coins": added_coins,
-                "battlepass_xp": user_battlepass_xp,
-                "added_battlepass_xp": added_battlepass_xp,
-                "battlepass_reward": bp_reward,
-                "miliseconds_played": miliseconds_played
-            })
-            return result, 200
-
-        # Update statistics
-        sql = "UPDATE users SET statistics = %s WHERE uuid = %s"
-        values = (json.dumps(statistics), user_id)
-        cursor.execute(sql, values)
-        conn.commit()
-
-        # Update game state in database
-        sql = "UPDATE games SET data = %s WHERE game_id = %s"
-        values = (json.dumps(game_data), session_id)
-        cursor.execute(sql, values)
-        conn.commit()
+            return result
         cursor.close()
-        
-        result = {
-            "type": "playing",
-            "board": sanitize_game_data(game_data)
-        }
-        if start_time:
-            result['start_time'] = start_time
-        return jsonify(result), 200
+        return respond(responses.fail("concurrent update")), 409
     except Exception as e:
         cursor.close()
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
 
 @app.route('/create_game', methods=['POST'])
 @cross_origin()
 def create_game():
-    # [session_id, size_x, size_y, mine_count, booster_used]
-    session_id = request.json['session_id']
-    size_x = request.json['size_x']
-    size_y = request.json['size_y']
-    difficulty = str(request.json['difficulty'])
-    booster_used = request.json['booster_used']
-
-    if not session_id or not size_x or not size_y or not difficulty or booster_used is None:
-        return jsonify({"type": "fail", "reason": "missing parameters"}), 400
-
-    booster_used = bool(int(booster_used) == 1)
-    difficulty_list = {
-        '1': 0.1,
-        '2': 0.15,
-        '3': 0.2,
-        '4': 0.35
-    }
-    mine_count = ceil(difficulty_list[difficulty] * size_x * size_y)
+    data = get_request_data()
+    session_id = data['session_id']
+    game_data = responses.new_game(data)
 
-    try:
-        cursor = conn.cursor()
-    except:
-        conn = connect()
-        cursor = conn.cursor()
-    try:
-        sql = "SELECT user_id FROM sessions WHERE session_id = %s"
-        values = (session_id, )
-        cursor.execute(sql, values)
-        session = cursor.fetchone()
-    
-        if not session:
-            cursor.close()
-            return jsonify({"type": "fail", "reason": "wrong session id"}), 401
-    
-        user_id = session[0]
-
-        sql = "SELECT data FROM games WHERE game_id = %s"
-        values = (session_id, )
-        cursor.execute(sql, values)
-        game = cursor.fetchone()
-    
-        # Delete old game if left in database
-        if game:
-            sql = "DELETE FROM games WHERE game_id = %s"
-            values = (session_id, )
-            cursor.execute(sql, values)
-            conn.commit()
-            print(f"deleted old game for session {session_id}")
-    
-        # Remove booster from user if used
-        if booster_used:
-            sql = "SELECT booster_count FROM users WHERE uuid = %s"
-            values = (user_id, )
-            cursor.execute(sql, values)
-            user = cursor.fetchone()
+    if not session_id or game_data is None:
+        return respond(responses.fail("missing parameters")), 400
+    booster_used = game_data['booster_active']
 
-            if not user:
-                cursor.close()
-                return jsonify({"type": "fail", "reason": "wrong user id"}), 401
-
-            booster_count = user[0]
-            if booster_count < 1:
-                cursor.close()
-                return jsonify({"type": "fail", "reason": "insufficient amount of boosters"}), 401
-
-            sql = "UPDATE users SET booster_count = %s WHERE uuid = %s"
-            values = (booster_count-1, user_id)
-            cursor.execute(sql, values)
-            conn.commit()
-
-        # Creating game data
-        game_board = create_game_board(size_x, size_y, mine_count)
-        game_data = {
-            'tiles': {
-                id: {'value': value, 'hidden': True} 
-                for id, value in enumerate(game_board)
-            },
-            'size_x': size_x,
-            'size_y': size_y,
-            'mine_count': mine_count,
-            'timer_started': False,
-            'booster_active': booster_used
-        }
-        sql = "INSERT INTO games (game_id, data) VALUES (%s, %s)"
-        values = (session_id, json.dumps(game_data))
-        cursor.execute(sql, values)
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        values = {**session_params(cursor, session_id), 'booster_used': booster_used, 'data': dump_game_data(game_data)}
+        cursor.execute(queries.CREATE_GAME, values)
+        session_found, game_created = cursor.fetchone()
         conn.commit()
+        if booster_used:
+            reads.invalidate(session_id)
         cursor.close()
-        
-        return jsonify({"type": "success"}), 200
+
+        if not session_found:
+            return wrong_session()
+        if not game_created:
+            return respond(responses.fail("insufficient amount of boosters")), 401
+        return respond({"type": "success"}), 200
     except Exception as e:
         cursor.close()
-        return jsonify({"error": str(e)}), 500
+        return respond({"error": str(e)}), 500
@@ -0,0 +1,246 @@
+"""End-to-end load test for the Sapper API against a disposable local database
+
+Boots an embedded Postgres (via the `pgserver` package, see
+loadtest/requirements.txt), loads loadtest/schema.sql, seeds synthetic
+users, serves index.py over HTTP and replays player sessions:
+
+    python loadtest/load_test.py --users 50 --sessions 200 --concurrency 16
+
+Pass --db-host (plus DB_USER and the other DB_* env vars) to use an existing
+throwaway database instead. Every table of the schema is dropped there first,
+so it also needs --i-know-this-drops-tables. Never point this at production.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import pbkdf2_hmac
+from time import perf_counter
+from urllib.parse import urlencode
+
+try:
+    import pgserver
+except ImportError:
+    pgserver = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'loadtest-password'
+
+
+class Stats:
+    """Thread-safe per-endpoint latency recorder"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def report(self, elapsed):
+        def percentile(values, p):
+            index = min(len(values) - 1, round(p / 100 * (len(values) - 1)))
+            return values[index]
+
+        endpoints = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            endpoints[endpoint] = {
+                'requests': len(values),
+                'errors': self.errors[endpoint],
+                'throughput_rps': len(values) / elapsed,
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000
+            }
+        total = sum(len(values) for values in self.latencies.values())
+        return {
+            'elapsed_s': elapsed,
+            'requests': total,
+            'throughput_rps': total / elapsed,
+            'endpoints': endpoints
+        }
+
+
+def start_database(data_dir):
+    if pgserver is None:
+        sys.exit("pgserver is not installed, run `pip install -r loadtest/requirements.txt` or pass --db-host")
+    server = pgserver.get_server(data_dir, cleanup_mode='stop')
+    os.environ['DB_HOST'] = data_dir
+    os.environ['DB_USER'] = 'postgres'
+    os.environ['DB_NAME'] = 'postgres'
+    os.environ.setdefault('DB_PASSWORD', '')
+    return server
+
+
+def seed_database(conn, user_count):
+    """Load the schema and insert user_count users sharing one password"""
+    cursor = conn.cursor()
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')) as f:
+        cursor.execute(f.read())
+
+    # Hash once, PBKDF2 per user would dominate the seeding time
+    from passwords import encoding, iterations
+    salt = os.urandom(64)
+    password_hash = pbkdf2_hmac(encoding, PASSWORD.encode('utf-8'), salt, iterations)
+
+    sql = "INSERT INTO users (email, username, password_hash, salt, coins, gems, booster_count) \
+           VALUES (%s, %s, right(%s::text, -1)::bit(512), right(%s::text, -1)::bit(512), %s, %s, %s)"
+    cursor.executemany(sql, [
+        (f"load{n}@example.com", f"load-{n}", password_hash, salt, 100000, 10000, 5)
+        for n in range(user_count)
+    ])
+    conn.commit()
+    cursor.close()
+    return [f"load{n}@example.com" for n in range(user_count)]
+
+
+class Client:
+    """Minimal HTTP client that times every call into Stats"""
+
+    def __init__(self, host, port, stats):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.stats = stats
+
+    def call(self, endpoint, payload, form=False):
+        if form:
+            body = urlencode(payload)
+            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        else:
+            body = json.dumps(payload)
+            headers = {'Content-Type': 'application/json'}
+
+        start = perf_counter()
+        self.connection.request('POST', endpoint, body, headers)
+        response = self.connection.getresponse()
+        data = response.read()
+        elapsed = perf_counter() - start
+
+        try:
+            data = json.loads(data)
+        except ValueError:
+            data = {}
+        ok = response.status < 500 and 'error' not in data
+        self.stats.record(endpoint, elapsed, ok)
+        return data
+
+    def close(self):
+        self.connection.close()
+
+
+def play_session(host, port, stats, email, args):
+    """login -> create_game -> click_tile until win/loss -> shop calls"""
+    client = Client(host, port, stats)
+    try:
+        login = client.call('/login', {'email': email, 'password': PASSWORD}, form=True)
+        session_id = login.get('session_id')
+        if not session_id:
+            return
+
+        client.call('/create_game', {
+            'session_id': session_id,
+            'size_x': args.size,
+            'size_y': args.size,
+            'difficulty': args.difficulty,
+            'booster_used': int(random.random() < 0.1)
+        })
+
+        hidden = [str(id) for id in range(args.size * args.size)]
+        random.shuffle(hidden)
+        while hidden:
+            result = client.call('/click_tile', {'session_id': session_id, 'tile_id': hidden.pop()})
+            if result.get('type') != 'playing':
+                break
+            board = result['board']
+            hidden = [id for id in hidden if board.get(id) == -1]
+
+        for endpoint in ('/get_balance', '/get_xp', '/get_booster_count', '/battlepass_status'):
+            client.call(endpoint, {'session_id': session_id})
+        client.call('/buy_booster', {'session_id': session_id, 'currency': 'coins'})
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help="synthetic users to seed")
+    parser.add_argument('--sessions', type=int, default=100, help="player sessions to replay")
+    parser.add_argument('--concurrency', type=int, default=8, help="concurrent sessions")
+    parser.add_argument('--size', type=int, default=9, help="board width and height")
+    parser.add_argument('--difficulty', default='1', choices=['1', '2', '3', '4'])
+    parser.add_argument('--db-host', help="use this database host instead of an embedded one")
+    parser.add_argument('--i-know-this-drops-tables', action='store_true',
+                        help="confirm that --db-host is a throwaway database, its tables are dropped")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    server = None
+    if args.db_host:
+        if not args.i_know_this_drops_tables:
+            sys.exit(f"loading the schema drops every table on {args.db_host}, "
+                     "pass --i-know-this-drops-tables if it is a throwaway database")
+        # index.py falls back to the production user
+        if not os.environ.get('DB_USER'):
+            sys.exit("set DB_USER for --db-host")
+        os.environ['DB_HOST'] = args.db_host
+    else:
+        server = start_database(tempfile.mkdtemp(prefix='sapper-loadtest-'))
+
+    # Every simulated player comes from 127.0.0.1, measure the API rather than the rate limiter
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+    try:
+        import index
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        emails = seed_database(index.connect(), args.users)
+
+        http_server = make_server('127.0.0.1', 0, index.app, threaded=True, request_handler=QuietHandler)
+        port = http_server.server_port
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+        stats = Stats()
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [
+                pool.submit(play_session, '127.0.0.1', port, stats, emails[n % len(emails)], args)
+                for n in range(args.sessions)
+            ]
+            for future in futures:
+                future.result()
+        report = stats.report(perf_counter() - start)
+        report['config'] = vars(args)
+        http_server.shutdown()
+    finally:
+        if server is not None:
+            server.cleanup()
+
+    print(f"{report['requests']} requests in {report['elapsed_s']:.1f}s "
+          f"({report['throughput_rps']:.1f} req/s, concurrency {args.concurrency})")
+    print(f"{'endpoint':<20}{'reqs':>7}{'errs':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, data in report['endpoints'].items():
+        print(f"{endpoint:<20}{data['requests']:>7}{data['errors']:>6}{data['throughput_rps']:>9.1f}"
+              f"{data['p50_ms']:>10.1f}{data['p95_ms']:>10.1f}{data['p99_ms']:>10.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
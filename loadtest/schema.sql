@@ -0,0 +1,80 @@
+-- Schema used by the load test database, matching what index.py expects.
+-- Only meant for local, disposable databases: it drops existing tables.
+DROP TABLE IF EXISTS users, sessions, session_revocations, games, game_results, skins, test CASCADE;
+
+CREATE TABLE users (
+    uuid uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    email text UNIQUE NOT NULL,
+    username text UNIQUE NOT NULL,
+    password_hash bit(512) NOT NULL,
+    salt bit(512) NOT NULL,
+    xp integer NOT NULL DEFAULT 0,
+    bp_xp integer NOT NULL DEFAULT 0,
+    coins integer NOT NULL DEFAULT 0,
+    gems integer NOT NULL DEFAULT 0,
+    statistics text NOT NULL DEFAULT '{"tiles_clicked": 0, "games_played": 0, "games_won": 0, "miliseconds_played": 0}',
+    avatar integer NOT NULL DEFAULT 1,
+    friends uuid[] NOT NULL DEFAULT '{}',
+    owned_avatars integer[] NOT NULL DEFAULT '{1}',
+    owned_skins integer[] NOT NULL DEFAULT '{}',
+    owns_battlepass boolean NOT NULL DEFAULT false,
+    booster_count integer NOT NULL DEFAULT 0
+);
+
+CREATE TABLE sessions (
+    session_id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id uuid NOT NULL REFERENCES users (uuid) ON DELETE CASCADE
+);
+
+-- Revoked signed session tokens: one token (token_id) or every token of the user
+-- (token_id NULL) issued before issued_before, in milliseconds since the epoch
+CREATE TABLE session_revocations (
+    user_id uuid NOT NULL,
+    token_id uuid,
+    issued_before bigint NOT NULL,
+    revoked_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX session_revocations_revoked_at ON session_revocations (revoked_at);
+
+CREATE TABLE games (
+    game_id uuid PRIMARY KEY,
+    data text NOT NULL,
+    start_time timestamptz,
+    version integer NOT NULL DEFAULT 0
+);
+
+-- Append-only, one row per finished game. users.statistics keeps the totals
+CREATE TABLE game_results (
+    result_id bigserial PRIMARY KEY,
+    user_id uuid NOT NULL,
+    finished_at timestamptz NOT NULL,
+    size_x integer NOT NULL,
+    size_y integer NOT NULL,
+    mine_count integer NOT NULL,
+    no_guess boolean NOT NULL,
+    won boolean NOT NULL,
+    miliseconds_played integer NOT NULL,
+    tiles_revealed integer NOT NULL,
+    -- Board seed, first tile and the varint click log (see game.record_click), for replays
+    seed bigint,
+    safe_tile integer,
+    clicks bytea
+);
+CREATE INDEX game_results_user ON game_results (user_id, result_id DESC);
+
+CREATE TABLE skins (
+    sid integer PRIMARY KEY,
+    name text NOT NULL,
+    price_coins integer NOT NULL,
+    price_gems integer NOT NULL
+);
+
+CREATE TABLE test (
+    value text
+);
+
+INSERT INTO skins (sid, name, price_coins, price_gems) VALUES
+    (1, 'classic', 500, 50),
+    (2, 'neon', 1000, 100),
+    (4, 'retro', 1500, 150),
+    (8, 'gold', 5000, 500);
@@ -0,0 +1,116 @@
+import atexit
+import json
+import logging
+import os
+import random
+import sys
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from uuid import uuid4
+
+from flask import request
+
+logger = logging.getLogger('sapper')
+
+RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'sample'}
+
+
+def parse_sample_rates(value):
+    """Parse "/click_tile=0.05,/create_game=0.5" into {route: rate}"""
+    rates = {}
+    for item in value.split(','):
+        if '=' in item:
+            route, rate = item.split('=', 1)
+            rates[route.strip()] = float(rate)
+    return rates
+
+
+sample_rates = parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', '/click_tile=0.05'))
+
+# (request_id, route) of the request being handled, shared with the asyncio entrypoint
+request_context = ContextVar('request_context', default=(None, None))
+
+
+class RequestContextFilter(logging.Filter):
+    """Tags records with the request id and route, and samples
+    high-frequency events (logged with extra={'sample': True}) per route"""
+
+    def filter(self, record):
+        record.request_id, record.route = request_context.get()
+
+        if getattr(record, 'sample', False):
+            rate = sample_rates.get(record.route, 1.0)
+            return rate >= 1.0 or random.random() < rate
+        return True
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting them,
+    JSON serialization and the stdout write happen off the request path"""
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.msg,
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED_ATTRS and value is not None:
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def begin(request):
+    """Bind a request id (X-Request-ID or a new one) and route to the current context"""
+    request_id = request.headers.get('X-Request-ID') or uuid4().hex
+    route = request.url_rule.rule if request.url_rule else None
+    request_context.set((request_id, route))
+    return request_id
+
+
+def start_request():
+    begin(request)
+
+
+def finish_request(response):
+    request_id, _ = request_context.get()
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+    request_context.set((None, None))
+    return response
+
+
+def configure():
+    """Route the `sapper` loggers through a queue drained by a background thread"""
+    if logger.handlers:
+        return
+    queue = SimpleQueue()
+    queue_handler = BackgroundQueueHandler(queue)
+    queue_handler.addFilter(RequestContextFilter())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JSONFormatter())
+    listener = QueueListener(queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+
+def init_app(app):
+    configure()
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,220 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+import psycopg2.extensions
+from flask import request
+
+import query_log
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+SIZE_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152)
+
+
+class Histogram:
+    """Prometheus style cumulative histogram, one series per route"""
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        self.lock = Lock()
+
+    def observe(self, route, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(route)
+            if series is None:
+                series = self.series[route] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            snapshot = {route: (list(counts), total, count) for route, (counts, total, count) in self.series.items()}
+        for route, (counts, total, count) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{route="{route}",le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{route="{route}"}} {total}')
+            lines.append(f'{self.name}_count{{route="{route}"}} {count}')
+        return lines
+
+
+class Counter:
+    """Prometheus style counter keyed by a tuple of label values"""
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            snapshot = dict(self.values)
+        for label_values, value in sorted(snapshot.items()):
+            labels = ','.join(f'{label}="{value}"' for label, value in zip(self.labels, label_values))
+            lines.append(f'{self.name}{{{labels}}} {value}')
+        return lines
+
+
+request_duration = Histogram(
+    'sapper_request_duration_seconds', "Wall time spent handling a request", TIME_BUCKETS)
+db_duration = Histogram(
+    'sapper_request_db_duration_seconds', "Time spent in database calls per request", TIME_BUCKETS)
+query_count = Histogram(
+    'sapper_request_queries', "Statements executed per request", COUNT_BUCKETS)
+rows_fetched = Histogram(
+    'sapper_request_rows_fetched', "Rows fetched from the database per request", COUNT_BUCKETS)
+commit_count = Histogram(
+    'sapper_request_commits', "Transactions committed per request", COUNT_BUCKETS)
+response_size = Histogram(
+    'sapper_response_size_bytes', "Size of the response body", SIZE_BUCKETS)
+requests_total = Counter(
+    'sapper_requests_total', "Handled requests", ('route', 'status'))
+click_conflicts = Counter(
+    'sapper_click_conflicts_total', "Clicks that lost the version check on their game (retried or failed)",
+    ('result',))
+
+registry = [
+    request_duration, db_duration, query_count, rows_fetched, commit_count, response_size, requests_total,
+    click_conflicts
+]
+
+
+class RequestStats:
+    __slots__ = ('start', 'route', 'db_time', 'queries', 'rows', 'commits')
+
+    def __init__(self, route):
+        self.start = perf_counter()
+        self.route = route
+        self.db_time = 0.0
+        self.queries = 0
+        self.rows = 0
+        self.commits = 0
+
+
+# A context variable rather than flask.g, so the asyncio entrypoint can share it
+request_stats = ContextVar('request_stats', default=None)
+
+
+def current_stats():
+    """Stats of the request being handled, or None outside of a request"""
+    return request_stats.get()
+
+
+class MetricsCursor(psycopg2.extensions.cursor):
+    """Cursor that adds its statement time and fetched rows to the current request
+    and feeds every statement to the slow query log"""
+
+    def execute(self, query, vars=None):
+        start = perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            duration = perf_counter() - start
+            stats = current_stats()
+            if stats is not None:
+                stats.db_time += duration
+                stats.queries += 1
+            query_log.record(query, self.query, duration, stats.route if stats else None)
+
+    def _count_rows(self, count):
+        stats = current_stats()
+        if stats is not None:
+            stats.rows += count
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._count_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        self._count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._count_rows(len(rows))
+        return rows
+
+
+def count_commit():
+    stats = current_stats()
+    if stats is not None:
+        stats.commits += 1
+
+
+class MetricsConnection(psycopg2.extensions.connection):
+    """Connection that counts the transactions it commits for the current request"""
+
+    def commit(self):
+        # Committing an idle connection doesn't reach the server
+        if self.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            count_commit()
+        return super().commit()
+
+
+def route_label(request):
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def begin(route):
+    request_stats.set(RequestStats(route))
+
+
+def observe(status_code, size):
+    """Record the finished request's stats into the histograms"""
+    stats = request_stats.get()
+    if stats is None:
+        return
+    request_stats.set(None)
+
+    route = stats.route
+    request_duration.observe(route, perf_counter() - stats.start)
+    db_duration.observe(route, stats.db_time)
+    query_count.observe(route, stats.queries)
+    rows_fetched.observe(route, stats.rows)
+    commit_count.observe(route, stats.commits)
+    response_size.observe(route, size)
+    requests_total.inc(route, str(status_code))
+
+
+def start_request():
+    begin(route_label(request))
+
+
+def finish_request(response):
+    # Measuring a streamed response would read the whole stream into memory first
+    size = 0 if response.is_streamed else response.calculate_content_length()
+    observe(response.status_code, size or 0)
+    return response
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,17 @@
+"""PBKDF2 password hashes. Hashes and salts are stored as bit(512) columns
+and read back as strings of bits"""
+from hashlib import pbkdf2_hmac
+
+encoding = 'sha512'
+iterations = 450959
+
+
+def hash_password(password, salt):
+    """Takes a few hundred ms of CPU, asgi.py runs it off the event loop"""
+    return pbkdf2_hmac(encoding, password.encode('utf-8'), salt, iterations)
+
+def from_bits(bits):
+    """bytes of a bit(512) column"""
+    # Only the password routes need bitstring, keep it out of the cold start
+    from bitstring import BitArray
+    return BitArray(bin=bits).bytes
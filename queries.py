@@ -0,0 +1,178 @@
+"""SQL shared by index.py (psycopg2) and asgi.py (psycopg 3). Both drivers
+take the same %s and %(name)s placeholders, so each statement is written
+once here and the entrypoints only run it"""
+import os
+
+from game import dump_game_data
+
+# Stands in for "sessions s" in queries joining the session, with %(session_id)s and
+# %(session_user)s from session_tokens.session_params(): a verified token doesn't need a sessions row
+SESSION_ROW = "(SELECT %(session_id)s::uuid AS session_id, %(session_user)s::uuid AS user_id \
+    WHERE %(session_user)s::uuid IS NOT NULL \
+    UNION ALL SELECT session_id, user_id FROM sessions \
+    WHERE session_id = %(session_id)s::uuid AND %(session_user)s::uuid IS NULL) s"
+
+# SESSIONS
+SESSION_USER = "SELECT user_id FROM sessions WHERE session_id = %s"
+SESSION_USER_FOR_UPDATE = "SELECT user_id FROM sessions WHERE session_id = %s FOR UPDATE"
+NEW_SESSION = "with rows as (INSERT INTO sessions (user_id) VALUES (%s) RETURNING session_id) SELECT session_id FROM rows"
+DELETE_SESSION = "DELETE FROM sessions WHERE session_id = %s"
+DELETE_USER_SESSIONS = "DELETE FROM sessions WHERE user_id = %s"
+
+# ACCOUNTS
+LOGIN_USER = "SELECT uuid, password_hash, salt, username, xp, bp_xp, coins, gems \
+    FROM users WHERE email = %s"
+EMAIL_TAKEN = "SELECT uuid FROM users WHERE email = %s"
+USERNAME_TAKEN = "SELECT uuid FROM users WHERE username = %s"
+# Hashes and salts are sent as bytes and stored as bit(512)
+REGISTER_USER = "INSERT INTO users (email, username, password_hash, salt) \
+    VALUES (%s, %s, right(%s::text, -1)::bit(512), right(%s::text, -1)::bit(512)) RETURNING uuid"
+PASSWORD_FOR_UPDATE = "SELECT password_hash, salt FROM users WHERE uuid = %s FOR UPDATE"
+SET_PASSWORD = "UPDATE users SET \
+    password_hash = right(%s::text, -1)::bit(512), \
+    salt = right(%s::text, -1)::bit(512) \
+    WHERE uuid = %s"
+
+# PROFILES
+USER_PROFILE = "SELECT username, avatar, xp, statistics FROM users WHERE uuid = %s"
+# Session check and every profile in one query, a wrong session returns no rows
+USERS_PROFILES = f"SELECT u.uuid, u.username, u.avatar, u.xp, u.statistics \
+    FROM {SESSION_ROW} LEFT JOIN users u ON u.uuid = ANY(%(user_ids)s::uuid[])"
+# {fields} are column names picked by the caller, never request data
+USER_FIELDS = "SELECT {fields} FROM users WHERE uuid = %s"
+# Session lookup and every requested /me field in one query
+SESSION_USER_FIELDS = "SELECT {fields} FROM " + SESSION_ROW + " JOIN users u ON u.uuid = s.user_id"
+
+# GAME HISTORY
+# Session check and the newest results in one query, a wrong session returns no rows
+GAME_HISTORY = f"SELECT r.result_id, extract(epoch from r.finished_at)::bigint, r.size_x, r.size_y, \
+    r.mine_count, r.no_guess, r.won, r.miliseconds_played, r.tiles_revealed \
+    FROM {SESSION_ROW} LEFT JOIN LATERAL \
+    (SELECT * FROM game_results WHERE user_id = s.user_id \
+     AND (%(before)s::bigint IS NULL OR result_id < %(before)s::bigint) \
+     ORDER BY result_id DESC LIMIT %(limit)s) r ON true"
+# Only the user's own games, a wrong session returns no row
+GAME_REPLAY = f"SELECT r.result_id, r.size_x, r.size_y, r.mine_count, r.seed, r.safe_tile, r.clicks \
+    FROM {SESSION_ROW} \
+    LEFT JOIN game_results r ON r.result_id = %(result_id)s AND r.user_id = s.user_id"
+
+# FRIENDS
+USER_EXISTS = "SELECT uuid FROM users WHERE uuid = %s"
+FRIENDS_FOR_UPDATE = "SELECT friends FROM users WHERE uuid = %s FOR UPDATE"
+SET_FRIENDS = "UPDATE users SET friends = %s::uuid[] WHERE uuid = %s"
+FRIENDS = "SELECT u.uuid, u.username, u.avatar FROM users me \
+    JOIN users u ON u.uuid = ANY(me.friends) WHERE me.uuid = %s"
+SEARCH_USERS = "SELECT uuid, username, avatar FROM users WHERE username ~* %s AND uuid != %s::uuid"
+
+# SHOP
+# {currency} is checked against 'coins' and 'gems' before these are formatted
+SKINS = "SELECT * FROM skins"
+SKIN_BALANCE = "SELECT {currency}, owned_skins FROM users WHERE uuid = %s FOR UPDATE"
+SKIN_PRICE = "SELECT price_{currency} FROM skins WHERE sid = %s"
+BUY_SKIN = "UPDATE users SET {currency} = {currency} - %s, owned_skins = %s WHERE uuid = %s"
+ADD_GEMS = "UPDATE users SET gems = gems + %s WHERE uuid = %s RETURNING gems"
+BATTLEPASS_USER = "SELECT gems, bp_xp, booster_count, owned_avatars, owned_skins \
+    FROM users WHERE uuid = %s FOR UPDATE"
+# Takes the gems and adds the tiers already reached in one statement
+BUY_BATTLEPASS = "UPDATE users \
+    SET gems = gems - %s, owns_battlepass = %s, \
+        booster_count = %s, owned_avatars = %s, owned_skins = %s \
+    WHERE uuid = %s RETURNING gems"
+BALANCE_FOR_UPDATE = "SELECT {currency} FROM users WHERE uuid = %s FOR UPDATE"
+BUY_BOOSTER = "UPDATE users SET {currency} = {currency} - %s, booster_count = booster_count + %s \
+    WHERE uuid = %s RETURNING booster_count"
+AVATARS_FOR_UPDATE = "SELECT owned_avatars FROM users WHERE uuid = %s FOR UPDATE"
+SET_AVATAR = "UPDATE users SET avatar = %s WHERE uuid = %s"
+
+# GAMES
+# Session check, booster spend and game upsert in one statement (and one commit).
+# The booster is only taken while booster_count > 0, so concurrent games can't double spend it
+CREATE_GAME = f"WITH session AS \
+    (SELECT session_id, user_id FROM {SESSION_ROW}), \
+    booster AS \
+    (UPDATE users SET booster_count = booster_count - 1 \
+     WHERE uuid = (SELECT user_id FROM session) AND %(booster_used)s AND booster_count > 0 \
+     RETURNING uuid), \
+    game AS \
+    (INSERT INTO games (game_id, data) \
+     SELECT session_id, %(data)s FROM session \
+     WHERE NOT %(booster_used)s OR EXISTS (SELECT 1 FROM booster) \
+     ON CONFLICT (game_id) DO UPDATE SET data = EXCLUDED.data, start_time = NULL, version = games.version + 1 \
+     RETURNING game_id) \
+    SELECT EXISTS (SELECT 1 FROM session), EXISTS (SELECT 1 FROM game)"
+LOAD_GAME = "SELECT data, extract(epoch from start_time)::integer, version FROM games WHERE game_id = %s"
+# Session, user and game of a click in one read without locks
+CLICK_GAME = f"SELECT s.user_id, u.owns_battlepass, u.bp_xp, g.data, \
+    extract(epoch from g.start_time)::integer, g.version \
+    FROM {SESSION_ROW} \
+    JOIN users u ON u.uuid = s.user_id \
+    LEFT JOIN games g ON g.game_id = s.session_id"
+USER_BATTLEPASS = "SELECT owns_battlepass, bp_xp FROM users WHERE uuid = %s"
+
+# statistics is JSON text, updated in place so clicks don't need to read it first.
+# Some stored rows end with a literal ::text, trimmed like sanitize_database_output does
+STATISTICS_SET = "statistics = (SELECT (stats || jsonb_build_object( \
+    'tiles_clicked', (stats->>'tiles_clicked')::bigint + %(tiles_clicked)s, \
+    'games_played', (stats->>'games_played')::bigint + %(played)s, \
+    'games_won', (stats->>'games_won')::bigint + %(won)s, \
+    'miliseconds_played', (stats->>'miliseconds_played')::bigint + %(miliseconds_played)s \
+))::text FROM (SELECT btrim(statistics, ':tex')::jsonb AS stats) stored)"
+ADD_STATISTICS = "UPDATE users SET " + STATISTICS_SET + " WHERE uuid = %(user_id)s"
+# The game write of a click, only if the game is still at %(version)s
+SAVE_GAME = "WITH game AS (UPDATE games \
+    SET data = %(data)s, start_time = COALESCE(start_time, NOW()), version = version + 1 \
+    WHERE game_id = %(session_id)s AND version = %(version)s \
+    RETURNING extract(epoch from start_time)::integer AS start_time, version) "
+DELETE_GAME = "WITH game AS (DELETE FROM games \
+    WHERE game_id = %(session_id)s AND version = %(version)s \
+    RETURNING NULL::integer AS start_time, NULL::integer AS version) "
+# Follows SAVE_GAME or DELETE_GAME: the click's statistics and rewards, written only
+# along with the game (and if bp_xp is still %(battlepass_xp)s when rewards depend on it)
+CLICK_USER_UPDATE = "UPDATE users SET " + STATISTICS_SET + ", \
+    coins = coins + %(added_coins)s, xp = xp + %(added_xp)s, bp_xp = bp_xp + %(added_battlepass_xp)s, \
+    booster_count = booster_count + %(boosters)s, \
+    owned_avatars = owned_avatars || %(avatars)s::integer[], \
+    owned_skins = owned_skins || %(skins)s::integer[] \
+    WHERE uuid = %(user_id)s AND EXISTS (SELECT 1 FROM game) \
+    AND (%(battlepass_xp)s::integer IS NULL OR bp_xp = %(battlepass_xp)s) \
+    RETURNING xp, bp_xp, coins, (SELECT start_time FROM game), (SELECT version FROM game)"
+CLICK_NO_USER_UPDATE = "SELECT NULL, NULL, NULL, start_time, version FROM game"
+NO_REWARDS = {
+    'added_coins': 0,
+    'added_xp': 0,
+    'added_battlepass_xp': 0,
+    'boosters': 0,
+    'avatars': [],
+    'skins': []
+}
+# A click that lost the race for its game row is read and played again this many times
+CLICK_RETRIES = int(os.environ.get('CLICK_RETRIES', 3))
+
+
+class GameConflict(Exception):
+    """The game changed between reading it and saving the click"""
+
+
+def save_click(session_id, user_id, game_data, version, statistics=None, delete_game=False,
+               rewards=None, battlepass_xp=None):
+    """(sql, values) writing everything a click changed with one statement: the
+    game (saved, with the timer started, or deleted) and the user's statistics
+    and rewards. The statement returns (xp, bp_xp, coins, start_time, version),
+    the user columns are None without statistics and start_time and version are
+    None once the game is deleted. It returns no row when the game is no longer
+    at version, or the user no longer at battlepass_xp, raise GameConflict then"""
+    sql = DELETE_GAME if delete_game else SAVE_GAME
+    values = {
+        'session_id': session_id,
+        'user_id': user_id,
+        'version': version,
+        'data': dump_game_data(game_data),
+        'battlepass_xp': battlepass_xp
+    }
+    if statistics is None:
+        sql += CLICK_NO_USER_UPDATE
+    else:
+        sql += CLICK_USER_UPDATE
+        values.update(statistics)
+        values.update(rewards or NO_REWARDS)
+    return sql, values
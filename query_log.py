@@ -0,0 +1,159 @@
+import logging
+import os
+import random
+from collections import OrderedDict, deque
+from queue import Full, Queue
+from threading import Lock, Thread
+from time import time
+
+import psycopg2.extensions
+
+logger = logging.getLogger('sapper.slow_query')
+
+threshold = float(os.environ.get('SLOW_QUERY_MS', 200)) / 1000
+explain_rate = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+explain_timeout_ms = int(os.environ.get('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', 5000))
+# Sampled statements waiting for EXPLAIN past this many are dropped, so a slow
+# database gets at most one extra connection and a few queued plans from us
+explain_queue_size = int(os.environ.get('SLOW_QUERY_EXPLAIN_QUEUE', 10))
+
+# Set by index.py and asgi.py, opens the (psycopg2) side connection used for EXPLAIN
+explain_connect = None
+
+slow_queries = deque(maxlen=int(os.environ.get('SLOW_QUERY_LOG_SIZE', 100)))
+# Least recently run statements are dropped past this many, so statements
+# built with literals in their text can't grow memory without bound
+statement_stats_size = int(os.environ.get('SLOW_QUERY_STATS_SIZE', 500))
+statement_stats = OrderedDict()
+lock = Lock()
+
+EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with')
+# Row locks ANALYZE would wait on, these get a plain EXPLAIN like writes do
+LOCKING = (' for update', ' for no key update', ' for share', ' for key share')
+
+explains = Queue(maxsize=explain_queue_size)
+explain_thread = None
+explain_conn = None
+
+
+def normalize(statement):
+    if isinstance(statement, bytes):
+        statement = statement.decode('utf-8', 'replace')
+    return ' '.join(str(statement).split())
+
+
+def record(statement, bound_query, duration, route):
+    """Account one executed statement and log it if it was slow
+
+    statement is the SQL template (without parameters), bound_query the
+    exact bytes sent to the server, only used for EXPLAIN.
+    """
+    statement = normalize(statement)
+    key = (route, statement)
+    with lock:
+        stats = statement_stats.get(key)
+        if stats is None:
+            stats = statement_stats[key] = {'calls': 0, 'total_s': 0.0, 'max_s': 0.0}
+            while len(statement_stats) > statement_stats_size:
+                statement_stats.popitem(last=False)
+        else:
+            statement_stats.move_to_end(key)
+        stats['calls'] += 1
+        stats['total_s'] += duration
+        stats['max_s'] = max(stats['max_s'], duration)
+
+    if duration < threshold:
+        return
+
+    entry = {
+        'time': time(),
+        'route': route,
+        'duration_ms': round(duration * 1000, 2),
+        'statement': statement
+    }
+    with lock:
+        slow_queries.append(entry)
+    logger.warning("slow query %.1fms on %s: %s", duration * 1000, route, statement)
+
+    if (
+        explain_connect is not None
+        and bound_query
+        and statement.lower().startswith(EXPLAINABLE)
+        and random.random() < explain_rate
+    ):
+        start_explaining()
+        try:
+            explains.put_nowait((entry, bound_query, analyzable(statement)))
+        except Full:
+            entry['plan_error'] = "explain queue full"
+
+
+def analyzable(statement):
+    """Whether EXPLAIN ANALYZE can run the statement without writing or
+    waiting on row locks, only plain SELECTs qualify"""
+    statement = statement.lower()
+    return statement.startswith('select') and not any(clause in statement for clause in LOCKING)
+
+
+def start_explaining():
+    global explain_thread
+    if explain_thread is None:
+        with lock:
+            if explain_thread is None:
+                explain_thread = Thread(target=run_explains, args=(explains,), name='slow-query-explain', daemon=True)
+                explain_thread.start()
+
+
+def run_explains(queue):
+    """Explain queued statements one at a time on the side connection"""
+    while True:
+        entry, bound_query, analyze = queue.get()
+        try:
+            explain(entry, bound_query, analyze)
+        finally:
+            queue.task_done()
+
+
+def explain(entry, bound_query, analyze):
+    """Capture the plan on the side connection, opened on first use and
+    reopened after it fails
+
+    Only plain SELECTs get ANALYZE (BUFFERS), anything else is planned
+    without running it. The transaction is always rolled back and a
+    statement timeout keeps lock waits from piling up.
+    """
+    global explain_conn
+    try:
+        if explain_conn is None or explain_conn.closed:
+            explain_conn = explain_connect()
+        cursor = explain_conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+        cursor.execute("SET LOCAL statement_timeout = %s", (explain_timeout_ms,))
+        cursor.execute((b"EXPLAIN (ANALYZE, BUFFERS) " if analyze else b"EXPLAIN ") + bound_query)
+        entry['plan'] = '\n'.join(row[0] for row in cursor.fetchall())
+        logger.info("plan for slow query on %s:\n%s", entry['route'], entry['plan'])
+        explain_conn.rollback()
+    except Exception as e:
+        entry['plan_error'] = str(e)
+        if explain_conn is not None:
+            try:
+                explain_conn.close()
+            except Exception:
+                pass
+            explain_conn = None
+
+
+def report(limit=20):
+    """Recent slow queries and the statements with the most total time"""
+    with lock:
+        recent = list(slow_queries)
+        stats = [
+            {'route': route, 'statement': statement, **values}
+            for (route, statement), values in statement_stats.items()
+        ]
+    stats.sort(key=lambda item: item['total_s'], reverse=True)
+    return {
+        'threshold_ms': threshold * 1000,
+        'explain_rate': explain_rate,
+        'slow_queries': recent[::-1],
+        'top_statements': stats[:limit]
+    }
@@ -0,0 +1,204 @@
+"""Per-client token buckets and global admission control, so a few abusive
+clients get fast 429s instead of slowing the API down for everyone"""
+import os
+from collections import OrderedDict
+from contextvars import ContextVar
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+from flask import request
+
+import metrics
+from serializers import get_request_data, respond, serializers
+
+ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+# Tokens per second and bucket size, a rate of 0 disables that bucket
+SESSION_RATE = float(os.environ.get('RATE_LIMIT_SESSION_RATE', 10))
+SESSION_BURST = float(os.environ.get('RATE_LIMIT_SESSION_BURST', 30))
+IP_RATE = float(os.environ.get('RATE_LIMIT_IP_RATE', 30))
+IP_BURST = float(os.environ.get('RATE_LIMIT_IP_BURST', 90))
+MAX_BUCKETS = int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', 100000))
+# Behind a proxy every request comes from the proxy, use the first X-Forwarded-For hop instead
+TRUST_FORWARDED = os.environ.get('RATE_LIMIT_TRUST_FORWARDED', '0') == '1'
+# Requests are shed with a 503 past these, 0 disables the check
+MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 64))
+MAX_POOL_WAITING = int(os.environ.get('ADMISSION_MAX_POOL_WAITING', 16))
+
+# Probes and scraping must keep working while the API is overloaded
+EXEMPT_ROUTES = {'/livez', '/readyz', '/warmup', '/health', '/metrics'}
+
+limited_requests = metrics.Counter(
+    'sapper_rate_limited_total',
+    "Requests rejected by a token bucket (session, ip) or shed by admission control (overload)",
+    ('route', 'reason'))
+metrics.registry.append(limited_requests)
+
+
+def parse_costs(value):
+    """Parse "/login=20,/create_game=3" into {route: tokens}"""
+    costs = {}
+    for item in value.split(','):
+        if '=' in item:
+            route, cost = item.split('=', 1)
+            costs[route.strip()] = float(cost)
+    return costs
+
+
+# PBKDF2 makes the password routes the most expensive, everything else costs 1
+route_costs = parse_costs(os.environ.get(
+    'RATE_LIMIT_COSTS', '/login=20,/register=20,/change_password=20,/create_game=3'))
+
+
+class RateLimiter:
+    """Token buckets keyed by (kind, key), each kind with its own (rate, burst).
+    Buckets refill continuously; the least recently used are dropped past max_buckets"""
+
+    def __init__(self, limits, max_buckets=MAX_BUCKETS):
+        self.limits = limits
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    def acquire(self, keys, cost, now=None):
+        """Take cost tokens from the bucket of every (kind, key), all or none.
+        Returns (0, None) when admitted, otherwise (seconds until it would be, kind)"""
+        if now is None:
+            now = monotonic()
+        wait, limited_by = 0.0, None
+        with self.lock:
+            taken = []
+            for kind, key in keys:
+                rate, burst = self.limits[kind]
+                if rate <= 0 or key is None:
+                    continue
+                bucket = self.buckets.get((kind, key))
+                if bucket is None:
+                    bucket = self.buckets[(kind, key)] = [burst, now]
+                    if len(self.buckets) > self.max_buckets:
+                        self.buckets.popitem(last=False)
+                else:
+                    self.buckets.move_to_end((kind, key))
+                    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+                needed = min(cost, burst)
+                if bucket[0] < needed and (needed - bucket[0]) / rate > wait:
+                    wait, limited_by = (needed - bucket[0]) / rate, kind
+                taken.append((bucket, needed))
+            if limited_by is None:
+                for bucket, needed in taken:
+                    bucket[0] -= needed
+        return wait, limited_by
+
+
+class Admission:
+    """Counts the requests being handled and turns new ones away once too
+    many are in flight or waiting for a database connection"""
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, max_pool_waiting=MAX_POOL_WAITING):
+        self.max_in_flight = max_in_flight
+        self.max_pool_waiting = max_pool_waiting
+        self.in_flight = 0
+        self.lock = Lock()
+        # Set by an entrypoint with a connection pool, returns the requests waiting for a connection
+        self.pool_waiting = None
+
+    def enter(self):
+        """False when the request should be shed, otherwise it is counted until leave()"""
+        if self.max_pool_waiting and self.pool_waiting is not None \
+                and self.pool_waiting() >= self.max_pool_waiting:
+            return False
+        with self.lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+        return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+limiter = RateLimiter({'session': (SESSION_RATE, SESSION_BURST), 'ip': (IP_RATE, IP_BURST)})
+admission = Admission()
+
+# Whether the current request was counted by admission, shared with the asyncio entrypoint
+admitted = ContextVar('admitted', default=False)
+
+
+def client_ip(remote_addr, headers):
+    if TRUST_FORWARDED:
+        forwarded = headers.get('X-Forwarded-For')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return remote_addr
+
+
+def throttle(route, session_id, ip):
+    """None when the client has tokens left for route, otherwise the seconds to retry after"""
+    if not ENABLED or route in EXEMPT_ROUTES:
+        return None
+    keys = (('session', str(session_id) if session_id else None), ('ip', ip))
+    wait, limited_by = limiter.acquire(keys, route_costs.get(route, 1))
+    if limited_by is None:
+        return None
+    limited_requests.inc(route, limited_by)
+    return max(1, ceil(wait))
+
+
+def check(route, session_id, ip):
+    """None when the request may proceed, otherwise (status, reason, retry_after)
+    for the rejection. Admitted requests must be finished with done()"""
+    retry_after = throttle(route, session_id, ip)
+    if retry_after is not None:
+        return 429, "rate limited", retry_after
+
+    if not ENABLED or route in EXEMPT_ROUTES:
+        return None
+    if not admission.enter():
+        limited_requests.inc(route, 'overload')
+        return 503, "server busy", 1
+    admitted.set(True)
+    return None
+
+
+def done():
+    if admitted.get():
+        admitted.set(False)
+        admission.leave()
+
+
+def rejection(status, reason, retry_after):
+    """(data, status, headers) of a rejected request"""
+    return {"type": "fail", "reason": reason, "retry_after": retry_after}, status, {'Retry-After': str(retry_after)}
+
+
+def request_session_id():
+    try:
+        data = get_request_data() if request.mimetype in serializers else request.values
+    except Exception:
+        return None # the handler reports malformed bodies
+    return data.get('session_id') if isinstance(data, dict) else None
+
+
+def start_request():
+    if request.method == 'OPTIONS':
+        return None
+    rejected = check(
+        metrics.route_label(request),
+        request_session_id(),
+        client_ip(request.remote_addr, request.headers)
+    )
+    if rejected is None:
+        return None
+    data, status, headers = rejection(*rejected)
+    return respond(data), status, headers
+
+
+def finish_request(_exc=None):
+    done()
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.teardown_request(finish_request)
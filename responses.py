@@ -0,0 +1,290 @@
+"""Request parsing and response bodies shared by index.py and asgi.py.
+Everything here is plain data in and out, the entrypoints only add the
+database I/O and respond(data), status"""
+import json
+import os
+from math import ceil
+from time import time
+from uuid import UUID
+
+from game import (
+    battlepass_rewards,
+    decode_clicks,
+    difficulty_list,
+    replay_game,
+    sanitize_game_data,
+    uncover_all_tiles,
+)
+from game_history import HISTORY_LIMIT
+
+# Most profiles /users_info returns for one request
+USERS_INFO_LIMIT = int(os.environ.get('USERS_INFO_LIMIT', 100))
+
+# /me response keys and the users column each one is read from
+PROFILE_FIELDS = {
+    'coins': 'coins',
+    'gems': 'gems',
+    'xp': 'xp',
+    'battlepass_xp': 'bp_xp',
+    'owns_battlepass': 'owns_battlepass',
+    'booster_count': 'booster_count',
+    'avatar_id': 'avatar',
+    'owned_avatars': 'owned_avatars',
+    'owned_skins': 'owned_skins'
+}
+
+# Engine outcomes of clicks that changed nothing, with their status and reason
+CLICK_FAILURES = {
+    'not_found': (404, "tile not found"),
+    'already_clicked': (400, "tile already clicked"),
+    'unknown_value': (400, "unknown tile value")
+}
+
+
+def sanitize_database_output(text):
+    return str(text).strip("::text")
+
+def fail(reason):
+    return {"type": "fail", "reason": reason}
+
+def wrong_session():
+    return fail("wrong session id"), 401
+
+def valid_password(password):
+    return 8 <= len(password) <= 64
+
+# ACCOUNTS
+def login(user, session_id):
+    """/login body for a LOGIN_USER row"""
+    _uuid, _hash, _salt, username, xp, battlepass_xp, coins, gems = user
+    return {
+        "session_id": session_id,
+        "username": username,
+        "xp": xp,
+        "battlepass_xp": battlepass_xp,
+        "coins": coins,
+        "gems": gems,
+        "type": "success"
+    }
+
+def statistics(user):
+    """/get_statistics and /user_info body for a USER_PROFILE row"""
+    return {
+        "type": "success",
+        "username": user[0],
+        "avatar": user[1],
+        "xp": user[2],
+        "statistics": json.loads(sanitize_database_output(user[3]))
+    }
+
+# GAME HISTORY
+def history_params(data):
+    """(limit, before) of a /game_history request, or None if they aren't numbers"""
+    try:
+        limit = min(int(data.get('limit', HISTORY_LIMIT)), HISTORY_LIMIT)
+        before = int(data['before']) if data.get('before') is not None else None
+    except (TypeError, ValueError):
+        return None
+    return max(limit, 0), before
+
+def history(rows):
+    """/game_history body for GAME_HISTORY rows, newest first.
+    Pass the last id as before for the next page"""
+    return {
+        "type": "success",
+        "games": [
+            {
+                "id": row[0],
+                "finished_at": row[1],
+                "size_x": row[2],
+                "size_y": row[3],
+                "mine_count": row[4],
+                "no_guess": row[5],
+                "won": row[6],
+                "miliseconds_played": row[7],
+                "tiles_revealed": row[8]
+            }
+            for row in rows if row[0] is not None
+        ]
+    }
+
+def replay_params(data):
+    """(result_id, step) of a /game_replay request, or None if they aren't numbers"""
+    try:
+        result_id = int(data['game_id'])
+        step = int(data['step']) if data.get('step') is not None else None
+    except (TypeError, ValueError):
+        return None
+    return result_id, step
+
+def replay(row, step):
+    """(/game_replay body, status) for a GAME_REPLAY row"""
+    if not row:
+        return wrong_session()
+    if row[0] is None:
+        return fail("game not found"), 404
+    if row[4] is None or row[6] is None:
+        return fail("replay not available"), 404
+
+    clicks = decode_clicks(row[6])
+    if step is None:
+        step = len(clicks)
+    if not 0 <= step <= len(clicks):
+        return fail("invalid parameters"), 400
+
+    # The board after the first step clicks, played again by the game engine
+    game_data, outcome = replay_game(row[1], row[2], row[3], row[4], row[5], clicks, step)
+    return {
+        "type": "success",
+        "step": step,
+        "steps": len(clicks),
+        "outcome": outcome,
+        "board": sanitize_game_data(game_data),
+        "clicks": [
+            {"tile_id": str(tile_index), "miliseconds": delay}
+            for tile_index, delay in clicks
+        ]
+    }, 200
+
+# FRIENDS
+def users(rows):
+    """Entries of /get_friends and /search_users for (uuid, username, avatar) rows"""
+    return [
+        {"id": user[0], "username": user[1], "avatar": user[2]}
+        for user in rows
+    ]
+
+def users_info_ids(user_ids):
+    """(unique user ids, None) of a /users_info request, or (None, reason)"""
+    if len(user_ids) > USERS_INFO_LIMIT:
+        return None, f"at most {USERS_INFO_LIMIT} users"
+    try:
+        return list({str(UUID(str(user_id))) for user_id in user_ids}), None
+    except ValueError:
+        return None, "invalid user id"
+
+def users_info(rows):
+    """/users_info body for USERS_PROFILES rows, users that don't exist are left out"""
+    return {
+        "type": "success",
+        "users": {
+            str(user[0]): {
+                "username": user[1],
+                "avatar": user[2],
+                "xp": user[3],
+                "statistics": json.loads(sanitize_database_output(user[4]))
+            }
+            for user in rows if user[0] is not None
+        }
+    }
+
+# PROFILE
+def profile_fields(requested):
+    """Response keys for the fields parameter of /me (a list or comma separated
+    string, all fields when missing), or None if one of them is unknown"""
+    if not requested:
+        return list(PROFILE_FIELDS)
+    if isinstance(requested, str):
+        requested = requested.split(',')
+    fields = [str(field).strip() for field in requested]
+    if any(field not in PROFILE_FIELDS for field in fields):
+        return None
+    return list(dict.fromkeys(fields))
+
+def profile_columns(fields):
+    """SESSION_USER_FIELDS columns for the response keys from profile_fields()"""
+    return ', '.join(f"u.{PROFILE_FIELDS[field]}" for field in fields)
+
+def profile(fields, row):
+    body = {"type": "success"}
+    for field, value in zip(fields, row):
+        if field == 'owns_battlepass':
+            value = "true" if value else "false"
+        body[field] = value
+    return body
+
+# SHOP
+def skins(rows):
+    """/get_all_skins body for SKINS rows"""
+    return {
+        str(skin[0]): {
+            'name': skin[1],
+            'price_coins': skin[2],
+            'price_gems': skin[3]
+        }
+        for skin in rows
+    }
+
+def add_battlepass_items(tiers, booster_count, owned_avatars, owned_skins):
+    for tier in tiers:
+        item = battlepass_rewards[str(tier)]
+        if item['type'] == "booster":
+            booster_count += item['count']
+            continue
+        if item['type'] == "avatar":
+            owned_avatars.append(item['id'])
+            continue
+        if item['type'] == "skin":
+            owned_skins.append(item['id'])
+            continue
+    return booster_count, owned_avatars, owned_skins
+
+# GAMES
+def new_game(data):
+    """game_data of a /create_game request, or None when a parameter is missing.
+    Only the parameters are stored, the board is generated on the first click"""
+    size_x = data['size_x']
+    size_y = data['size_y']
+    difficulty = str(data['difficulty'])
+    booster_used = data['booster_used']
+    if not size_x or not size_y or not difficulty or booster_used is None:
+        return None
+    return {
+        'size_x': size_x,
+        'size_y': size_y,
+        'mine_count': ceil(difficulty_list[difficulty] * size_x * size_y),
+        'timer_started': False,
+        'booster_active': bool(int(booster_used) == 1),
+        'no_guess': bool(int(data.get('no_guess', 0)) == 1)
+    }
+
+def miliseconds_played(start_time):
+    """Game time in hundredths of a second, -1 if the timer never started"""
+    return int((time() - start_time)*100) if start_time != -1 else -1
+
+def click_failure(outcome, game_data):
+    """(body, status) of a click that changed nothing"""
+    status, reason = CLICK_FAILURES[outcome]
+    return {**fail(reason), "board": sanitize_game_data(game_data)}, status
+
+def click_loss(game_data, miliseconds_played):
+    return {
+        "type": "loss",
+        "board": uncover_all_tiles(game_data),
+        "miliseconds_played": miliseconds_played
+    }
+
+def click_win(game_data, user, rewards, miliseconds_played):
+    """user is the (xp, bp_xp, coins) the click's update returned"""
+    user_xp, user_battlepass_xp, user_coins = user
+    return {
+        "type": "win",
+        "board": sanitize_game_data(game_data),
+        "xp": user_xp,
+        "added_xp": rewards['added_xp'],
+        "coins": user_coins,
+        "added_coins": rewards['added_coins'],
+        "battlepass_xp": user_battlepass_xp,
+        "added_battlepass_xp": rewards['added_battlepass_xp'],
+        "battlepass_reward": rewards['battlepass_reward'],
+        "miliseconds_played": miliseconds_played
+    }
+
+def click_playing(game_data, start_time):
+    result = {
+        "type": "playing",
+        "board": sanitize_game_data(game_data)
+    }
+    if start_time:
+        result['start_time'] = start_time
+    return result
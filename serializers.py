@@ -0,0 +1,104 @@
+import json
+from abc import ABC, abstractmethod
+
+from flask import Response, g, jsonify, request
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class Serializer(ABC):
+    """Encodes response bodies and decodes request bodies for one mimetype"""
+    mimetype = None
+
+    @abstractmethod
+    def dumps(self, data):
+        """Encode data as this mimetype"""
+
+    @abstractmethod
+    def loads(self, raw):
+        """Decode a body of this mimetype"""
+
+
+class JSONSerializer(Serializer):
+    mimetype = 'application/json'
+
+    def dumps(self, data):
+        return json.dumps(data)
+
+    def loads(self, raw):
+        return json.loads(raw)
+
+
+class MsgPackSerializer(Serializer):
+    mimetype = 'application/msgpack'
+
+    def dumps(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+class CBORSerializer(Serializer):
+    mimetype = 'application/cbor'
+
+    def dumps(self, data):
+        return cbor2.dumps(data)
+
+    def loads(self, raw):
+        return cbor2.loads(raw)
+
+
+json_serializer = JSONSerializer()
+
+# Binary encodings are only offered when their library is installed
+serializers = {json_serializer.mimetype: json_serializer}
+if msgpack is not None:
+    serializers[MsgPackSerializer.mimetype] = MsgPackSerializer()
+    serializers['application/x-msgpack'] = serializers[MsgPackSerializer.mimetype]
+if cbor2 is not None:
+    serializers[CBORSerializer.mimetype] = CBORSerializer()
+
+
+def negotiate_serializer(accept_mimetypes=None):
+    """Pick the serializer the client prefers in Accept, JSON by default"""
+    if accept_mimetypes is None:
+        accept_mimetypes = request.accept_mimetypes
+    best = accept_mimetypes.best_match(
+        list(serializers),
+        default=json_serializer.mimetype
+    )
+    return serializers.get(best, json_serializer)
+
+
+def get_request_data():
+    """Decode the request body according to its Content-Type"""
+    if 'request_data' in g:
+        return g.request_data
+
+    serializer = serializers.get(request.mimetype)
+    if serializer is None or serializer is json_serializer:
+        data = request.json
+    else:
+        data = serializer.loads(request.get_data(cache=True))
+    g.request_data = data
+    return data
+
+
+def respond(data):
+    """Serialize data using the encoding negotiated from the Accept header"""
+    serializer = negotiate_serializer()
+    if serializer is json_serializer:
+        response = jsonify(data)
+    else:
+        response = Response(serializer.dumps(data), mimetype=serializer.mimetype)
+    response.vary.add('Accept')
+    return response
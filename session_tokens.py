@@ -0,0 +1,204 @@
+"""Signed session tokens: an HMAC over the token id, user id and issue time,
+checked without the sessions table. Revocations are kept in memory and
+synced from session_revocations, so other instances see them too"""
+import base64
+import hmac
+import os
+from hashlib import sha256
+from threading import Lock
+from time import monotonic, time
+from uuid import UUID, uuid4
+
+import metrics
+
+
+def parse_keys(value):
+    """Parse "kid:secret,kid:secret" into {kid: secret}, the first key signs new tokens"""
+    keys = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        kid, secret = item.strip().split(':', 1)
+        if not kid or '.' in kid or not secret:
+            raise ValueError(f"invalid session token key {kid!r}")
+        keys[kid] = secret.encode('utf-8')
+    return keys
+
+
+# Rotate by putting a new key first and dropping the old one once SESSION_TOKEN_TTL_S
+# passed, tokens signed by any listed key stay valid. No keys keeps opaque session ids
+KEYS = parse_keys(os.environ.get('SESSION_TOKEN_KEYS', ''))
+ENABLED = bool(KEYS)
+TTL_MS = int(float(os.environ.get('SESSION_TOKEN_TTL_S', 30 * 24 * 3600)) * 1000)
+# Other instances' revocations are picked up this often
+SYNC_INTERVAL = float(os.environ.get('SESSION_REVOCATION_SYNC_S', 10))
+# Each sync reads again revocations this much older than the previous one,
+# so rows committed late (or by a server with a lagging clock) aren't missed
+SYNC_OVERLAP_MS = 60 * 1000
+# Tokens issued this far in the future still pass, for clocks a little ahead
+CLOCK_SKEW_MS = 60 * 1000
+
+# One row per revocation: a token (token_id) or every token of the user (token_id NULL)
+# issued before issued_before. Always returns a first row with the database time
+SYNC_SQL = "SELECT (extract(epoch from now()) * 1000)::bigint, r.user_id, r.token_id, r.issued_before \
+    FROM (SELECT 1) clock LEFT JOIN session_revocations r \
+    ON r.revoked_at >= to_timestamp(%s / 1000.0)"
+REVOKE_SQL = "INSERT INTO session_revocations (user_id, token_id, issued_before) VALUES (%s, %s, %s)"
+
+checked_tokens = metrics.Counter(
+    'sapper_session_tokens_total',
+    "Signed session tokens accepted (valid) or rejected (invalid, expired, revoked)",
+    ('result',))
+metrics.registry.append(checked_tokens)
+
+
+def now_ms():
+    return int(time() * 1000)
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def sign(kid, key, payload):
+    # 128 bits of the HMAC are plenty for a tag and keep the token short
+    return hmac.new(key, kid.encode('utf-8') + b'.' + payload, sha256).digest()[:16]
+
+
+def is_token(session_id):
+    """Signed tokens contain dots, opaque session ids are uuids"""
+    return isinstance(session_id, str) and '.' in session_id
+
+
+def issue(user_id, issued_at=None):
+    """A new token for user_id signed with the first key, "kid.payload.tag" """
+    if issued_at is None:
+        issued_at = now_ms()
+    kid, key = next(iter(KEYS.items()))
+    payload = uuid4().bytes + UUID(str(user_id)).bytes + issued_at.to_bytes(8, 'big')
+    return f"{kid}.{encode(payload)}.{encode(sign(kid, key, payload))}"
+
+
+def parse(token):
+    """(token_id, user_id, issued_at) of a correctly signed token, otherwise None.
+    Expiry and revocation are left to verify()"""
+    try:
+        kid, payload, tag = token.split('.')
+        key = KEYS.get(kid)
+        if key is None:
+            return None
+        payload, tag = decode(payload), decode(tag)
+    except ValueError:
+        return None
+    if len(payload) != 40 or not hmac.compare_digest(sign(kid, key, payload), tag):
+        return None
+    return str(UUID(bytes=payload[:16])), str(UUID(bytes=payload[16:32])), int.from_bytes(payload[32:], 'big')
+
+
+class Revocations:
+    """Revoked token ids and per user "tokens issued before" times. Entries are
+    dropped once every token they cover has expired, so this stays small"""
+
+    def __init__(self, ttl_ms=TTL_MS, sync_interval=SYNC_INTERVAL):
+        self.ttl_ms = ttl_ms
+        self.sync_interval = sync_interval
+        self.tokens = {}
+        self.users = {}
+        # Database time of the last sync, None until the first one
+        self.synced_at = None
+        self.checked_at = 0.0
+        # Held by the sync in progress
+        self.lock = Lock()
+        # Held while tokens and users change or are read, requests revoke during a sync
+        self.data_lock = Lock()
+
+    def add(self, user_id, token_id, issued_before):
+        with self.data_lock:
+            if token_id is not None:
+                self.tokens[str(token_id)] = issued_before
+            elif issued_before > self.users.get(str(user_id), 0):
+                self.users[str(user_id)] = issued_before
+
+    def is_revoked(self, token_id, user_id, issued_at):
+        with self.data_lock:
+            return token_id in self.tokens or issued_at < self.users.get(user_id, 0)
+
+    def due(self):
+        return self.synced_at is None or monotonic() - self.checked_at >= self.sync_interval
+
+    def since(self):
+        """Lower bound of revoked_at for the next sync"""
+        if self.synced_at is None:
+            return 0
+        return self.synced_at - SYNC_OVERLAP_MS
+
+    def apply(self, rows):
+        """Add the rows of SYNC_SQL"""
+        for _synced_at, user_id, token_id, issued_before in rows:
+            if user_id is not None:
+                self.add(user_id, token_id, issued_before)
+        self.synced_at = rows[0][0]
+        self.checked_at = monotonic()
+        self.prune(now_ms())
+
+    def prune(self, now):
+        expired = now - self.ttl_ms
+        with self.data_lock:
+            for token_id in [token_id for token_id, issued_before in self.tokens.items() if issued_before <= expired]:
+                del self.tokens[token_id]
+            for user_id in [user_id for user_id, issued_before in self.users.items() if issued_before <= expired]:
+                del self.users[user_id]
+
+
+revocations = Revocations()
+
+
+def verify(token, now=None):
+    """(token_id, user_id) of a valid token, None when it is forged, expired or revoked"""
+    session = parse(token)
+    if session is None:
+        checked_tokens.inc('invalid')
+        return None
+    token_id, user_id, issued_at = session
+    if now is None:
+        now = now_ms()
+    if issued_at + TTL_MS <= now or issued_at > now + CLOCK_SKEW_MS:
+        checked_tokens.inc('expired')
+        return None
+    if revocations.is_revoked(token_id, user_id, issued_at):
+        checked_tokens.inc('revoked')
+        return None
+    checked_tokens.inc('valid')
+    return token_id, user_id
+
+
+def session_params(session_id):
+    """session_id and session_user for queries.SESSION_ROW. A valid token gives its own id
+    (which keys its game) and user, an opaque session id itself and None, a bad token None and None"""
+    if is_token(session_id):
+        session = verify(session_id) or (None, None)
+    else:
+        session = (session_id, None)
+    return {'session_id': session[0], 'session_user': session[1]}
+
+
+def revoke(token):
+    """REVOKE_SQL values revoking a valid token, applied locally right away. None for other tokens"""
+    session = parse(token)
+    if session is None:
+        return None
+    token_id, user_id, issued_at = session
+    revocations.add(user_id, token_id, issued_at + 1)
+    return user_id, token_id, issued_at + 1
+
+
+def revoke_user(user_id, issued_before=None):
+    """REVOKE_SQL values revoking every token of the user issued so far, applied locally right away"""
+    if issued_before is None:
+        issued_before = now_ms()
+    revocations.add(user_id, None, issued_before)
+    return str(user_id), None, issued_before
@@ -0,0 +1,150 @@
+"""Coalescing of identical concurrent reads: callers asking for the same
+(owner, name) while a fetch is running wait for it and share its result"""
+import os
+from threading import Event, Lock
+from time import monotonic
+
+import metrics
+
+# Results are reused this long after the fetch finishes, 0 only shares fetches in flight
+TTL = float(os.environ.get('SINGLE_FLIGHT_TTL_MS', 0)) / 1000
+# Finished results are swept once this many owners are tracked
+PRUNE_AFTER = 1024
+
+coalesced_reads = metrics.Counter(
+    'sapper_coalesced_reads_total',
+    "Reads that ran a fetch (leader) or shared a running or recent one (shared)",
+    ('name', 'result'))
+metrics.registry.append(coalesced_reads)
+
+
+class Flight:
+    __slots__ = ('done', 'result', 'error', 'expires')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+        self.expires = None
+
+
+class TaskFlight:
+    __slots__ = ('task', 'expires')
+
+    def __init__(self, task):
+        self.task = task
+        self.expires = None
+
+
+class SingleFlight:
+    """Shares fetches between threads. Owners (a session) are invalidated as a
+    whole by writes, so nothing started before the write is handed out after it"""
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self.flights = {}
+        self.lock = Lock()
+
+    def do(self, owner, name, fetch):
+        """fetch() once for all concurrent callers with the same owner and name"""
+        with self.lock:
+            flights = self.flights.setdefault(owner, {})
+            flight = flights.get(name)
+            if flight is None or (flight.expires is not None and flight.expires <= monotonic()):
+                flight = flights[name] = Flight()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            coalesced_reads.inc(name, 'shared')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        coalesced_reads.inc(name, 'leader')
+        try:
+            flight.result = fetch()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            flight.expires = monotonic() + self.ttl
+            self.land(owner, name, flight)
+            flight.done.set()
+        return flight.result
+
+    def land(self, owner, name, flight):
+        """Forget a finished flight unless its result may still be reused"""
+        with self.lock:
+            flights = self.flights.get(owner)
+            if flights is not None and flights.get(name) is flight \
+                    and (self.ttl <= 0 or flight.error is not None):
+                del flights[name]
+                if not flights:
+                    del self.flights[owner]
+            if len(self.flights) > PRUNE_AFTER:
+                self.prune()
+
+    def prune(self):
+        now = monotonic()
+        for owner in list(self.flights):
+            flights = self.flights[owner]
+            for name in [name for name, flight in flights.items() if flight.expires is not None and flight.expires <= now]:
+                del flights[name]
+            if not flights:
+                del self.flights[owner]
+
+    def invalidate(self, owner):
+        """Drop the owner's results and detach its running fetches, later calls fetch again"""
+        with self.lock:
+            self.flights.pop(owner, None)
+
+
+class AsyncSingleFlight:
+    """SingleFlight for the event loop: the fetch runs as a task, so a caller
+    that goes away doesn't cancel it for the others"""
+
+    def __init__(self, ttl=TTL):
+        self.ttl = ttl
+        self.flights = {}
+
+    async def do(self, owner, name, fetch):
+        """await fetch() once for all concurrent callers with the same owner and name"""
+        # Already loaded under the event loop, importing it at the top would slow index.py's cold start
+        import asyncio
+        flights = self.flights.setdefault(owner, {})
+        flight = flights.get(name)
+        if flight is not None and (flight.expires is None or flight.expires > monotonic()):
+            coalesced_reads.inc(name, 'shared')
+            return await asyncio.shield(flight.task)
+
+        coalesced_reads.inc(name, 'leader')
+        flight = flights[name] = TaskFlight(asyncio.ensure_future(fetch()))
+        flight.task.add_done_callback(lambda _task: self.land(owner, name, flight))
+        return await asyncio.shield(flight.task)
+
+    def land(self, owner, name, flight):
+        flight.expires = monotonic() + self.ttl
+        flights = self.flights.get(owner)
+        if flights is not None and flights.get(name) is flight \
+                and (self.ttl <= 0 or flight.task.cancelled() or flight.task.exception() is not None):
+            del flights[name]
+            if not flights:
+                del self.flights[owner]
+        if len(self.flights) > PRUNE_AFTER:
+            self.prune()
+
+    def prune(self):
+        now = monotonic()
+        for owner in list(self.flights):
+            flights = self.flights[owner]
+            for name in [name for name, flight in flights.items() if flight.expires is not None and flight.expires <= now]:
+                del flights[name]
+            if not flights:
+                del self.flights[owner]
+
+    def invalidate(self, owner):
+        """Drop the owner's results and detach its running fetches, later calls fetch again"""
+        self.flights.pop(owner, None)
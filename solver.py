@@ -0,0 +1,173 @@
+"""Minesweeper constraint solver, used to generate boards that can be
+cleared from the first click without guessing"""
+from collections import deque
+from functools import lru_cache
+from time import perf_counter
+
+
+class SolverTimeout(Exception):
+    """The deadline passed before the solver reached a verdict"""
+
+
+@lru_cache(maxsize=32)
+def neighbor_table(size_x, size_y):
+    """Neighbour ids (excluding the tile itself) of every tile"""
+    table = []
+    for tile_id in range(size_x * size_y):
+        x, y = tile_id % size_x, tile_id // size_x
+        table.append(tuple(
+            nx + ny*size_x
+            for nx in range(max(x-1, 0), min(x+2, size_x))
+            for ny in range(max(y-1, 0), min(y+2, size_y))
+            if nx != x or ny != y
+        ))
+    return table
+
+
+class Solver:
+    """Plays a board the way a careful player would: only revealing tiles
+    that are provably safe, using single-tile counts, overlapping pairs of
+    counts and the total mine count"""
+
+    def __init__(self, size_x, size_y, board, deadline=None):
+        self.board = board
+        self.neighbors = neighbor_table(size_x, size_y)
+        self.deadline = deadline
+        self.revealed = bytearray(len(board))
+        self.flagged = bytearray(len(board))
+        self.safe_left = sum(1 for value in board if value != 9)
+        self.mines_left = len(board) - self.safe_left
+        self.dirty = deque()
+
+    def check_deadline(self):
+        if self.deadline is not None and perf_counter() > self.deadline:
+            raise SolverTimeout
+
+    def reveal(self, tile_id):
+        """Reveal a safe tile, flooding through zeros like uncover_tiles"""
+        queue = [tile_id]
+        while queue:
+            current = queue.pop()
+            if self.revealed[current]:
+                continue
+            if self.safe_left % 256 == 0:
+                self.check_deadline()
+            self.revealed[current] = 1
+            self.safe_left -= 1
+            self.dirty.append(current)
+            for neighbor in self.neighbors[current]:
+                if self.revealed[neighbor]:
+                    self.dirty.append(neighbor)
+                elif self.board[current] == 0:
+                    queue.append(neighbor)
+
+    def flag(self, tile_id):
+        self.flagged[tile_id] = 1
+        self.mines_left -= 1
+        for neighbor in self.neighbors[tile_id]:
+            if self.revealed[neighbor]:
+                self.dirty.append(neighbor)
+
+    def constraint(self, tile_id):
+        """(unknown neighbour ids, mines among them) of a revealed tile"""
+        unknown = []
+        mines = self.board[tile_id]
+        for neighbor in self.neighbors[tile_id]:
+            if self.flagged[neighbor]:
+                mines -= 1
+            elif not self.revealed[neighbor]:
+                unknown.append(neighbor)
+        return unknown, mines
+
+    def apply(self, safe, mines):
+        for tile_id in mines:
+            if not self.flagged[tile_id]:
+                self.flag(tile_id)
+        for tile_id in safe:
+            if not self.revealed[tile_id]:
+                self.reveal(tile_id)
+        return bool(safe or mines)
+
+    def single_pass(self):
+        """Resolve tiles whose own count decides all of their unknown neighbours"""
+        progress = False
+        while self.dirty:
+            if len(self.dirty) % 256 == 0:
+                self.check_deadline()
+            tile_id = self.dirty.popleft()
+            unknown, mines = self.constraint(tile_id)
+            if not unknown:
+                continue
+            if mines == 0:
+                progress |= self.apply(unknown, ())
+            elif mines == len(unknown):
+                progress |= self.apply((), unknown)
+        return progress
+
+    def pair_pass(self):
+        """Compare overlapping counts: when the mines one tile needs outside
+        of the overlap fill (or cannot exist in) its remaining unknowns"""
+        constraints = {}
+        by_tile = {}
+        for tile_id in range(len(self.board)):
+            if tile_id % 1024 == 0:
+                self.check_deadline()
+            if not self.revealed[tile_id] or self.board[tile_id] == 0:
+                continue
+            unknown, mines = self.constraint(tile_id)
+            if unknown:
+                constraints[tile_id] = (frozenset(unknown), mines)
+                for neighbor in unknown:
+                    by_tile.setdefault(neighbor, []).append(tile_id)
+
+        # Everything deduced from the same position holds together, apply it in one go
+        safe, mines_found = set(), set()
+        for tile_id, (cells, mines) in constraints.items():
+            self.check_deadline()
+            others = {other for cell in cells for other in by_tile[cell] if other != tile_id}
+            for other in others:
+                other_cells, other_mines = constraints[other]
+                only_here = cells - other_cells
+                only_there = other_cells - cells
+                # Mines that must lie outside of the overlap
+                if mines - other_mines == len(only_here) and only_here:
+                    mines_found |= only_here
+                    safe |= only_there
+                elif other_mines - mines == len(only_there) and only_there:
+                    mines_found |= only_there
+                    safe |= only_here
+                # Overlap already holds every mine of the subset
+                elif not only_here and mines == other_mines and only_there:
+                    safe |= only_there
+        return self.apply(safe, mines_found)
+
+    def count_pass(self):
+        """Use the total mine count once it decides every remaining tile"""
+        unknown = [
+            tile_id for tile_id in range(len(self.board))
+            if not self.revealed[tile_id] and not self.flagged[tile_id]
+        ]
+        if self.mines_left == 0:
+            return self.apply(unknown, ())
+        if self.mines_left == len(unknown):
+            return self.apply((), unknown)
+        return False
+
+    def solve(self, start):
+        """True if every safe tile can be revealed from start without guessing"""
+        if self.board[start] == 9:
+            return False
+        self.reveal(start)
+        while self.safe_left:
+            self.check_deadline()
+            if self.single_pass():
+                continue
+            if not (self.pair_pass() or self.count_pass()):
+                return False
+        return True
+
+
+def is_solvable(size_x, size_y, board, start, deadline=None):
+    """True if the board can be cleared from start without guessing.
+    Raises SolverTimeout once perf_counter() passes deadline"""
+    return Solver(size_x, size_y, board, deadline).solve(start)
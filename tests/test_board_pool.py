@@ -0,0 +1,54 @@
+import board_pool
+
+SMALL = (9, 9, 10)
+MEDIUM = (16, 16, 40)
+LARGE = (30, 16, 99)
+
+
+def request(pool, config, times=1):
+    for _ in range(times):
+        pool.take(*config)
+
+
+def test_configuration_is_adopted_after_enough_requests():
+    pool = board_pool.BoardPool(1, adopt_after=3)
+
+    request(pool, SMALL, 2)
+    assert SMALL not in pool.boards
+    request(pool, SMALL)
+    assert SMALL in pool.boards
+
+
+def test_huge_configurations_are_never_adopted():
+    pool = board_pool.BoardPool(1, adopt_after=1, max_tiles=2500)
+
+    request(pool, (2000, 2000, 400000), 10)
+    request(pool, (50, 50, 250))
+
+    assert list(pool.boards) == [(50, 50, 250)]
+
+
+def test_full_pool_replaces_its_least_requested_configuration():
+    pool = board_pool.BoardPool(1, configs=[LARGE], max_configs=2, adopt_after=2)
+    request(pool, SMALL, 5)
+    assert set(pool.boards) == {LARGE, SMALL}
+
+    # Not requested more than SMALL yet
+    request(pool, MEDIUM, 5)
+    assert set(pool.boards) == {LARGE, SMALL}
+
+    # The configured LARGE is kept however rarely it is played
+    request(pool, MEDIUM)
+    assert set(pool.boards) == {LARGE, MEDIUM}
+
+
+def test_request_counts_fade_every_window():
+    pool = board_pool.BoardPool(1, adopt_after=3, window=4)
+
+    request(pool, SMALL, 2)
+    request(pool, MEDIUM, 2)
+
+    # Halved once the window of 4 first clicks is over
+    assert pool.requests == {SMALL: 1, MEDIUM: 1}
+    request(pool, SMALL, 2)
+    assert SMALL in pool.boards
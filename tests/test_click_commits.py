@@ -0,0 +1,171 @@
+"""/click_tile saves each click with one statement and a single commit"""
+import os
+from uuid import uuid4
+
+import pytest
+
+import index
+from game import count_neighbors, dump_game_data, set_tiles
+
+SESSION_ID = str(uuid4())
+USER_ID = str(uuid4())
+# 3x3 board with its only mine in the corner, tile 4 is a 1 and tile 0 opens every other tile
+MINE = 8
+
+
+class FakeCursor:
+    """Answers fetchone() with the given rows in order and keeps the statements"""
+
+    def __init__(self, *rows):
+        self.rows = list(rows)
+        self.statements = []
+
+    def execute(self, sql, values=None):
+        self.statements.append(sql)
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def stored_game(revealed=(), timer_started=True):
+    game_data = {
+        'size_x': 3,
+        'size_y': 3,
+        'mine_count': 1,
+        'timer_started': timer_started,
+        'booster_active': False,
+        'no_guess': False
+    }
+    set_tiles(game_data, count_neighbors(3, 3, {MINE}), revealed)
+    return dump_game_data(game_data)
+
+
+def click(tile_id, saved_row, revealed=(), timer_started=True):
+    """Play tile_id, returns (status, response data, connection, cursor)"""
+    session = (USER_ID, False, 0, stored_game(revealed, timer_started), 1000, 1)
+    cursor = FakeCursor(session, saved_row)
+    conn = FakeConnection()
+    with index.app.test_request_context():
+        response, status = index.play_click(conn, cursor, SESSION_ID, tile_id)
+        return status, response.get_json(), conn, cursor
+
+
+@pytest.fixture(autouse=True)
+def no_history(monkeypatch):
+    monkeypatch.setattr(index.results, 'record', lambda *args: None)
+
+
+def test_playing_click_commits_once():
+    status, data, conn, cursor = click('4', (None, None, None))
+
+    assert (status, data['type']) == (200, 'playing')
+    assert (conn.commits, conn.rollbacks) == (1, 0)
+    # The read and the save
+    assert len(cursor.statements) == 2
+
+
+def test_loss_commits_once():
+    status, data, conn, cursor = click(str(MINE), (0, 0, 0))
+
+    assert (status, data['type']) == (200, 'loss')
+    assert (conn.commits, conn.rollbacks) == (1, 0)
+    assert 'DELETE FROM games' in cursor.statements[1] and 'UPDATE users' in cursor.statements[1]
+
+
+def test_win_commits_once():
+    status, data, conn, cursor = click('0', (25, 25, 25))
+
+    assert (status, data['type'], data['xp']) == (200, 'win', 25)
+    assert (conn.commits, conn.rollbacks) == (1, 0)
+    assert len(cursor.statements) == 2
+
+
+def test_failed_click_commits_nothing():
+    status, data, conn, cursor = click('4', None, revealed=[4])
+
+    assert (status, data['reason']) == (400, "tile already clicked")
+    assert (conn.commits, conn.rollbacks) == (0, 1)
+    assert len(cursor.statements) == 1
+
+
+def test_failed_first_click_starts_the_timer():
+    status, data, conn, cursor = click('9', (None, None, None), timer_started=False)
+
+    assert (status, data['reason']) == (404, "tile not found")
+    assert (conn.commits, conn.rollbacks) == (1, 0)
+
+
+@pytest.fixture(scope='module')
+def database(tmp_path_factory):
+    """index.py against an embedded Postgres with loadtest/schema.sql loaded"""
+    pgserver = pytest.importorskip('pgserver')
+    data_dir = str(tmp_path_factory.mktemp('pgdata'))
+    server = pgserver.get_server(data_dir, cleanup_mode='stop')
+    with open(os.path.join(os.path.dirname(__file__), '..', 'loadtest', 'schema.sql')) as f:
+        server.psql(f.read())
+
+    environ = dict(os.environ)
+    os.environ.update(DB_HOST=data_dir, DB_USER='postgres', DB_NAME='postgres', DB_PASSWORD='',
+                      RATE_LIMIT_ENABLED='0')
+    yield index.app.test_client()
+    if index.pool is not None:
+        index.pool.closeall()
+        index.pool = None
+    os.environ.clear()
+    os.environ.update(environ)
+
+
+def click_commits():
+    """(commits, requests) recorded so far for /click_tile"""
+    series = index.metrics.commit_count.series.get('/click_tile', [None, 0, 0])
+    return series[1], series[2]
+
+
+def test_game_commits_once_per_click(database):
+    client = database
+    name = f"click-{uuid4().hex[:8]}"
+    client.post('/register', data={'email': f"{name}@example.com", 'username': name, 'password': 'password123'})
+    session_id = client.post('/login', data={'email': f"{name}@example.com", 'password': 'password123'}).get_json()['session_id']
+    client.post('/create_game', json={'session_id': session_id, 'size_x': 9, 'size_y': 9, 'difficulty': 1, 'booster_used': 0})
+
+    # Rows written by older versions can end with a literal ::text
+    conn = index.connect()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET statistics = statistics || '::text' WHERE username = %s", (name,))
+    conn.commit()
+
+    board = client.post('/click_tile', json={'session_id': session_id, 'tile_id': '0'}).get_json()['board']
+    cursor.execute("SELECT data FROM games WHERE game_id = %s", (session_id,))
+    tiles = index.load_game_data(cursor.fetchone()[0])['tiles']
+    conn.close()
+
+    data = {'type': 'playing', 'board': board}
+    for tile_id, tile in tiles.items():
+        if data['type'] != 'playing':
+            break
+        if tile['value'] == 9 or data['board'][tile_id] != -1:
+            continue
+        commits, requests = click_commits()
+        response = client.post('/click_tile', json={'session_id': session_id, 'tile_id': tile_id})
+        data = response.get_json()
+        assert response.status_code == 200
+        assert click_commits() == (commits + 1, requests + 1)
+
+    assert data['type'] == 'win'
+    statistics = client.post('/get_statistics', json={'session_id': session_id}).get_json()['statistics']
+    assert (statistics['games_played'], statistics['games_won']) == (1, 1)
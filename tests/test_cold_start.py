@@ -0,0 +1,37 @@
+"""index.py imports without a database, within the cold start budget of benchmarks/bench_import.py"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import bench_import
+
+# The pool (and with it any connection) is only opened by the first request
+CHECK = "import index; assert index.pool is None; print('ok')"
+
+
+def environment():
+    env = {name: value for name, value in os.environ.items() if name not in ('DB_PASSWORD', 'DB_HOST')}
+    env['DB_WARM_UP'] = '0'
+    return env
+
+
+def test_index_imports_without_database():
+    process = subprocess.run(
+        [sys.executable, '-c', CHECK], cwd=ROOT, env=environment(), capture_output=True, text=True
+    )
+
+    assert process.returncode == 0, process.stderr
+    assert process.stdout.strip() == 'ok'
+
+
+def test_index_import_within_budget():
+    # The fastest of a few runs, so a busy test machine doesn't fail it
+    timings = []
+    for _ in range(3):
+        seconds, error = bench_import.import_once('index')
+        assert error is None
+        timings.append(seconds)
+
+    assert min(timings) * 1000 <= bench_import.BUDGET_MS
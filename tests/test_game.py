@@ -0,0 +1,125 @@
+import base64
+import json
+import random
+
+import game
+
+
+def test_seeded_mines_are_pinned():
+    """Stored games and replays rebuild their board from the seed, these must never change"""
+    assert game.seeded_mines(9, 9, 10, 12345, 40) == (1, 14, 17, 18, 19, 26, 33, 44, 45, 67)
+    assert game.seeded_mines(16, 16, 40, 987654321, 0) == (
+        12, 21, 26, 27, 32, 42, 44, 49, 57, 59, 61, 73, 80, 86, 88, 98, 102, 105, 114, 120,
+        122, 135, 142, 148, 154, 156, 160, 163, 167, 191, 194, 196, 198, 204, 208, 227, 248, 253, 254, 255
+    )
+
+
+def test_mines_only_use_random():
+    class RandomOnly:
+        """random() of a seeded Random and nothing else"""
+        def __init__(self, seed):
+            self.random = random.Random(seed).random
+
+    assert game.place_mines(9, 9, 10, 40, rng=RandomOnly(12345)) == game.seeded_mines(9, 9, 10, 12345, 40)
+
+
+def test_prepared_board_matches_seeded_mines():
+    for seed in range(20):
+        prepared = game.PreparedBoard(16, 16, 40, seed=seed)
+        board = prepared.open_at(17)
+
+        mines = game.seeded_mines(16, 16, 40, seed, 17)
+        assert tuple(sorted(prepared.mines)) == mines
+        assert board == game.count_neighbors(16, 16, mines)
+
+
+def test_random_tiles_are_distinct():
+    rng = random.Random(1)
+    assert sorted(game.random_tiles(rng, 10, 10)) == list(range(10))
+    assert len(set(game.random_tiles(rng, 1000, 999))) == 999
+
+
+def test_varints_round_trip():
+    values = [0, 1, 127, 128, 16383, 16384, 2**21, 2**35]
+    log = bytearray()
+    for value in values:
+        start = len(log)
+        game.append_varint(log, value)
+        # 7 bits per byte: 127 fits in one, 128 takes two and 16384 three
+        assert len(log) - start == max(1, (value.bit_length() + 6) // 7)
+
+    assert game.read_varints(bytes(log)) == values
+
+
+def test_click_log_round_trip():
+    game_data = {}
+    game.record_click(game_data, '127', now=100.0)
+    game.record_click(game_data, '128', now=101.27)
+    game.record_click(game_data, '16384', now=101.27)
+    game.record_click(game_data, '5', now=265.11)
+
+    log = base64.b64decode(game_data['clicks'])
+    assert game.decode_clicks(log) == [(127, 0), (128, 127), (16384, 0), (5, 16384)]
+    # psycopg2 returns bytea as a memoryview
+    assert game.decode_clicks(memoryview(log)) == game.decode_clicks(log)
+
+
+def new_game(size_x, size_y, mine_count):
+    return {
+        'size_x': size_x,
+        'size_y': size_y,
+        'mine_count': mine_count,
+        'timer_started': True,
+        'booster_active': False,
+        'no_guess': False
+    }
+
+
+def test_seeded_game_round_trip():
+    # 15 tiles, the bitmap's last byte is padded
+    game_data = new_game(5, 3, 3)
+    game.apply_click(game_data, '14')
+    stored = json.loads(game.dump_game_data(game_data))
+
+    assert 'tiles' not in stored and 'mines' not in stored
+    assert len(base64.b64decode(stored['revealed'])) == 2
+    assert game.load_game_data(game.dump_game_data(game_data)) == game_data
+
+
+def test_unseeded_game_round_trip():
+    # Boards not generated from a seed keep their mine ids, a blown up mine included
+    game_data = game.set_tiles(new_game(5, 3, 3), game.count_neighbors(5, 3, {0, 7, 14}), revealed=[1, 14])
+    stored = json.loads(game.dump_game_data(game_data))
+
+    assert sorted(stored['mines']) == [0, 7, 14]
+    assert game.load_game_data(game.dump_game_data(game_data)) == game_data
+    assert game_data['tiles']['14'] == {'value': 10, 'hidden': False}
+
+
+def test_legacy_games_load():
+    game_data = game.set_tiles(new_game(3, 3, 1), game.count_neighbors(3, 3, {8}), revealed=[0])
+    # Stored before boards were kept as a seed, with every tile
+    assert game.load_game_data(json.dumps(game_data)) == game_data
+    # Created but not clicked yet
+    assert game.load_game_data(json.dumps(new_game(9, 9, 10))) == new_game(9, 9, 10)
+
+
+def test_replay_reproduces_the_final_board():
+    game_data = new_game(16, 16, 40)
+    rng = random.Random(7)
+    tile_id, outcome, now = '100', 'playing', 1000.0
+    while outcome == 'playing':
+        outcome = game.apply_click(game_data, tile_id)
+        now += rng.random()
+        game.record_click(game_data, tile_id, now)
+        tile_id = rng.choice([tile_id for tile_id, tile in game_data['tiles'].items() if tile['hidden']])
+
+    clicks = game.decode_clicks(base64.b64decode(game_data['clicks']))
+    replayed, replay_outcome = game.replay_game(
+        16, 16, 40, game_data['seed'], game_data['safe_tile'], clicks
+    )
+
+    assert replay_outcome == outcome
+    assert replayed['tiles'] == game_data['tiles']
+    # Every earlier step is still playing
+    assert game.replay_game(16, 16, 40, game_data['seed'], game_data['safe_tile'], clicks, len(clicks) - 1)[1] == 'playing'
@@ -0,0 +1,69 @@
+import asyncio
+from uuid import uuid4
+
+import game_history
+
+GAME = {'size_x': 8, 'size_y': 8, 'mine_count': 10, 'tiles': {}}
+
+
+def unreachable():
+    raise OSError("database unreachable")
+
+
+class FailingPool:
+    def connection(self):
+        raise OSError("database unreachable")
+
+
+def record(queue, count):
+    for _ in range(count):
+        queue.record(uuid4(), GAME, True, 100)
+
+
+def test_failed_write_keeps_results_pending():
+    writer = game_history.ResultWriter(batch_size=2, max_pending=10)
+    writer.connect = unreachable
+    record(writer, 5)
+    pending = list(writer.pending)
+
+    writer.flush()
+
+    assert list(writer.pending) == pending
+    assert writer.backoff == writer.flush_interval
+
+
+def test_failed_writes_back_off():
+    writer = game_history.ResultWriter(batch_size=2, max_pending=10, flush_interval=1)
+    writer.connect = unreachable
+    record(writer, 1)
+
+    for _ in range(10):
+        writer.flush()
+
+    assert len(writer.pending) == 1
+    assert writer.backoff == min(2 ** 9, game_history.MAX_BACKOFF)
+
+
+def test_requeue_only_drops_past_max_pending():
+    writer = game_history.ResultWriter(batch_size=3, max_pending=4)
+    writer.connect = unreachable
+    record(writer, 4)
+    batch, _ = writer.take()
+    # Results recorded while the batch was being written
+    record(writer, 2)
+    pending = list(writer.pending)
+
+    writer.failed(batch)
+
+    assert list(writer.pending) == (batch + pending)[:4]
+
+
+def test_async_failed_write_keeps_results_pending():
+    writer = game_history.AsyncResultWriter(batch_size=2, max_pending=10)
+    record(writer, 3)
+    pending = list(writer.pending)
+
+    asyncio.run(writer.flush(FailingPool()))
+
+    assert list(writer.pending) == pending
+    assert writer.backoff > 0
@@ -0,0 +1,86 @@
+from queue import Queue
+
+import pytest
+
+import query_log
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, values=None):
+        self.conn.statements.append(sql)
+
+    def fetchall(self):
+        return [("Seq Scan on users",)]
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.closed = False
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """Connections query_log opened, every slow statement sampled"""
+    opened = []
+
+    def connect():
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(query_log, 'explain_connect', connect)
+    monkeypatch.setattr(query_log, 'explain_rate', 1.0)
+    monkeypatch.setattr(query_log, 'explain_conn', None)
+    monkeypatch.setattr(query_log, 'explains', Queue(maxsize=2))
+    # A worker left from another test waits on its own queue
+    monkeypatch.setattr(query_log, 'explain_thread', None)
+    return opened
+
+
+def slow(statement):
+    query_log.record(statement, statement.encode(), query_log.threshold + 1, '/test')
+    return query_log.slow_queries[-1]
+
+
+def test_explains_share_one_connection(connections):
+    entries = [slow("SELECT * FROM users WHERE uuid = 'a'") for _ in range(2)]
+    query_log.explains.join()
+
+    assert len(connections) == 1
+    assert all(entry['plan'] == "Seq Scan on users" for entry in entries)
+
+
+def test_only_plain_selects_are_analyzed(connections):
+    slow("SELECT * FROM users")
+    slow("UPDATE users SET xp = 1")
+    query_log.explains.join()
+    slow("SELECT gems FROM users WHERE uuid = 'a' FOR UPDATE")
+    query_log.explains.join()
+
+    explained = [sql for sql in connections[0].statements if isinstance(sql, bytes)]
+    assert explained == [
+        b"EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM users",
+        b"EXPLAIN UPDATE users SET xp = 1",
+        b"EXPLAIN SELECT gems FROM users WHERE uuid = 'a' FOR UPDATE"
+    ]
+
+
+def test_full_queue_drops_explains(connections, monkeypatch):
+    # Nothing takes from the queue, so it stays full
+    monkeypatch.setattr(query_log, 'start_explaining', lambda: None)
+    for _ in range(2):
+        slow("SELECT 1")
+
+    entry = slow("SELECT 1")
+
+    assert entry['plan_error'] == "explain queue full"
+    assert connections == []
@@ -0,0 +1,145 @@
+from threading import BoundedSemaphore, Thread
+from time import monotonic, sleep
+
+import pytest
+from flask import Flask
+
+import index
+import rate_limit
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    """Session buckets of 30 tokens refilling 10 per second, IP buckets of 5 refilling 1"""
+    limiter = rate_limit.RateLimiter({'session': (10, 30), 'ip': (1, 5)}, max_buckets=3)
+    monkeypatch.setattr(rate_limit, 'limiter', limiter)
+    monkeypatch.setattr(rate_limit, 'ENABLED', True)
+    return limiter
+
+
+def test_bucket_empties_and_refills(limiter):
+    keys = (('session', 'a'), ('ip', None))
+    for _ in range(30):
+        assert limiter.acquire(keys, 1, now=0) == (0, None)
+
+    assert limiter.acquire(keys, 1, now=0) == (pytest.approx(0.1), 'session')
+    assert limiter.acquire(keys, 1, now=0.1) == (0, None)
+
+
+def test_buckets_are_taken_all_or_none(limiter):
+    for _ in range(5):
+        limiter.acquire((('ip', '1.2.3.4'),), 1, now=0)
+
+    wait, limited_by = limiter.acquire((('session', 'a'), ('ip', '1.2.3.4')), 1, now=0)
+
+    assert (wait, limited_by) == (pytest.approx(1), 'ip')
+    # The session bucket kept the token the IP bucket refused
+    assert limiter.buckets[('session', 'a')][0] == 30
+
+
+def test_disabled_bucket_admits_everything():
+    limiter = rate_limit.RateLimiter({'session': (0, 1)})
+    for _ in range(10):
+        assert limiter.acquire((('session', 'a'),), 1, now=0) == (0, None)
+    assert limiter.buckets == {}
+
+
+def test_least_recently_used_buckets_are_dropped(limiter):
+    for key in 'abcd':
+        limiter.acquire((('session', key),), 1, now=0)
+
+    assert [key for _kind, key in limiter.buckets] == ['b', 'c', 'd']
+
+
+def test_route_costs(limiter, monkeypatch):
+    assert rate_limit.parse_costs("/login=20, /create_game=3,bad") == {'/login': 20, '/create_game': 3}
+    monkeypatch.setattr(rate_limit, 'route_costs', {'/login': 20})
+
+    assert rate_limit.throttle('/login', 'a', None) is None
+    # 10 tokens left, the next login waits a second for the missing 10
+    assert rate_limit.throttle('/login', 'a', None) == 1
+    assert rate_limit.throttle('/me', 'a', None) is None
+    # A cost above the burst only needs a full bucket
+    monkeypatch.setattr(rate_limit, 'route_costs', {'/login': 100})
+    assert rate_limit.throttle('/login', 'b', None) is None
+
+
+def test_exempt_routes_are_never_limited(limiter):
+    for _ in range(100):
+        assert rate_limit.check('/readyz', 'a', '1.2.3.4') is None
+
+
+@pytest.fixture
+def client(limiter):
+    app = Flask(__name__)
+    rate_limit.init_app(app)
+
+    @app.route('/me', methods=['POST'])
+    def me():
+        return {"type": "success"}
+
+    return app.test_client()
+
+
+def test_rejection_has_retry_after(client):
+    for _ in range(5):
+        assert client.post('/me', json={'session_id': 'a'}).status_code == 200
+
+    response = client.post('/me', json={'session_id': 'a'})
+
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert response.get_json() == {"type": "fail", "reason": "rate limited", "retry_after": 1}
+
+
+def test_admission_sheds_past_max_in_flight():
+    admission = rate_limit.Admission(max_in_flight=2, max_pool_waiting=0)
+
+    assert admission.enter() and admission.enter()
+    assert not admission.enter()
+    admission.leave()
+    assert admission.enter()
+
+
+def test_overloaded_request_is_shed(client, monkeypatch):
+    admission = rate_limit.Admission(max_in_flight=1)
+    monkeypatch.setattr(rate_limit, 'admission', admission)
+    admission.enter()
+
+    response = client.post('/me', json={'session_id': 'a'})
+
+    assert (response.status_code, response.headers['Retry-After']) == (503, '1')
+    # Shed requests aren't counted, only the one still in flight
+    assert admission.in_flight == 1
+
+
+class FakePool:
+    def getconn(self):
+        return FakeConnection()
+
+    def putconn(self, conn, close=False):
+        pass
+
+
+class FakeConnection:
+    closed = False
+
+
+def test_flask_sheds_when_requests_wait_for_the_pool(monkeypatch):
+    monkeypatch.setattr(index, 'pool_slots', BoundedSemaphore(1))
+    monkeypatch.setattr(index, 'get_pool', FakePool)
+    admission = rate_limit.Admission(max_in_flight=0, max_pool_waiting=1)
+    admission.pool_waiting = rate_limit.admission.pool_waiting
+
+    conn = index.getconn()
+    waiting = Thread(target=lambda: index.putconn(index.getconn()))
+    waiting.start()
+    deadline = monotonic() + 5
+    while index.pool_waiting == 0 and monotonic() < deadline:
+        sleep(0.01)
+
+    assert not admission.enter()
+    index.putconn(conn)
+    waiting.join()
+    assert index.pool_waiting == 0
+    assert admission.enter()
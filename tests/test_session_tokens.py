@@ -0,0 +1,136 @@
+from threading import Thread
+from uuid import uuid4
+
+import pytest
+
+import session_tokens
+
+NOW = 1_800_000_000_000
+USER_ID = str(uuid4())
+
+
+@pytest.fixture(autouse=True)
+def keys(monkeypatch):
+    monkeypatch.setattr(session_tokens, 'KEYS', {'k2': b'new secret', 'k1': b'old secret'})
+    monkeypatch.setattr(session_tokens, 'revocations', session_tokens.Revocations())
+
+
+def tamper(token, part, value):
+    parts = token.split('.')
+    parts[part] = value
+    return '.'.join(parts)
+
+
+def test_issued_token_verifies():
+    token = session_tokens.issue(USER_ID, issued_at=NOW)
+
+    token_id, user_id = session_tokens.verify(token, now=NOW)
+
+    assert user_id == USER_ID
+    assert session_tokens.parse(token) == (token_id, USER_ID, NOW)
+
+
+def test_bad_tag_is_rejected():
+    token = session_tokens.issue(USER_ID, issued_at=NOW)
+    forged = session_tokens.encode(bytes(16))
+
+    assert session_tokens.verify(tamper(token, 2, forged), now=NOW) is None
+    assert session_tokens.verify(tamper(token, 2, "not base64!"), now=NOW) is None
+
+
+def test_unknown_kid_is_rejected():
+    token = session_tokens.issue(USER_ID, issued_at=NOW)
+
+    assert session_tokens.verify(tamper(token, 0, 'k3'), now=NOW) is None
+    # The tag covers the kid, another listed key doesn't verify it either
+    assert session_tokens.verify(tamper(token, 0, 'k1'), now=NOW) is None
+
+
+def test_expired_token_is_rejected():
+    token = session_tokens.issue(USER_ID, issued_at=NOW)
+
+    assert session_tokens.verify(token, now=NOW + session_tokens.TTL_MS - 1) is not None
+    assert session_tokens.verify(token, now=NOW + session_tokens.TTL_MS) is None
+
+
+def test_future_dated_token_is_rejected():
+    token = session_tokens.issue(USER_ID, issued_at=NOW + session_tokens.CLOCK_SKEW_MS)
+    assert session_tokens.verify(token, now=NOW) is not None
+
+    token = session_tokens.issue(USER_ID, issued_at=NOW + session_tokens.CLOCK_SKEW_MS + 1)
+    assert session_tokens.verify(token, now=NOW) is None
+
+
+def test_rotation_signs_with_the_first_key(monkeypatch):
+    monkeypatch.setattr(session_tokens, 'KEYS', {'k1': b'old secret'})
+    old_token = session_tokens.issue(USER_ID, issued_at=NOW)
+    monkeypatch.setattr(session_tokens, 'KEYS', {'k2': b'new secret', 'k1': b'old secret'})
+    new_token = session_tokens.issue(USER_ID, issued_at=NOW)
+
+    assert new_token.startswith('k2.')
+    assert session_tokens.verify(old_token, now=NOW) is not None
+    assert session_tokens.verify(new_token, now=NOW) is not None
+
+    # Once the old key is dropped its tokens stop verifying
+    monkeypatch.setattr(session_tokens, 'KEYS', {'k2': b'new secret'})
+    assert session_tokens.verify(old_token, now=NOW) is None
+
+
+def test_revoked_token_is_rejected():
+    token = session_tokens.issue(USER_ID, issued_at=NOW)
+    other = session_tokens.issue(USER_ID, issued_at=NOW)
+
+    token_id = session_tokens.parse(token)[0]
+    assert session_tokens.revoke(token) == (USER_ID, token_id, NOW + 1)
+
+    assert session_tokens.verify(token, now=NOW) is None
+    assert session_tokens.verify(other, now=NOW) is not None
+
+
+def test_revoked_user_rejects_older_tokens():
+    old_token = session_tokens.issue(USER_ID, issued_at=NOW)
+    session_tokens.revoke_user(USER_ID, issued_before=NOW + 1)
+    new_token = session_tokens.issue(USER_ID, issued_at=NOW + 1)
+
+    assert session_tokens.verify(old_token, now=NOW + 1) is None
+    assert session_tokens.verify(new_token, now=NOW + 1) is not None
+
+
+def test_synced_revocations_survive_pruning():
+    token = session_tokens.issue(USER_ID, issued_at=NOW)
+    other_user = str(uuid4())
+    user_token = session_tokens.issue(other_user, issued_at=NOW)
+    token_id = session_tokens.parse(token)[0]
+    revocations = session_tokens.revocations
+
+    revocations.apply([
+        (NOW, USER_ID, token_id, NOW + 1),
+        (NOW, other_user, None, NOW + 1),
+        # Already expired, pruned right away
+        (NOW, str(uuid4()), str(uuid4()), 1)
+    ])
+
+    assert revocations.synced_at == NOW
+    assert len(revocations.tokens) == 1
+    assert session_tokens.verify(token, now=NOW) is None
+    assert session_tokens.verify(user_token, now=NOW) is None
+
+    # Pruned once every token they cover has expired, and those are rejected as expired
+    revocations.prune(NOW + 1 + session_tokens.TTL_MS)
+    assert (revocations.tokens, revocations.users) == ({}, {})
+    assert session_tokens.verify(token, now=NOW + session_tokens.TTL_MS) is None
+
+
+def test_revoke_waits_for_prune():
+    """A request revoking during a sync's prune() waits instead of changing the dicts it iterates"""
+    revocations = session_tokens.revocations
+    token = session_tokens.issue(USER_ID, issued_at=NOW)
+
+    with revocations.data_lock:
+        thread = Thread(target=session_tokens.revoke, args=(token,))
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive() and revocations.tokens == {}
+    thread.join()
+
+    assert session_tokens.verify(token, now=NOW) is None
@@ -0,0 +1,121 @@
+import asyncio
+from threading import Barrier, Event, Thread
+from time import sleep
+
+import pytest
+
+import single_flight
+
+
+class Fetch:
+    """Counts its calls, each one blocks until release() and returns the call number"""
+
+    def __init__(self):
+        self.calls = 0
+        self.started = Event()
+        self.released = Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        assert self.released.wait(5)
+        return self.calls
+
+    def release(self):
+        self.released.set()
+
+
+def run_readers(flights, fetch, count):
+    barrier = Barrier(count)
+    results = []
+
+    def read():
+        barrier.wait()
+        results.append(flights.do('session', 'user', fetch))
+
+    threads = [Thread(target=read) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_concurrent_reads_share_one_fetch():
+    flights = single_flight.SingleFlight(ttl=0)
+    fetch = Fetch()
+    threads, results = run_readers(flights, fetch, 8)
+    assert fetch.started.wait(5)
+    # Let every reader join the flight before it lands
+    sleep(0.1)
+    fetch.release()
+    for thread in threads:
+        thread.join()
+
+    assert fetch.calls == 1
+    assert results == [1] * 8
+    # Nothing is kept without a TTL
+    assert flights.flights == {}
+
+
+def test_error_is_shared_and_not_kept():
+    flights = single_flight.SingleFlight(ttl=60)
+
+    def fail():
+        raise ValueError("database unreachable")
+
+    with pytest.raises(ValueError):
+        flights.do('session', 'user', fail)
+    assert flights.do('session', 'user', lambda: 'fetched') == 'fetched'
+
+
+def test_results_are_reused_until_the_ttl_passes():
+    flights = single_flight.SingleFlight(ttl=0.05)
+
+    assert flights.do('session', 'user', lambda: 1) == 1
+    assert flights.do('session', 'user', lambda: 2) == 1
+    sleep(0.06)
+    assert flights.do('session', 'user', lambda: 3) == 3
+
+
+def test_invalidate_forces_a_refetch():
+    flights = single_flight.SingleFlight(ttl=60)
+    assert flights.do('session', 'user', lambda: 'before') == 'before'
+
+    flights.invalidate('session')
+
+    assert flights.do('session', 'user', lambda: 'after') == 'after'
+
+
+def test_invalidate_detaches_a_running_fetch():
+    """A read started before a write isn't handed to readers arriving after it"""
+    flights = single_flight.SingleFlight(ttl=60)
+    fetch = Fetch()
+    threads, results = run_readers(flights, fetch, 1)
+    assert fetch.started.wait(5)
+
+    flights.invalidate('session')
+    assert flights.do('session', 'user', lambda: 'after write') == 'after write'
+    fetch.release()
+    threads[0].join()
+
+    assert results == [1]
+    assert flights.do('session', 'user', lambda: 'cached') == 'after write'
+
+
+def test_async_reads_share_one_fetch():
+    flights = single_flight.AsyncSingleFlight(ttl=0)
+    calls = []
+
+    async def fetch():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def main():
+        results = await asyncio.gather(*(flights.do('session', 'user', fetch) for _ in range(8)))
+        flights.invalidate('session')
+        return results, await flights.do('session', 'user', fetch)
+
+    results, after = asyncio.run(main())
+
+    assert results == [1] * 8
+    assert after == 2
@@ -0,0 +1,35 @@
+import game
+import solver
+
+
+def test_board_cleared_by_counts():
+    # Opening the far corner of a 3x3 board with one mine leaves only the mine hidden
+    board = game.count_neighbors(3, 3, {0})
+
+    assert solver.is_solvable(3, 3, board, 8)
+
+
+def test_fifty_fifty_needs_a_guess():
+    # Opening tile 2 leaves tiles 0 and 3 with one mine between them
+    board = game.count_neighbors(3, 2, {0})
+
+    assert board == [9, 1, 0, 1, 1, 0]
+    assert not solver.is_solvable(3, 2, board, 2)
+
+
+def test_no_guess_seed_is_solvable():
+    seed = game.find_no_guess_seed(9, 9, 10, 40, budget_ms=5000)
+    mines = game.seeded_mines(9, 9, 10, seed, 40)
+
+    assert 40 not in mines
+    assert solver.is_solvable(9, 9, game.count_neighbors(9, 9, mines), 40)
+
+
+def test_solver_times_out():
+    board = game.count_neighbors(30, 30, game.seeded_mines(30, 30, 180, 1, 0))
+
+    try:
+        solver.is_solvable(30, 30, board, 0, deadline=0)
+    except solver.SolverTimeout:
+        return
+    raise AssertionError("no SolverTimeout")